@@ -0,0 +1,2562 @@
+#!/usr/bin/env python3
+"""
+ScraperCommon.py — Shared plumbing for the SetFaction* helper scripts.
+
+What it does
+------------
+- TokenBucket: thread-safe requests-per-second limiter shared by all workers
+- AdaptivePacer: '--adaptive' AIMD pacing shared by the search and details sessions; speeds up
+  while answers are fast and successful, halves on 429/5xx/errors/slow answers, honours
+  Retry-After, and logs its current rate
+- CircuitBreaker: per-host breaker; after '--breaker-failures' consecutive failed requests the
+  host is left alone and lookups pause (instead of piling up MISSes) until a probe gets through
+- ResponseCache: SQLite-backed page cache keyed by URL (TTL expiry, LRU size cap),
+  shared by every script pointed at the same --cache-dir; it also keeps each page's ETag /
+  Last-Modified so an expired page is re-fetched conditionally and a 304 reuses the cached body,
+  along with what the script parsed out of it last time (Fetcher.parse)
+- FactionIndex: persistent faction name -> ID-based details URL, so the search step
+  only runs once per faction (records whether the match was exact or a fallback)
+- Fetcher: the one place a script's search/details GETs go through (cache, offline, rate limit);
+  with '--stream-details-kb N' details pages are streamed and the download stops as soon as
+  the fields the script needs have arrived (or after N KB), reading each chunk once
+- scan_output: one streaming pass over a generated .sql file to find what is already done
+- ProgressJournal: append-only JSONL sidecar (<output>.progress.jsonl) with one line per
+  faction outcome; resume and --retry-misses read it instead of the SQL
+- run_watch / split_rechecks: '--watch' daemon mode; stale results are re-checked oldest first,
+  spread over the '--stale-hours' window, and names added to the input file are picked up;
+  each pass that changes something appends its own BEGIN TRAN ... COMMIT block
+- apply_faction_updates: '--apply' bulk load of journalled results into ref.Faction via a
+  staging table (pyodbc fast_executemany) and one set-based UPDATE per batch
+- LazySystemMap: '--system-map lazy' resolves only the system names a run actually scrapes,
+  one cached parameterised query each, instead of loading all of ref.System up front; names
+  with no exact match get one trigram-ranked candidate query each until misses pile up
+- SystemResolver / SystemNameIndex: when a system name has no exact match, retry it by a
+  normalised key (case, unicode dashes, punctuation, spacing) and optionally by trigram similarity
+  ('--system-match fuzzy'); ambiguous names are reported instead of guessed
+- SystemSnapshot: SQLite copy of ref.System (topped up by highest SystemID, reloaded whole after
+  '--system-snapshot-hours') so SystemIDs can be resolved at startup speed, or with no database
+  connection at all
+- DbWriter: '--apply-live' background writer threads that apply results to ref.Faction in
+  batched transactions while the run is still scraping, fed through bounded queues (one per
+  writer, picked by faction name so a faction's results commit in order)
+- GroupCommit: keeps output handles open and fsyncs SQL + journal together in batches
+  ('--fsync-every N' / '--fsync-interval SECS')
+- ValuesBlock + merge_preamble/merge_trailer: '--output-format merge', i.e. rows batched into
+  INSERT INTO #FactionStaging VALUES blocks (1000 rows) and one set-based UPDATE at the end
+- fast_label_value / make_soup: regex fast path over the raw details HTML, with the
+  BeautifulSoup tree ('--parser html.parser|lxml') only built when that fails
+- run_ordered: runs lookups on a bounded thread pool, but hands results back
+  in input order so the generated SQL stays deterministic and resume-safe
+- widen_connection_pool: lets a requests.Session keep one connection per worker
+- run_async_lookups: '--engine async' backend; pipelines search + details fetches for
+  many factions over one asyncio event loop (needs `pip install aiohttp`, Python 3.11+)
+
+The helper scripts import this module from their own folder, so keep it next to them.
+"""
+
+import asyncio
+import codecs
+import email.utils
+import html
+import json
+import math
+import os
+import queue
+import re
+import signal
+import sqlite3
+import threading
+import time
+import unicodedata
+import zlib
+from array import array
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from functools import reduce
+from itertools import chain, repeat
+from operator import or_
+from pathlib import Path
+from urllib.parse import urlsplit
+from typing import IO, Callable, DefaultDict, Deque, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple, TypeVar, Any
+
+from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+
+try:
+    import aiohttp  # only needed for --engine async
+except Exception:
+    aiohttp = None
+
+try:
+    import lxml  # optional, faster BeautifulSoup backend for --parser lxml
+except Exception:
+    lxml = None
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# --- Rate limiting ----------------------------------------------------------------
+
+class TokenBucket:
+    """
+    Classic token bucket: refills at `rate` tokens per second and holds at most `burst`.
+    Each request takes one token; callers that find the bucket empty wait their turn.
+    """
+
+    def __init__(self, rate: float, burst: float = 1.0):
+        if rate <= 0:
+            raise ValueError("rate must be > 0")
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Claim one token and return how many seconds the caller must wait before using it.
+        Tokens may go negative, which queues callers fairly behind each other.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= 1.0
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+ADAPTIVE_MIN_RATE = 0.2
+ADAPTIVE_MAX_RATE = 8.0
+# Longest Retry-After we honour as-is; a site asking for more gets this instead.
+RETRY_AFTER_MAX_SECS = 300.0
+# With --adaptive, 429/5xx answers are retried by Fetcher.get() through the pacer (like the
+# urllib3 Retry they replace) instead of inside the search session's adapter.
+PACED_STATUS_RETRIES = 4
+
+def add_pacing_arguments(parser) -> None:
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Pace requests from the server's answers (AIMD) instead of --sleep and fixed retry "
+                             "pauses: start at --rate, speed up while responses are fast, back off on 429/5xx, "
+                             "errors or slow responses, and honour Retry-After.")
+    parser.add_argument("--min-rate", type=float, default=ADAPTIVE_MIN_RATE,
+                        help=f"With --adaptive: slowest pace in requests/second (default: {ADAPTIVE_MIN_RATE}).")
+    parser.add_argument("--max-rate", type=float, default=ADAPTIVE_MAX_RATE,
+                        help=f"With --adaptive: fastest pace in requests/second (default: {ADAPTIVE_MAX_RATE}).")
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date), or None."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+class AdaptivePacer:
+    """
+    AIMD request pacing driven by the server's answers; a drop-in for TokenBucket.
+
+    Requests are spaced 1/rate seconds apart. Every successful answer that is not much
+    slower than the recent average adds `step` requests/second (up to max_rate); a 429,
+    a 5xx, a transport error or an answer `slow_factor` times slower than average halves
+    the rate (down to min_rate), at most once per `cooldown` seconds so one burst of
+    failures only counts once. A Retry-After header holds every caller back until it
+    has passed. Cuts are reported through `note` as they happen, the current rate every
+    `log_every` seconds.
+    """
+
+    def __init__(self, rate: float, min_rate: float = ADAPTIVE_MIN_RATE, max_rate: float = ADAPTIVE_MAX_RATE,
+                 step: float = 0.1, slow_factor: float = 3.0, cooldown: float = 2.0, log_every: float = 30.0,
+                 note: Callable[[str], Any] = lambda message: None):
+        if not 0 < min_rate <= max_rate:
+            raise ValueError("--min-rate must be > 0 and no more than --max-rate.")
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.rate = min(self.max_rate, max(self.min_rate, float(rate)))
+        self.step = step
+        self.slow_factor = slow_factor
+        self.cooldown = cooldown
+        self.log_every = log_every
+        self.note = note
+        self.latency: Optional[float] = None  # moving average of successful answers, seconds
+        now = time.monotonic()
+        self._next = now
+        self._hold_until = now
+        self._last_cut = now - cooldown
+        self._last_log = now
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Claim the next request slot; returns how many seconds to wait before sending."""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next, self._hold_until)
+            self._next = start + 1.0 / self.rate
+            return start - now
+
+    def acquire(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def observe(self, status: Optional[int], elapsed: float, retry_after: Optional[str] = None) -> None:
+        """Feed back one answer: its status (None = transport error/timeout) and seconds to headers."""
+        with self._lock:
+            now = time.monotonic()
+            wait = parse_retry_after(retry_after)
+            if wait:
+                wait = min(wait, RETRY_AFTER_MAX_SECS)
+                if now >= self._hold_until:
+                    self.note(f"Pacer: server asked to retry after {wait:.0f}s; holding all requests.")
+                self._hold_until = max(self._hold_until, now + wait)
+            if status is None or status == 429 or status >= 500:
+                self._cut(now, f"HTTP {status}" if status else "request failed")
+                return
+            average = self.latency
+            self.latency = elapsed if average is None else 0.8 * average + 0.2 * elapsed
+            if average is not None and elapsed > 1.0 and elapsed > self.slow_factor * average:
+                self._cut(now, f"slow response {elapsed:.1f}s vs {average:.1f}s average")
+                return
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.step)
+            if now - self._last_log >= self.log_every:
+                self._last_log = now
+                self.note(f"Pacer: {self.rate:.2f} requests/second (average response {self.latency:.2f}s).")
+
+    def _cut(self, now: float, reason: str) -> None:
+        if now - self._last_cut < self.cooldown:
+            return
+        self._last_cut = self._last_log = now
+        self.rate = max(self.min_rate, self.rate * 0.5)
+        self.note(f"Pacer: backing off to {self.rate:.2f} requests/second ({reason}).")
+
+# --- Circuit breaker --------------------------------------------------------------
+
+BREAKER_FAILURES = 5
+BREAKER_COOLDOWN_SECS = 60.0
+BREAKER_MAX_COOLDOWN_SECS = 300.0
+# Times one faction's lookup is redone because of an outage before its own result stands (or,
+# still facing an open circuit, it becomes a MISS); at the default cooldowns that is about
+# 12 minutes, so a single page that keeps failing cannot hold up the run as its own probe.
+BREAKER_MAX_REDOS = 4
+
+# Per lookup ([bool] holder, set by Fetcher.pausing and the async engine): whether that lookup's
+# last request failed, so a circuit tripped by other requests does not redo a lookup that got
+# its answer.
+_last_request_failed: ContextVar[Optional[List[bool]]] = ContextVar("last_request_failed", default=None)
+
+class CircuitOpen(Exception):
+    """Raised instead of sending a request to a host whose circuit breaker is open."""
+
+class TransientFailure(Exception):
+    """
+    Raised when a search got no usable answer (429/5xx, connection error, timeout, urllib3
+    retries used up). That says nothing about the faction, so it is never a MISS: the lookup
+    is redone behind the circuit breaker, or left unsettled for a later pass.
+    """
+
+def add_breaker_arguments(parser) -> None:
+    parser.add_argument("--breaker-failures", type=int, default=BREAKER_FAILURES,
+                        help="Consecutive failed requests (errors, timeouts, 5xx) to one host before lookups pause "
+                             f"and only a probe is sent now and then (default: {BREAKER_FAILURES}; 0 = off).")
+    parser.add_argument("--breaker-cooldown", type=float, default=BREAKER_COOLDOWN_SECS,
+                        help=f"Seconds before the first probe of a failing host (default: {BREAKER_COOLDOWN_SECS:g}); "
+                             f"doubles after each failed probe, up to {BREAKER_MAX_COOLDOWN_SECS:g}.")
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker for a run's requests.
+
+    A host's circuit opens after `threshold` consecutive failures; allow() then raises
+    CircuitOpen until `cooldown` seconds have passed, when exactly one caller gets through
+    as the half-open probe. A successful probe closes the circuit, a failed one reopens it
+    for twice as long (up to max_cooldown). Answers to requests started before the circuit
+    opened (`started`, monotonic) are ignored while it is open, so a slow straggler can neither
+    close it nor count as the probe. `trips` counts openings, so callers can tell whether a
+    circuit opened while they were working. State changes go through `note`.
+    """
+
+    def __init__(self, threshold: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN_SECS,
+                 max_cooldown: float = BREAKER_MAX_COOLDOWN_SECS, note: Callable[[str], Any] = lambda message: None):
+        if threshold < 1 or cooldown <= 0:
+            raise ValueError("--breaker-failures must be >= 1 and --breaker-cooldown > 0.")
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max(cooldown, max_cooldown)
+        self.note = note
+        self.trips = 0
+        # host -> [consecutive failures, reopen time (monotonic) or None, current cooldown, probe in flight,
+        #          time the circuit last opened]
+        self._hosts: Dict[str, List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def _state(self, host: str) -> List[Any]:
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = [0, None, self.cooldown, False, 0.0]
+        return state
+
+    @staticmethod
+    def _straggler(state: List[Any], started: Optional[float]) -> bool:
+        return state[1] is not None and started is not None and started < state[4]
+
+    def allow(self, host: str) -> None:
+        """Return if a request to host may go out now; raise CircuitOpen if not."""
+        with self._lock:
+            state = self._state(host)
+            if state[1] is None:
+                return
+            if state[3] or time.monotonic() < state[1]:
+                raise CircuitOpen(host)
+            state[3] = True
+        self.note(f"Circuit for {host} half-open: sending a probe.")
+
+    def success(self, host: str, started: Optional[float] = None) -> None:
+        with self._lock:
+            state = self._state(host)
+            if self._straggler(state, started):
+                return
+            reopened = state[1] is not None
+            self._hosts[host] = [0, None, self.cooldown, False, 0.0]
+        if reopened:
+            self.note(f"Circuit for {host} closed: probe succeeded, resuming.")
+
+    def failure(self, host: str, started: Optional[float] = None) -> None:
+        with self._lock:
+            state = self._state(host)
+            if self._straggler(state, started):
+                return
+            state[0] += 1
+            if state[3]:
+                state[2] = min(self.max_cooldown, state[2] * 2)
+            elif state[1] is not None or state[0] < self.threshold:
+                return
+            state[4] = time.monotonic()
+            state[1] = state[4] + state[2]
+            state[3] = False
+            self.trips += 1
+            failures, cooldown = state[0], state[2]
+        self.note(f"Circuit for {host} open after {failures} consecutive failures; pausing lookups for {cooldown:.0f}s.")
+
+    def failing(self) -> bool:
+        """True while any host's last request failed."""
+        with self._lock:
+            return any(state[0] for state in self._hosts.values())
+
+    def retry_in(self) -> float:
+        """Seconds until every open circuit is due a probe (0 when none is open)."""
+        with self._lock:
+            now = time.monotonic()
+            waits = [max(0.0, state[1] - now) if not state[3] else 0.5
+                     for state in self._hosts.values() if state[1] is not None]
+        return max(waits, default=0.0)
+
+# --- Response cache ---------------------------------------------------------------
+
+CACHE_FILE_NAME = "http_cache.sqlite3"
+INDEX_FILE_NAME = "faction_index.sqlite3"
+CACHEABLE_STATUSES = (200, 404)
+
+class CacheMiss(Exception):
+    """Raised in --offline mode when a page is not in the cache."""
+
+class ResponseCache:
+    """
+    URL -> (status, body) cache in a single SQLite file.
+
+    Bodies are zlib-compressed. Entries older than the caller's max_age are ignored
+    (and refreshed on the next successful fetch). Once the total stored size exceeds
+    max_bytes, least-recently-used entries are evicted down to 90% of the cap.
+    Bodies cut short by a streamed download are flagged `partial` and only handed to
+    callers whose `complete` check accepts them; a full download replaces them.
+    The response's ETag / Last-Modified are kept alongside, so an expired entry can be
+    revalidated (revalidation()) and, on 304 Not Modified, made fresh again (touch()).
+    What a script parsed out of a body can be kept next to it (keep_parsed()), keyed by the
+    parser and the body's CRC, so a page served again unchanged is not parsed again.
+    Safe to share between threads and between scripts running side by side.
+    """
+
+    def __init__(self, path: Path, max_bytes: int = 512 * 1024 * 1024):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " url TEXT PRIMARY KEY, status INTEGER NOT NULL, body BLOB NOT NULL,"
+            " size INTEGER NOT NULL, fetched_at REAL NOT NULL, used_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS ix_responses_used_at ON responses(used_at)")
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(responses)")}
+        if "partial" not in columns:
+            self._db.execute("ALTER TABLE responses ADD COLUMN partial INTEGER NOT NULL DEFAULT 0")
+        for column in ("etag", "last_modified"):
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE responses ADD COLUMN {column} TEXT")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS parsed ("
+            " url TEXT NOT NULL, kind TEXT NOT NULL, crc INTEGER NOT NULL, value TEXT NOT NULL,"
+            " PRIMARY KEY (url, kind))"
+        )
+        self._total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, url: str, max_age: Optional[float],
+            complete: Optional[Callable[[str], bool]] = None) -> Optional[Tuple[int, str]]:
+        """
+        Return (status, text) if cached and younger than max_age seconds (None = any age).
+        Partial bodies count as a hit only if complete(text) is true.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT status, body, fetched_at, partial FROM responses WHERE url = ?", (url,)
+            ).fetchone()
+            if row is None:
+                return None
+            status, body, fetched_at, partial = row
+            now = time.time()
+            if max_age is not None and now - fetched_at > max_age:
+                return None
+            text = zlib.decompress(body).decode("utf-8", errors="replace")
+            if partial and (complete is None or not complete(text)):
+                return None
+            self._db.execute("UPDATE responses SET used_at = ? WHERE url = ?", (now, url))
+        return status, text
+
+    def revalidation(self, url: str, complete: Optional[Callable[[str], bool]] = None
+                     ) -> Optional[Tuple[int, str, Dict[str, str]]]:
+        """
+        (status, text, conditional request headers) for a cached entry of any age that has
+        validators, or None. Partial bodies qualify only if complete(text) is true.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT status, body, partial, etag, last_modified FROM responses WHERE url = ?", (url,)
+            ).fetchone()
+        if row is None or not (row[3] or row[4]):
+            return None
+        status, body, partial, etag, last_modified = row
+        text = zlib.decompress(body).decode("utf-8", errors="replace")
+        if partial and (complete is None or not complete(text)):
+            return None
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return status, text, headers
+
+    def touch(self, url: str) -> None:
+        """Mark an entry as just fetched (its body was confirmed by a 304)."""
+        now = time.time()
+        with self._lock:
+            self._db.execute("UPDATE responses SET fetched_at = ?, used_at = ? WHERE url = ?", (now, now, url))
+
+    def parsed(self, url: str, kind: str, crc: int) -> Optional[str]:
+        """The JSON kept by keep_parsed() for this url, parser and body CRC, or None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM parsed WHERE url = ? AND kind = ? AND crc = ?", (url, kind, crc)
+            ).fetchone()
+        return row[0] if row else None
+
+    def keep_parsed(self, url: str, kind: str, crc: int, value: str) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO parsed (url, kind, crc, value) VALUES (?, ?, ?, ?)",
+                (url, kind, crc, value),
+            )
+
+    def put(self, url: str, status: int, text: str, partial: bool = False,
+            etag: Optional[str] = None, last_modified: Optional[str] = None) -> None:
+        body = zlib.compress(text.encode("utf-8"), 6)
+        now = time.time()
+        with self._lock:
+            old = self._db.execute("SELECT size FROM responses WHERE url = ?", (url,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses"
+                " (url, status, body, size, fetched_at, used_at, partial, etag, last_modified)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (url, status, body, len(body), now, now, int(partial), etag, last_modified),
+            )
+            self._total += len(body) - (old[0] if old else 0)
+            if self._total > self.max_bytes:
+                self._evict(int(self.max_bytes * 0.9))
+
+    def _evict(self, target: int) -> None:
+        while self._total > target:
+            rows = self._db.execute(
+                "SELECT url, size FROM responses ORDER BY used_at LIMIT 256"
+            ).fetchall()
+            if not rows:
+                self._total = 0
+                return
+            for url, size in rows:
+                self._db.execute("DELETE FROM responses WHERE url = ?", (url,))
+                self._db.execute("DELETE FROM parsed WHERE url = ?", (url,))
+                self._total -= size
+                if self._total <= target:
+                    return
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+# --- Faction resolution index -----------------------------------------------------
+
+# (details_url, candidate_text, exact) as returned by the scripts' pick_* functions
+FactionMatch = Tuple[str, str, bool]
+
+def _index_key(name: str) -> str:
+    return re.sub(r"\s+", " ", name or "").strip().lower()
+
+class FactionIndex:
+    """
+    Persistent (site, faction name) -> details URL map in a SQLite file.
+
+    The URLs are ID-based (/en/faction/id/<id>/name/... on EDSM, /elite/minorfaction/<id>/
+    on INARA), so they stay valid once found. Each entry records the candidate text that
+    was picked and whether it was an exact normalised-name match or the first-candidate
+    fallback. Exact matches are trusted indefinitely; fallbacks only for `fallback_max_age`
+    seconds, after which the faction is searched again in case an exact match appeared.
+    """
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS factions ("
+            " site TEXT NOT NULL, name_key TEXT NOT NULL, name TEXT NOT NULL,"
+            " faction_id INTEGER, url TEXT NOT NULL, candidate TEXT NOT NULL,"
+            " match TEXT NOT NULL, resolved_at REAL NOT NULL,"
+            " PRIMARY KEY (site, name_key))"
+        )
+
+    def lookup(self, site: str, name: str, fallback_max_age: Optional[float]) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT url, match, resolved_at FROM factions WHERE site = ? AND name_key = ?",
+                (site, _index_key(name)),
+            ).fetchone()
+        if row is None:
+            return None
+        url, match, resolved_at = row
+        if match != "exact" and fallback_max_age is not None and time.time() - resolved_at > fallback_max_age:
+            return None
+        return url
+
+    def record(self, site: str, name: str, match: FactionMatch) -> None:
+        url, candidate, exact = match
+        m = re.search(r"/(?:id/)?(\d+)(?:/|$)", url)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO factions"
+                " (site, name_key, name, faction_id, url, candidate, match, resolved_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (site, _index_key(name), name, int(m.group(1)) if m else None, url, candidate,
+                 "exact" if exact else "fallback", time.time()),
+            )
+
+    def forget(self, site: str, name: str) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM factions WHERE site = ? AND name_key = ?", (site, _index_key(name)))
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+def add_cache_arguments(parser) -> None:
+    parser.add_argument("--cache-dir", default=None,
+                        help=f"Folder for the shared on-disk page cache ({CACHE_FILE_NAME}). Off when omitted.")
+    parser.add_argument("--cache-ttl", type=float, default=72.0,
+                        help="Hours a cached page stays fresh (default: 72).")
+    parser.add_argument("--cache-max-mb", type=float, default=512.0,
+                        help="Cache size cap in MB; least-recently-used pages are evicted (default: 512).")
+    parser.add_argument("--offline", action="store_true",
+                        help="Cache-only: never touch the network; factions whose pages are not cached are skipped.")
+    parser.add_argument("--faction-index", default=None,
+                        help=f"SQLite file mapping faction names to details URLs (default: <cache-dir>/{INDEX_FILE_NAME}).")
+
+def open_cache(args) -> Optional[ResponseCache]:
+    """Open the cache described by add_cache_arguments() flags, or None if caching is off."""
+    if not args.cache_dir:
+        if args.offline:
+            raise ValueError("--offline needs --cache-dir.")
+        return None
+    return ResponseCache(Path(args.cache_dir) / CACHE_FILE_NAME, max_bytes=int(args.cache_max_mb * 1024 * 1024))
+
+def open_index(args) -> Optional[FactionIndex]:
+    if args.faction_index:
+        return FactionIndex(Path(args.faction_index))
+    if args.cache_dir:
+        return FactionIndex(Path(args.cache_dir) / INDEX_FILE_NAME)
+    return None
+
+# --- Fetching ---------------------------------------------------------------------
+
+STREAM_CHUNK_BYTES = 16 * 1024
+# Text already scanned that each chunk's checks see again; longer than any label + value.
+STREAM_OVERLAP_CHARS = 4096
+
+def add_stream_arguments(parser) -> None:
+    parser.add_argument("--stream-details-kb", type=float, default=0.0,
+                        help="Stream details pages and stop reading once the needed fields have arrived, "
+                             "or after this many KB (default: 0 = always download the whole page).")
+
+class AllFound:
+    """
+    A `complete` check made of independent field checks; true once every one of them holds.
+    StreamReader runs each check only until it first holds, so a found field is not looked
+    for again in every later chunk.
+    """
+
+    def __init__(self, *checks: Callable[[str], bool]):
+        self.checks = checks
+
+    def __call__(self, text: str) -> bool:
+        return all(check(text) for check in self.checks)
+
+class StreamReader:
+    """
+    Decodes a response body chunk by chunk. feed() returns True once reading can stop:
+    `complete` holds or `limit` bytes have been read. `partial` tells whether the body was
+    cut short.
+
+    Checks only see the newly decoded text plus the last STREAM_OVERLAP_CHARS before it,
+    so reading a page costs time linear in its size. A label and its value spanning more
+    than that overlap are not seen until the page is read whole.
+    """
+
+    def __init__(self, encoding: Optional[str], complete: Callable[[str], bool], limit: int):
+        try:
+            self._decoder = codecs.getincrementaldecoder(encoding or "utf-8")(errors="replace")
+        except LookupError:
+            self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._pending = list(getattr(complete, "checks", (complete,)))
+        self._limit = limit
+        self._parts: List[str] = []
+        self._tail = ""
+        self._size = 0
+        self.partial = False
+
+    def feed(self, chunk: bytes) -> bool:
+        decoded = self._decoder.decode(chunk)
+        self._parts.append(decoded)
+        self._size += len(chunk)
+        window = self._tail + decoded
+        self._tail = window[-STREAM_OVERLAP_CHARS:]
+        self._pending = [check for check in self._pending if not check(window)]
+        if not self._pending or self._size >= self._limit:
+            self.partial = True
+        return self.partial
+
+    def text(self) -> str:
+        if not self.partial:
+            self._parts.append(self._decoder.decode(b"", final=True))
+        return "".join(self._parts)
+
+class Fetcher:
+    """
+    Per-run HTTP policy for a script. Scripts keep one module-level instance, configure it
+    in main() from the command line, and route every search/details GET through get().
+    """
+
+    def __init__(self, site: str = ""):
+        self.site = site
+        self.limiter: Optional[TokenBucket] = None
+        # Set by configure_pacing() under --adaptive; it is then also the limiter.
+        self.pacer: Optional[AdaptivePacer] = None
+        self.breaker: Optional[CircuitBreaker] = None
+        self.cache: Optional[ResponseCache] = None
+        self.cache_ttl: float = 72 * 3600.0
+        self.offline = False
+        self.index: Optional[FactionIndex] = None
+        # Byte cap for streamed details downloads (--stream-details-kb); 0 = off.
+        self.stream_limit = 0
+
+    def configure_cache(self, args) -> None:
+        self.cache = open_cache(args)
+        self.index = open_index(args)
+        self.cache_ttl = args.cache_ttl * 3600.0
+        self.offline = args.offline
+        self.stream_limit = int(getattr(args, "stream_details_kb", 0) * 1024)
+
+    def configure_pacing(self, args, *sessions, note: Callable[[str], Any] = lambda message: None) -> None:
+        """
+        --adaptive: pace every GET with one AdaptivePacer starting at --rate, and take 429/5xx
+        retries (and Retry-After sleeps) away from the sessions' urllib3 Retry so that they go
+        through the pacer too.
+        """
+        if not args.adaptive:
+            return
+        self.pacer = self.limiter = AdaptivePacer(args.rate, args.min_rate, args.max_rate, note=note)
+        for session in sessions:
+            for prefix, adapter in list(session.adapters.items()):
+                retry = adapter.max_retries.new(status_forcelist=None, respect_retry_after_header=False)
+                session.mount(prefix, HTTPAdapter(max_retries=retry))
+        note(f"Adaptive pacing: starting at {self.pacer.rate:.2f} requests/second "
+             f"({self.pacer.min_rate:.2f}-{self.pacer.max_rate:.2f}).")
+
+    def configure_breaker(self, args, note: Callable[[str], Any] = lambda message: None) -> None:
+        """Set up the per-host CircuitBreaker from --breaker-failures / --breaker-cooldown."""
+        self.breaker = None
+        if args.breaker_failures > 0:
+            self.breaker = CircuitBreaker(args.breaker_failures, args.breaker_cooldown, note=note)
+
+    def pausing(self, lookup: Optional[Callable[[str], R]] = None, *,
+                miss: Optional[Callable[[str], R]] = None):
+        """
+        Wrap a per-faction lookup so that it waits while a circuit is open; use as
+        @fetcher.pausing(miss=...). A lookup is run again once a probe is due if it hit an open
+        circuit, or if its own last request failed and a circuit opened meanwhile (or it raised
+        while a host was failing), so an outage pauses the run instead of turning the remaining
+        factions into MISSes (or ending it). After BREAKER_MAX_REDOS redos the lookup's own
+        outcome stands, and one still facing an open circuit becomes miss("circuit open").
+        A TransientFailure is redone the same way, backing off; if it persists (or there is no
+        breaker) the lookup returns None, like a page --offline could not find: not journalled.
+        """
+        if lookup is None:
+            return lambda fn: self.pausing(fn, miss=miss)
+        breaker = self.breaker
+        if breaker is None:
+            def unsettled(name: str) -> Optional[R]:
+                try:
+                    return lookup(name)
+                except TransientFailure:
+                    return None
+            return unsettled
+
+        def run(name: str) -> Optional[R]:
+            redos = 0
+            while True:
+                delay = breaker.retry_in()
+                while delay > 0:
+                    time.sleep(min(delay, 5.0))
+                    delay = breaker.retry_in()
+                trips = breaker.trips
+                failed = [False]
+                token = _last_request_failed.set(failed)
+                try:
+                    result = lookup(name)
+                except CircuitOpen:
+                    if redos >= BREAKER_MAX_REDOS:
+                        if miss is None:
+                            raise
+                        return miss("circuit open")
+                    redos += 1
+                    continue
+                except TransientFailure:
+                    if redos >= BREAKER_MAX_REDOS:
+                        return None
+                    redos += 1
+                    time.sleep(self.pause(2.0 ** redos))
+                    continue
+                except Exception:
+                    # A search that gave up on a failing host: try again (or pause once the breaker trips).
+                    if not (failed[0] and breaker.failing()) or redos >= BREAKER_MAX_REDOS:
+                        raise
+                    redos += 1
+                    continue
+                finally:
+                    _last_request_failed.reset(token)
+                if not failed[0] or breaker.trips == trips or redos >= BREAKER_MAX_REDOS:
+                    return result
+                redos += 1
+
+        return run
+
+    def rate_limit(self, rate: float, burst: float) -> None:
+        """Cap requests with a TokenBucket, unless --adaptive already set up the pacer."""
+        if self.pacer is None:
+            self.limiter = TokenBucket(rate, burst)
+
+    def pause(self, seconds: float) -> float:
+        """A fixed delay (--sleep, retry backoff) to sleep, or 0 when the pacer does the pacing."""
+        return 0.0 if self.pacer is not None else seconds
+
+    def observe(self, url: str, status: Optional[int], started: float, headers=None) -> None:
+        """Report one answer (status None = no answer) to the pacer, circuit breaker and lookup."""
+        failed = status is None or status >= 500
+        holder = _last_request_failed.get()
+        if holder is not None:
+            holder[0] = failed
+        if self.breaker is not None:
+            if failed:
+                self.breaker.failure(urlsplit(url).netloc, started)
+            else:
+                self.breaker.success(urlsplit(url).netloc, started)
+        if self.pacer is not None:
+            self.pacer.observe(status, time.monotonic() - started,
+                               headers.get("Retry-After") if headers is not None else None)
+
+    # Faction index passthroughs; all no-ops when no index is configured.
+    def indexed_url(self, name: str) -> Optional[str]:
+        if self.index is None:
+            return None
+        return self.index.lookup(self.site, name, self.cache_ttl)
+
+    def remember(self, name: str, match: FactionMatch) -> None:
+        if self.index is not None:
+            self.index.record(self.site, name, match)
+
+    def forget(self, name: str) -> None:
+        if self.index is not None:
+            self.index.forget(self.site, name)
+
+    def cached(self, url: str, complete: Optional[Callable[[str], bool]] = None) -> Optional[Tuple[int, str]]:
+        """Cache lookup honouring --offline (any age is fine, and a miss raises CacheMiss)."""
+        if self.cache is None:
+            return None
+        hit = self.cache.get(url, None if self.offline else self.cache_ttl, complete)
+        if hit is None and self.offline:
+            raise CacheMiss(url)
+        return hit
+
+    def store(self, url: str, status: int, text: str, partial: bool = False, headers=None) -> None:
+        if self.cache is not None and status in CACHEABLE_STATUSES:
+            etag = last_modified = None
+            if headers is not None and status == 200:
+                etag, last_modified = headers.get("ETag"), headers.get("Last-Modified")
+            self.cache.put(url, status, text, partial, etag, last_modified)
+
+    def revalidation(self, url: str, complete: Optional[Callable[[str], bool]] = None
+                     ) -> Optional[Tuple[int, str, Dict[str, str]]]:
+        """Expired cache entry plus its If-None-Match / If-Modified-Since headers, if it has any."""
+        if self.cache is None:
+            return None
+        return self.cache.revalidation(url, complete)
+
+    def not_modified(self, url: str, stale: Tuple[int, str, Dict[str, str]]) -> Tuple[int, str]:
+        """Handle a 304 for a conditional GET: the cached page is current again."""
+        self.cache.touch(url)
+        return stale[0], stale[1]
+
+    def parse(self, url: str, text: str, interpret: Callable[..., Any], *args) -> Any:
+        """
+        interpret(text, *args) for the page at url, kept in the cache next to it: when get()
+        hands back the same body again (cached, or confirmed by a 304) the kept result is used
+        instead of parsing it again. Results must survive JSON (tuples come back as tuples).
+        """
+        if self.cache is None:
+            return interpret(text, *args)
+        kind = f"{self.site}:{interpret.__name__}"
+        crc = zlib.crc32(text.encode("utf-8"))
+        kept = self.cache.parsed(url, kind, crc)
+        if kept is not None:
+            value = json.loads(kept)
+            return tuple(value) if isinstance(value, list) else value
+        result = interpret(text, *args)
+        self.cache.keep_parsed(url, kind, crc, json.dumps(result, ensure_ascii=False))
+        return result
+
+    def search(self, session, url: str, timeout: float) -> Tuple[int, str]:
+        """
+        get() for a search page, where only an answer may read as "not found": a 429/5xx, or
+        a request that got no answer at all, raises TransientFailure instead.
+        """
+        try:
+            status, text = self.get(session, url, timeout)
+        except RequestException as e:
+            raise TransientFailure(f"search: {type(e).__name__}") from e
+        if status in RETRY_STATUSES or status >= 500:
+            raise TransientFailure(f"search: HTTP {status}")
+        return status, text
+
+    def stream_reader(self, status: int, encoding: Optional[str],
+                      complete: Optional[Callable[[str], bool]]) -> Optional[StreamReader]:
+        """A StreamReader when this response should be streamed, else None (read it whole)."""
+        if complete is None or not self.stream_limit or status != 200:
+            return None
+        return StreamReader(encoding, complete, self.stream_limit)
+
+    def get(self, session, url: str, timeout: float,
+            complete: Optional[Callable[[str], bool]] = None) -> Tuple[int, str]:
+        """
+        GET url with `session`; returns (status_code, text). With a `complete` check and
+        --stream-details-kb set, a 200 body is streamed and the connection closed early.
+        An expired cached page is re-requested conditionally; a 304 hands back the cached body.
+        With --adaptive, 429/5xx answers are retried here, each attempt paced by the pacer.
+        Raises CircuitOpen rather than contacting a host whose circuit breaker is open.
+        """
+        hit = self.cached(url, complete)
+        if hit is not None:
+            return hit
+        stale = self.revalidation(url, complete)
+        retries = PACED_STATUS_RETRIES if self.pacer is not None else 0
+        for attempt in range(retries + 1):
+            if self.breaker is not None:
+                self.breaker.allow(urlsplit(url).netloc)
+            if self.limiter is not None:
+                self.limiter.acquire()
+            started = time.monotonic()
+            try:
+                r = session.get(url, timeout=timeout, stream=True, headers=stale[2] if stale else None)
+            except Exception:
+                self.observe(url, None, started)
+                raise
+            with r:
+                self.observe(url, r.status_code, started, r.headers)
+                if r.status_code in RETRY_STATUSES and attempt < retries:
+                    continue
+                if r.status_code == 304 and stale is not None:
+                    return self.not_modified(url, stale)
+                reader = self.stream_reader(r.status_code, r.encoding, complete)
+                if reader is None:
+                    text = r.text
+                else:
+                    for chunk in r.iter_content(STREAM_CHUNK_BYTES):
+                        if reader.feed(chunk):
+                            break
+                    text = reader.text()
+            break
+        partial = reader is not None and reader.partial
+        if not partial or complete(text):
+            self.store(url, r.status_code, text, partial, r.headers)
+        return r.status_code, text
+
+# --- Output scanning --------------------------------------------------------------
+
+WHERE_PREFIX = "WHERE f.FactionName = '"
+MISS_PREFIXES = ("-- MISS: ", "-- RETRY MISS: ")
+NONPLAYER_PREFIX = "-- NONPLAYER: "
+_SET_SYSTEM_RE = re.compile(r"f\.NativeSystemID\s*=\s*(\d+)")
+_SET_PLAYER_RE = re.compile(r"f\.IsPlayer\s*=\s*([01])")
+_VALUES_ROW_RE = re.compile(r"^\(N'((?:[^']|'')*)', (\d+|NULL), ([01]|NULL)\)[,;]$")
+
+class OutputScan:
+    """
+    What a generated .sql file already covers, collected by scan_output().
+
+    UPDATE targets are exact (taken from the WHERE clause, or the row of a merge-format
+    VALUES block), and `values` keeps the
+    (NativeSystemID, IsPlayer) each one sets. MISS/NONPLAYER comments read
+    "<name> (<reason>)", and both names and reasons may contain " (", so those payloads
+    are kept raw and matched against the input names later (longest matching prefix wins).
+    """
+
+    def __init__(self):
+        self.updated: Set[str] = set()
+        self.values: Dict[str, Tuple[Optional[int], Optional[bool]]] = {}
+        self.miss_payloads: List[str] = []
+        self.nonplayer_payloads: List[str] = []
+        self.has_commit = False
+
+    def missed(self, names: Iterable[str]) -> Set[str]:
+        return _match_payloads(self.miss_payloads, set(names))
+
+    def nonplayer(self, names: Iterable[str]) -> Set[str]:
+        return _match_payloads(self.nonplayer_payloads, set(names))
+
+def _match_payloads(payloads: List[str], name_set: Set[str]) -> Set[str]:
+    found: Set[str] = set()
+    for raw in payloads:
+        if raw in name_set:
+            found.add(raw)
+            continue
+        idx = raw.rfind(" (")
+        while idx > 0:
+            if raw[:idx] in name_set:
+                found.add(raw[:idx])
+                break
+            idx = raw.rfind(" (", 0, idx)
+    return found
+
+def scan_output(out_path: Path) -> OutputScan:
+    """Read out_path once, line by line; cost grows linearly with the file size."""
+    scan = OutputScan()
+    if not out_path.exists():
+        return scan
+    set_line = ""
+    with open(out_path, "r", encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("SET "):
+                set_line = line
+            elif line.startswith(WHERE_PREFIX) and line.endswith("';"):
+                name = line[len(WHERE_PREFIX):-2].replace("''", "'")
+                scan.updated.add(name)
+                sm = _SET_SYSTEM_RE.search(set_line)
+                pm = _SET_PLAYER_RE.search(set_line)
+                scan.values[name] = (int(sm.group(1)) if sm else None, pm.group(1) == "1" if pm else None)
+                set_line = ""
+            elif line.startswith("(N'"):
+                vm = _VALUES_ROW_RE.match(line)
+                if vm:
+                    name = vm.group(1).replace("''", "'")
+                    scan.updated.add(name)
+                    scan.values[name] = (None if vm.group(2) == "NULL" else int(vm.group(2)),
+                                         None if vm.group(3) == "NULL" else vm.group(3) == "1")
+            elif line.startswith("-- "):
+                for prefix in MISS_PREFIXES:
+                    if line.startswith(prefix):
+                        scan.miss_payloads.append(line[len(prefix):].strip())
+                        break
+                else:
+                    if line.startswith(NONPLAYER_PREFIX):
+                        scan.nonplayer_payloads.append(line[len(NONPLAYER_PREFIX):].strip())
+            elif line == "COMMIT;":
+                scan.has_commit = True
+    return scan
+
+def ends_with_commit(out_path: Path) -> bool:
+    """True if the last line of out_path (blank lines aside) is COMMIT; reads only the file's tail."""
+    try:
+        with open(out_path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 256))
+            tail = f.read()
+    except OSError:
+        return False
+    lines = tail.rstrip().splitlines()
+    return bool(lines) and lines[-1].strip() == b"COMMIT;"
+
+# --- Durable appends ---------------------------------------------------------------
+
+class GroupCommit:
+    """
+    Buffers appended lines for the output files of a run and makes them durable together.
+
+    Lines are held in memory until a commit, which writes, flushes and fsyncs each file
+    in the order it was first added to (the SQL before its journal), so the journal never
+    claims a faction whose SQL did not make it to disk. A commit happens after every
+    `every` finished records or once `interval` seconds have passed since the last one,
+    whichever comes first; with the defaults (every=1) each faction is committed on its own.
+    After a crash at most `every` records are lost, and resume simply redoes them.
+
+    With ValuesBlocks attached (--output-format merge) `every` is ignored: a commit happens
+    when a block fills (or `interval` passes), and each commit first turns the blocks'
+    rows into INSERT statements, so the journal again never gets ahead of the SQL.
+
+    begin(path, lines) sets lines (a new BEGIN TRAN, say) to go ahead of the first lines
+    that reach path, if any do; `begun` then holds path.
+    """
+
+    def __init__(self, every: int = 1, interval: float = 0.0):
+        self.every = max(0, every)
+        self.interval = max(0.0, interval)
+        self._pending: Dict[Path, List[str]] = {}
+        self._handles: Dict[Path, IO[str]] = {}
+        self._records = 0
+        self._last_commit = time.monotonic()
+        self._blocks: List[ValuesBlock] = []
+        self._openers: Dict[Path, List[str]] = {}
+        self.begun: Set[Path] = set()
+
+    def begin(self, path: Path, lines: Iterable[str]) -> None:
+        self._openers[path] = list(lines)
+
+    def attach(self, block: "ValuesBlock") -> None:
+        """Write `block` through this writer (attach before the first record)."""
+        self._pending.setdefault(block.path, [])
+        self._blocks.append(block)
+
+    def add(self, path: Path, lines: Iterable[str]) -> None:
+        self._pending.setdefault(path, []).extend(lines)
+
+    def end_record(self) -> None:
+        self._records += 1
+        if self._blocks:
+            due_count = any(block.full() for block in self._blocks)
+        elif self.every:
+            due_count = self._records >= self.every
+        else:
+            due_count = not self.interval
+        due_time = self.interval and time.monotonic() - self._last_commit >= self.interval
+        if due_count or due_time:
+            self.commit()
+
+    def commit(self) -> None:
+        for block in self._blocks:
+            self.add(block.path, block.take())
+        for path, lines in self._pending.items():
+            if not lines:
+                continue
+            opener = self._openers.pop(path, None)
+            if opener is not None:
+                lines[:0] = opener
+                self.begun.add(path)
+            f = self._handles.get(path)
+            if f is None:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                f = self._handles[path] = open(path, "a", encoding="utf-8", newline="\n")
+            f.write("".join(line + "\n" for line in lines))
+            f.flush()
+            os.fsync(f.fileno())
+            lines.clear()
+        self._records = 0
+        self._last_commit = time.monotonic()
+
+    def close(self) -> None:
+        try:
+            self.commit()
+        finally:
+            for f in self._handles.values():
+                f.close()
+            self._handles.clear()
+
+def add_commit_arguments(parser) -> None:
+    parser.add_argument("--fsync-every", type=int, default=1,
+                        help="Flush + fsync the output after every N factions (default: 1). "
+                             "Up to N factions are redone after a crash.")
+    parser.add_argument("--fsync-interval", type=float, default=0.0,
+                        help="Also flush + fsync at least this often, in seconds (default: 0 = off).")
+
+# --- Merge output format ----------------------------------------------------------
+
+MERGE_STAGING_TABLE = "#FactionStaging"
+MERGE_ROWS_PER_BLOCK = 1000  # SQL Server's cap on rows in one VALUES list
+OUTPUT_FORMATS = ("updates", "merge")
+
+def add_output_format_arguments(parser) -> None:
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default="updates",
+                        help="updates = one UPDATE per faction (default); merge = rows batched into "
+                             f"INSERT INTO {MERGE_STAGING_TABLE} VALUES blocks of {MERGE_ROWS_PER_BLOCK} "
+                             "and one set-based UPDATE at the end. Resume picks up at block boundaries.")
+
+def staging_table_sql(table: str) -> str:
+    return (f"CREATE TABLE {table} ("
+            " FactionName NVARCHAR(450) COLLATE DATABASE_DEFAULT NOT NULL,"
+            " NativeSystemID INT NULL, IsPlayer BIT NULL);")
+
+def staging_update_sql(table: str) -> str:
+    """One set-based UPDATE of ref.Faction from a staging table; NULL keeps the current value."""
+    return (
+        "UPDATE f\n"
+        "SET f.NativeSystemID = COALESCE(s.NativeSystemID, f.NativeSystemID),\n"
+        "    f.IsPlayer = COALESCE(s.IsPlayer, f.IsPlayer)\n"
+        "FROM ref.Faction AS f\n"
+        f"JOIN {table} AS s ON s.FactionName = f.FactionName;"
+    )
+
+def merge_preamble() -> List[str]:
+    """Lines a merge-format file starts with, right after BEGIN TRAN."""
+    return [
+        f"IF OBJECT_ID('tempdb..{MERGE_STAGING_TABLE}') IS NOT NULL DROP TABLE {MERGE_STAGING_TABLE};",
+        staging_table_sql(MERGE_STAGING_TABLE),
+        "",
+    ]
+
+def merge_trailer() -> List[str]:
+    """Applies (and clears) everything staged so far; appended at the end of a run."""
+    return [
+        "-- Apply staged rows to ref.Faction",
+        staging_update_sql(MERGE_STAGING_TABLE),
+        f"TRUNCATE TABLE {MERGE_STAGING_TABLE};",
+        "",
+    ]
+
+def transaction_start(preamble: Iterable[str] = ()) -> List[str]:
+    """
+    Lines that open a new transaction in an output whose last one was committed (a --watch
+    or --stale-hours pass); `preamble` is the format's own, as after the header's BEGIN TRAN.
+    """
+    return [f"-- Pass: {datetime.now().isoformat(timespec='seconds')}", "BEGIN TRAN;", "", *preamble]
+
+def output_format_of(out_path: Path) -> Optional[str]:
+    """'merge' or 'updates' for an existing output (from its header), None if empty/missing."""
+    if not out_path.exists() or out_path.stat().st_size == 0:
+        return None
+    with open(out_path, "r", encoding="utf-8", errors="ignore") as f:
+        for _, line in zip(range(20), f):
+            if line.startswith(f"CREATE TABLE {MERGE_STAGING_TABLE} "):
+                return "merge"
+    return "updates"
+
+class ValuesBlock:
+    """
+    Staging rows for one merge-format output file. A GroupCommit writer takes() them as
+    INSERT INTO #FactionStaging VALUES statements of up to `rows_per_block` rows.
+    """
+
+    def __init__(self, path: Path, rows_per_block: int = MERGE_ROWS_PER_BLOCK):
+        self.path = path
+        self.rows_per_block = max(1, rows_per_block)
+        self.rows: List[str] = []
+        self.written = 0
+
+    def add(self, name: str, system_id: Optional[int], is_player: Optional[bool]) -> None:
+        sid = "NULL" if system_id is None else str(int(system_id))
+        player = "NULL" if is_player is None else ("1" if is_player else "0")
+        self.rows.append(f"(N'{name.replace(chr(39), chr(39) * 2)}', {sid}, {player})")
+
+    def full(self) -> bool:
+        return len(self.rows) >= self.rows_per_block
+
+    def take(self) -> List[str]:
+        lines: List[str] = []
+        while self.rows:
+            chunk, self.rows = self.rows[:self.rows_per_block], self.rows[self.rows_per_block:]
+            lines.append(f"INSERT INTO {MERGE_STAGING_TABLE} (FactionName, NativeSystemID, IsPlayer) VALUES")
+            lines.extend(row + "," for row in chunk[:-1])
+            lines.extend([chunk[-1] + ";", ""])
+            self.written += len(chunk)
+        return lines
+
+# --- Progress journal -------------------------------------------------------------
+
+JOURNAL_SUFFIX = ".progress.jsonl"
+STATUS_UPDATE = "update"
+STATUS_NONPLAYER = "nonplayer"
+STATUS_MISS = "miss"
+
+class ProgressJournal:
+    """
+    Append-only JSONL record of every faction outcome written to the SQL output.
+
+    Each line holds: name, status (update/nonplayer/miss), reason, system, system_id,
+    is_player, retry, ts (ISO timestamp) and latency_ms. The last line for a name is its
+    current state. A torn final line (crash mid-write) is ignored on load. refresh() reads
+    just the lines added since the last load, and compact() drops superseded lines once
+    they are most of the file (re-checks add one line per name each time).
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.latest: Dict[str, dict] = {}
+        # When set, entries ride along with the SQL in the run's GroupCommit batches.
+        self.committer: Optional[GroupCommit] = None
+        self.lines = 0
+        # Where refresh() picks up: the file it read (inode) and how far (bytes).
+        self._inode: Optional[int] = None
+        self._offset = 0
+
+    @staticmethod
+    def path_for(out_path: Path) -> Path:
+        return out_path.with_name(out_path.name + JOURNAL_SUFFIX)
+
+    @classmethod
+    def for_output(cls, out_path: Path, names: Iterable[str]) -> "ProgressJournal":
+        """
+        Open the journal next to out_path (call before writing the SQL header). If the SQL
+        predates the journal, seed it once from a scan of the SQL so the journal is
+        authoritative from then on.
+        """
+        journal = cls(cls.path_for(out_path))
+        fresh_output = not out_path.exists() or out_path.stat().st_size == 0
+        if journal.path.exists() and fresh_output:
+            # The SQL was deleted to start over; a journal describing it is stale.
+            journal.path.unlink()
+        if journal.path.exists():
+            journal.load()
+        elif not fresh_output:
+            journal.seed_from_output(out_path, names)
+        return journal
+
+    def load(self) -> None:
+        self.latest.clear()
+        self.lines = 0
+        self._inode = None
+        self.refresh()
+
+    def refresh(self) -> None:
+        """Read the lines appended since the last load()/refresh(); all of them if the file was replaced."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self.latest.clear()
+            self.lines = self._offset = 0
+            self._inode = None
+            return
+        if st.st_ino != self._inode or st.st_size < self._offset:
+            self.latest.clear()
+            self.lines = self._offset = 0
+            self._inode = st.st_ino
+        if st.st_size == self._offset:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1  # a torn last line is read once it is whole
+        for line in data[:end].splitlines():
+            try:
+                entry = json.loads(line.decode("utf-8", errors="ignore"))
+            except ValueError:
+                continue
+            name = entry.get("name") if isinstance(entry, dict) else None
+            if name:
+                self.latest[name] = entry
+                self.lines += 1
+        self._offset += end
+
+    def compact(self) -> bool:
+        """
+        Rewrite the file with only each name's latest entry once more than half its lines are
+        superseded (atomically; call when no GroupCommit holds unwritten entries). Returns
+        whether it did.
+        """
+        if self.lines <= 2 * len(self.latest) or not self.path.exists():
+            return False
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w", encoding="utf-8", newline="\n") as f:
+            for entry in self.latest.values():
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.lines = len(self.latest)
+        self._inode = None
+        return True
+
+    def seed_from_output(self, out_path: Path, names: Iterable[str]) -> None:
+        names = list(names)
+        scan = scan_output(out_path)
+        entries = []
+        nonplayer = scan.nonplayer(names)
+        missed = scan.missed(names)
+        for name in names:
+            system_id = is_player = None
+            if name in scan.updated:
+                status = STATUS_UPDATE
+                system_id, is_player = scan.values.get(name, (None, None))
+            elif name in nonplayer:
+                status = STATUS_NONPLAYER
+            elif name in missed:
+                status = STATUS_MISS
+            else:
+                continue
+            entries.append(self._entry(name, status, reason=f"imported from {out_path.name}",
+                                       system_id=system_id, is_player=is_player))
+        self._write(entries)
+
+    def record(self, name: str, status: str, *, reason: Optional[str] = None, system: Optional[str] = None,
+               system_id: Optional[int] = None, is_player: Optional[bool] = None,
+               latency: Optional[float] = None, retry: bool = False) -> None:
+        self._write([self._entry(name, status, reason=reason, system=system, system_id=system_id,
+                                 is_player=is_player, latency=latency, retry=retry)])
+
+    def _entry(self, name: str, status: str, *, reason=None, system=None, system_id=None,
+               is_player=None, latency=None, retry=False) -> dict:
+        entry = {
+            "name": name,
+            "status": status,
+            "reason": reason,
+            "system": system,
+            "system_id": system_id,
+            "is_player": is_player,
+            "retry": retry,
+            "ts": datetime.now().isoformat(timespec="seconds"),
+            "latency_ms": None if latency is None else int(latency * 1000),
+        }
+        self.latest[name] = entry
+        return entry
+
+    def _write(self, entries: List[dict]) -> None:
+        if not entries:
+            return
+        self.lines += len(entries)
+        lines = [json.dumps(entry, ensure_ascii=False) for entry in entries]
+        if self.committer is not None:
+            self.committer.add(self.path, lines)
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8", newline="\n") as f:
+            for line in lines:
+                f.write(line + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def status(self, name: str) -> Optional[str]:
+        entry = self.latest.get(name)
+        return entry.get("status") if entry else None
+
+    def unchanged(self, name: str, status: str, system_id: Optional[int] = None,
+                  is_player: Optional[bool] = None) -> bool:
+        """True if name's latest entry already has this outcome, so the SQL has it too."""
+        entry = self.latest.get(name)
+        return (entry is not None and entry.get("status") == status
+                and entry.get("system_id") == system_id and entry.get("is_player") == is_player)
+
+    def checked_at(self, name: str) -> Optional[float]:
+        """When `name` was last looked up (epoch seconds), or None if it never was."""
+        entry = self.latest.get(name)
+        try:
+            return datetime.fromisoformat(entry["ts"]).timestamp() if entry else None
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def processed(self, names: Iterable[str], include_misses: bool = True,
+                  max_age: Optional[float] = None) -> Set[str]:
+        """Names with an outcome; with max_age, only outcomes at most that many seconds old."""
+        cutoff = None if max_age is None else time.time() - max_age
+        done = set()
+        for name in names:
+            st = self.status(name)
+            if st is None or (not include_misses and st == STATUS_MISS):
+                continue
+            if cutoff is not None and (self.checked_at(name) or 0.0) < cutoff:
+                continue
+            done.add(name)
+        return done
+
+    def misses(self, names: Iterable[str]) -> Set[str]:
+        return {name for name in names if self.status(name) == STATUS_MISS}
+
+    def updates(self, names: Iterable[str]) -> List[dict]:
+        """Latest entries with status 'update' for `names`, in input order."""
+        return [self.latest[name] for name in names if self.status(name) == STATUS_UPDATE]
+
+# --- Watch mode -------------------------------------------------------------------
+
+WATCH_DEFAULT_STALE_HOURS = 168.0
+
+def add_watch_arguments(parser) -> None:
+    parser.add_argument("--stale-hours", type=float, default=None,
+                        help="Treat results older than this many hours as not done yet, so they are looked up "
+                             f"again (default: never; {WATCH_DEFAULT_STALE_HOURS:g} with --watch).")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running after the pass: re-check factions as their results go stale (oldest "
+                             "first, spread evenly over --stale-hours) and pick up names added to the input file. "
+                             "Stop with Ctrl+C.")
+    parser.add_argument("--watch-poll", type=float, default=60.0,
+                        help="With --watch: seconds between looks at the input file and journal (default: 60).")
+
+def stale_seconds(args) -> Optional[float]:
+    hours = args.stale_hours
+    if hours is None and args.watch:
+        hours = WATCH_DEFAULT_STALE_HOURS
+    return None if hours is None else hours * 3600.0
+
+def split_rechecks(args, pending: List[str], journals: List[ProgressJournal],
+                   total: int) -> Tuple[List[str], List[str], float]:
+    """
+    --watch: split a pass's pending names into first-time lookups (run by the chosen engine at
+    full speed) and re-checks of stale results, oldest first. Re-checks are paced so the
+    whole list cycles once per staleness window (never faster than --sleep), and a pass only
+    takes as many as fit in one --watch-poll, so new input names never wait long.
+    Returns (first_time, rechecks, pause_between_rechecks).
+    """
+    if not args.watch:
+        return pending, [], args.sleep
+
+    def last_checked(name: str) -> Optional[float]:
+        times = [journal.checked_at(name) for journal in journals]
+        return None if None in times else min(times)
+
+    first = [name for name in pending if last_checked(name) is None]
+    stale = sorted((name for name in pending if last_checked(name) is not None), key=last_checked)
+    pause = max(args.sleep, (stale_seconds(args) or 0.0) / max(1, total))
+    per_pass = max(1, int(args.watch_poll // pause)) if pause > 0 else len(stale)
+    return first, stale[:per_pass], pause
+
+def watch_journals(out_paths: Iterable[Path]) -> List[ProgressJournal]:
+    """The outputs' journals for watch_due_in(), kept between polls so each only reads what was added."""
+    return [ProgressJournal(ProgressJournal.path_for(out_path)) for out_path in out_paths]
+
+def watch_due_in(journals: Iterable[ProgressJournal], names: List[str], max_age: float,
+                 deferred: Optional[Dict[str, float]] = None) -> float:
+    """
+    Seconds until the next of `names` is due in any of the journals (0 = due now); each is
+    refreshed first. deferred maps names the last pass could not settle (not cached with
+    --offline, no answer from the site) to the time.time() they are due again, since no
+    journal entry will ever say so.
+    """
+    now = time.time()
+    soonest = None
+    if deferred:
+        for name in names:
+            if name in deferred:
+                due = deferred[name] - now
+                soonest = due if soonest is None else min(soonest, due)
+        names = [name for name in names if name not in deferred]
+    for journal in journals:
+        journal.refresh()
+        for name in names:
+            checked = journal.checked_at(name)
+            if checked is None:
+                return 0.0
+            due = checked + max_age - now
+            soonest = due if soonest is None else min(soonest, due)
+    return 0.0 if soonest is None else max(0.0, soonest)
+
+def run_watch(run_pass: Callable[[], int], due_in: Callable[[], float], poll: float,
+              note: Callable[[str], Any]) -> int:
+    """
+    --watch driver: call run_pass() whenever due_in() reports a faction due (stale or newly
+    added), otherwise sleep up to `poll` seconds and look again. Runs until Ctrl+C or
+    SIGTERM; a pass that fails on its arguments (exit code 2) ends the watch, any other
+    failure is reported and retried after `poll` seconds.
+    """
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    try:
+        signal.signal(signal.SIGTERM, stop)
+    except ValueError:
+        pass  # not on the main thread; Ctrl+C still works
+    try:
+        while True:
+            wait = due_in()
+            if wait > 0:
+                time.sleep(min(wait, poll))
+                continue
+            rc = run_pass()
+            if rc == 2:
+                return rc
+            if rc != 0:
+                note(f"Pass ended with exit code {rc}; trying again in {poll:g}s.")
+                time.sleep(poll)
+            else:
+                time.sleep(min(poll, 1.0))  # don't spin on names a pass could not settle (--offline)
+    except KeyboardInterrupt:
+        note("Watch stopped.")
+        return 0
+
+# --- Bulk apply -------------------------------------------------------------------
+
+APPLY_STAGING_TABLE = "#FactionApply"
+
+# (faction_name, native_system_id, is_player); None leaves that ref.Faction column as it is.
+FactionUpdate = Tuple[str, Optional[int], Optional[bool]]
+
+def add_apply_arguments(parser) -> None:
+    parser.add_argument("--apply", action="store_true",
+                        help="After the run, write every journalled UPDATE straight into ref.Faction "
+                             "(staging table + one set-based UPDATE per batch). Needs --conn.")
+    parser.add_argument("--apply-batch", type=int, default=5000,
+                        help="Rows per staging load / UPDATE / COMMIT with --apply (default: 5000).")
+
+def apply_faction_updates(cnx, updates: Iterable[FactionUpdate], batch_size: int = 5000,
+                          on_batch: Optional[Callable[[int, int], Any]] = None) -> int:
+    """
+    Bulk-apply results to ref.Faction over a pyodbc connection. Each batch is loaded into a
+    temp staging table with fast_executemany, joined into ref.Faction with one UPDATE (NULLs
+    keep the current value) and committed; on_batch(rows_loaded, rows_updated) reports each.
+    Re-running with the same results is harmless. Returns the total rows updated.
+    """
+    rows: Dict[str, List[Any]] = {}
+    for name, system_id, is_player in updates:
+        row = rows.setdefault(name, [name, None, None])
+        if system_id is not None:
+            row[1] = int(system_id)
+        if is_player is not None:
+            row[2] = int(bool(is_player))
+    params = [tuple(r) for r in rows.values() if r[1] is not None or r[2] is not None]
+    if not params:
+        return 0
+
+    cur = cnx.cursor()
+    cur.fast_executemany = True
+    updated = 0
+    try:
+        cur.execute(staging_table_sql(APPLY_STAGING_TABLE))
+        step = max(1, batch_size)
+        for start in range(0, len(params), step):
+            batch = params[start:start + step]
+            cur.executemany(
+                f"INSERT INTO {APPLY_STAGING_TABLE} (FactionName, NativeSystemID, IsPlayer) VALUES (?, ?, ?);",
+                batch,
+            )
+            cur.execute(staging_update_sql(APPLY_STAGING_TABLE))
+            batch_updated = max(cur.rowcount, 0)
+            updated += batch_updated
+            cur.execute(f"TRUNCATE TABLE {APPLY_STAGING_TABLE};")
+            cnx.commit()
+            if on_batch is not None:
+                on_batch(len(batch), batch_updated)
+    except Exception:
+        cnx.rollback()
+        raise
+    finally:
+        try:
+            cur.execute(f"DROP TABLE IF EXISTS {APPLY_STAGING_TABLE};")
+            cnx.commit()
+        except Exception:
+            pass
+        cur.close()
+    return updated
+
+def add_live_apply_arguments(parser) -> None:
+    parser.add_argument("--apply-live", action="store_true",
+                        help="Write each result into ref.Faction while the run goes, from background writer "
+                             "threads (batches of --apply-batch, or every --apply-interval seconds). Needs --conn.")
+    parser.add_argument("--apply-interval", type=float, default=5.0,
+                        help="With --apply-live: longest a result waits before its batch is written (default: 5).")
+    parser.add_argument("--apply-writers", type=int, default=1,
+                        help="With --apply-live: writer threads, each with its own DB connection (default: 1).")
+
+_STOP = object()
+
+class DbWriter:
+    """
+    Applies results to ref.Faction on background threads while the scraping loop runs.
+
+    put() hands an update to a writer's bounded queue, blocking only when the database falls
+    behind by more than two batches. Updates are routed by a hash of the faction name, so
+    every result for one faction (a recheck after its first lookup, say) goes through the
+    same writer and commits in the order it was put. Each writer thread keeps its own
+    connection from connect() and drains its queue through apply_faction_updates(): up to
+    batch_size rows per transaction, or whatever arrived within `interval` seconds of a
+    batch's first row.
+    A batch that fails is retried once on a fresh connection; after that the writer stops
+    applying (later puts are dropped, so the run itself carries on) and close() raises.
+    """
+
+    def __init__(self, connect: Callable[[], Any], batch_size: int = 5000, interval: float = 5.0,
+                 writers: int = 1, on_batch: Optional[Callable[[int, int], Any]] = None):
+        self.connect = connect
+        self.batch_size = max(1, batch_size)
+        self.interval = max(0.0, interval)
+        self.on_batch = on_batch
+        self.queues: List["queue.Queue[Any]"] = [queue.Queue(maxsize=2 * self.batch_size)
+                                                 for _ in range(max(1, writers))]
+        self.error: Optional[BaseException] = None
+        self.staged = 0
+        self.updated = 0
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._run, args=(q,), name=f"DbWriter-{i + 1}", daemon=True)
+                         for i, q in enumerate(self.queues)]
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, update: FactionUpdate) -> None:
+        if self.error is None:
+            self.queues[zlib.crc32(update[0].encode("utf-8")) % len(self.queues)].put(update)
+
+    def close(self) -> None:
+        """Flush what is queued, stop the writers and re-raise the first failure, if any."""
+        for q in self.queues:
+            q.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _take(self, q: "queue.Queue[Any]") -> Tuple[List[FactionUpdate], bool]:
+        """Next batch from q, and whether the stop marker came with it."""
+        item = q.get()
+        if item is _STOP:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size:
+            try:
+                item = q.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self, q: "queue.Queue[Any]") -> None:
+        cnx = None
+        stopping = False
+        while not stopping:
+            batch, stopping = self._take(q)
+            if not batch or self.error is not None:
+                continue  # after a failure, keep draining so put() never blocks for good
+            cnx, updated = self._apply(cnx, batch)
+            if updated is None:
+                continue
+            with self._lock:
+                self.staged += len(batch)
+                self.updated += updated
+            if self.on_batch is not None:
+                self.on_batch(len(batch), updated)
+        _close_quietly(cnx)
+
+    def _apply(self, cnx, batch: List[FactionUpdate]) -> Tuple[Any, Optional[int]]:
+        """Apply one batch, reconnecting once on failure. Returns (connection, rows updated or None)."""
+        for attempt in (1, 2):
+            try:
+                if cnx is None:
+                    cnx = self.connect()
+                return cnx, apply_faction_updates(cnx, batch, self.batch_size)
+            except Exception as e:
+                _close_quietly(cnx)
+                cnx = None
+                if attempt == 2:
+                    with self._lock:
+                        if self.error is None:
+                            self.error = e
+        return None, None
+
+def _close_quietly(cnx) -> None:
+    if cnx is not None:
+        try:
+            cnx.close()
+        except Exception:
+            pass
+
+# --- System lookups ---------------------------------------------------------------
+
+SYSTEM_MAP_MODES = ("auto", "full", "lazy", "snapshot")
+# --system-map auto: runs with at most this many factions to look up query systems on demand.
+LAZY_SYSTEM_MAP_MAX_FACTIONS = 5000
+SYSTEM_FETCH_ROWS = 50000
+LAZY_SYSTEM_CACHE_ENTRIES = 100000
+# Lazy mode answers this many unmatched names from a per-name SQL candidate query (one table
+# scan each) before it loads the whole table into a SystemNameIndex instead.
+LAZY_INDEX_MISSES = 25
+LAZY_CANDIDATE_ROWS = 200
+# Name trigrams a candidate query ranks by (SQL Server allows 2100 parameters).
+LAZY_CANDIDATE_GRAMS = 32
+SYSTEM_SNAPSHOT_FILE_NAME = "system_snapshot.sqlite3"
+# Reload the snapshot whole once its last full load is this old (renames and deletions only show up then).
+SYSTEM_SNAPSHOT_DEFAULT_HOURS = 24.0
+
+def add_system_map_arguments(parser) -> None:
+    parser.add_argument("--system-map", choices=SYSTEM_MAP_MODES, default="auto",
+                        help="full = load every system up front; lazy = look up only the systems the "
+                             "scraper returns (keeps the DB connection open for the run); snapshot = "
+                             "resolve from the local --system-snapshot, topped up from --conn when given; "
+                             f"auto = lazy for runs of up to {LAZY_SYSTEM_MAP_MAX_FACTIONS} factions, else "
+                             "snapshot when --cache-dir is set, else full; snapshot whenever --system-snapshot "
+                             "is given or there is no --conn (default).")
+    parser.add_argument("--system-snapshot", default=None,
+                        help="SQLite copy of the system table for offline / fast-start resolution "
+                             f"(default: <cache-dir>/{SYSTEM_SNAPSHOT_FILE_NAME}).")
+    parser.add_argument("--rebuild-system-snapshot", action="store_true",
+                        help="Reload the snapshot from scratch instead of only fetching systems with a "
+                             "higher ID (picks up renamed or deleted systems). Needs --conn.")
+    parser.add_argument("--system-snapshot-hours", type=float, default=SYSTEM_SNAPSHOT_DEFAULT_HOURS,
+                        help="Rebuild the snapshot when its last full load is older than this, if --conn "
+                             f"is given (default: {SYSTEM_SNAPSHOT_DEFAULT_HOURS:g}; 0 = never).")
+
+def system_snapshot_path(args) -> Optional[Path]:
+    if args.system_snapshot:
+        return Path(args.system_snapshot)
+    if args.cache_dir:
+        return Path(args.cache_dir) / SYSTEM_SNAPSHOT_FILE_NAME
+    return None
+
+def system_map_mode(requested: str, pending: int, snapshot: Optional[Path] = None,
+                    explicit: bool = False, connected: bool = True) -> str:
+    """
+    Resolve --system-map auto for a run that will look up `pending` factions. A snapshot
+    (`snapshot` is its path, None if there is none) is used when it was asked for
+    (`explicit`: --system-snapshot) or there is no DB connection; otherwise small runs go
+    lazy, and large ones use the snapshot over loading the whole table.
+    """
+    if requested != "auto":
+        return requested
+    if snapshot is not None and (explicit or not connected):
+        return "snapshot"
+    if pending <= LAZY_SYSTEM_MAP_MAX_FACTIONS:
+        return "lazy"
+    return "full" if snapshot is None else "snapshot"
+
+def iter_rows(cur, size: int = SYSTEM_FETCH_ROWS) -> Iterable[Any]:
+    """Stream a cursor's result set with fetchmany instead of materialising it with fetchall."""
+    while True:
+        rows = cur.fetchmany(size)
+        if not rows:
+            return
+        yield from rows
+
+class LazySystemMap:
+    """
+    Dict-like stand-in for a script's system map that asks the database per name.
+
+    get(key) runs one parameterised 'WHERE name_col = ?' lookup for a key it has not seen
+    and remembers the answer, found or not, in an LRU of max_entries. Keys are the scripts'
+    normalised (lower-cased) names, so this relies on the column's case-insensitive collation,
+    as SQL Server's default is. Lookups are serialised, so one connection serves all callers.
+    candidates(name) finds the rows nearest a name that has no exact match, without
+    reading the table into Python.
+    """
+
+    def __init__(self, cnx, table: str, id_col: str, name_col: str,
+                 max_entries: int = LAZY_SYSTEM_CACHE_ENTRIES):
+        self.cnx = cnx
+        self.table, self.id_col, self.name_col = table, id_col, name_col
+        self.sql = f"SELECT TOP 1 {id_col} FROM {table} WHERE {name_col} = ?;"
+        self.max_entries = max(1, max_entries)
+        self.entries: "OrderedDict[str, Optional[int]]" = OrderedDict()
+        self.queries = 0
+        self._lock = threading.Lock()
+
+    def check(self) -> None:
+        """Fail now, not at the first faction, if the table or columns are wrong."""
+        cur = self.cnx.cursor()
+        try:
+            cur.execute(self.sql.replace("TOP 1", "TOP 0", 1), "")
+            cur.fetchall()
+        finally:
+            cur.close()
+
+    def get(self, key: str, default: Optional[int] = None) -> Optional[int]:
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                found = self.entries[key]
+            else:
+                found = self._query(key)
+                self.entries[key] = found
+                if len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return default if found is None else found
+
+    def candidates(self, name: str, limit: int = LAZY_CANDIDATE_ROWS) -> List[Tuple[str, int]]:
+        """
+        Up to limit (name, system_id) rows sharing the most trigrams of system_name_key(name),
+        counted by the database with one LIKE per trigram; SystemResolver builds a small
+        SystemNameIndex over them.
+        """
+        key = system_name_key(name)
+        if not key:
+            return []
+        grams = sorted({key[i:i + 3] for i in range(max(1, len(key) - 2))})[:LAZY_CANDIDATE_GRAMS]
+        patterns = ["%" + re.sub(r"([\\%_\[])", r"\\\1", gram) + "%" for gram in grams]
+        hits = " + ".join(f"CASE WHEN {self.name_col} LIKE ? ESCAPE '\\' THEN 1 ELSE 0 END" for _ in patterns)
+        sql = (f"SELECT TOP {int(limit)} sid, sname FROM (SELECT {self.id_col} AS sid, {self.name_col} AS sname, "
+               f"{hits} AS hits FROM {self.table}) AS c WHERE hits > 0 ORDER BY hits DESC;")
+        with self._lock:
+            self.queries += 1
+            cur = self.cnx.cursor()
+            try:
+                cur.execute(sql, *patterns)
+                rows = [(str(sname), int(sid)) for sid, sname in cur.fetchall() if sname is not None]
+            finally:
+                cur.close()
+        return rows
+
+    def items(self) -> Iterable[Tuple[str, int]]:
+        """Stream every (name, system_id) row, to build a SystemNameIndex once misses are many."""
+        with self._lock:
+            cur = self.cnx.cursor()
+            try:
+                cur.execute(f"SELECT {self.id_col}, {self.name_col} FROM {self.table};")
+                rows = [(str(name), int(sid)) for sid, name in iter_rows(cur) if name is not None]
+            finally:
+                cur.close()
+        return rows
+
+    def _query(self, key: str) -> Optional[int]:
+        self.queries += 1
+        cur = self.cnx.cursor()
+        try:
+            cur.execute(self.sql, key)
+            row = cur.fetchone()
+        finally:
+            cur.close()
+        return int(row[0]) if row and row[0] is not None else None
+
+class SystemSnapshot:
+    """
+    Local copy of one system table (table, id column, name column) in a SQLite file.
+
+    refresh() tops the copy up with 'WHERE id_col > <highest ID held>', since new systems
+    get higher IDs; rebuild=True reloads it whole, and age() tells how long ago that last
+    happened. get(key) answers from the file alone, so runs without DB access can still
+    resolve SystemIDs. Names are stored
+    whitespace-collapsed and lower-cased, which also matches either script's own keys.
+    """
+
+    def __init__(self, path: Path, table: str, id_col: str, name_col: str):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.table, self.id_col, self.name_col = table, id_col, name_col
+        self.source = f"{table}({id_col}, {name_col})"
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS systems ("
+            " source TEXT NOT NULL, name_key TEXT NOT NULL, system_id INTEGER NOT NULL,"
+            " PRIMARY KEY (source, name_key))"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sources ("
+            " source TEXT PRIMARY KEY, max_id INTEGER NOT NULL, refreshed_at REAL NOT NULL)"
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(sources)")}
+        if "built_at" not in columns:
+            self._db.execute("ALTER TABLE sources ADD COLUMN built_at REAL")
+
+    def max_id(self) -> Optional[int]:
+        with self._lock:
+            row = self._db.execute("SELECT max_id FROM sources WHERE source = ?", (self.source,)).fetchone()
+        return row[0] if row else None
+
+    def count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM systems WHERE source = ?", (self.source,)).fetchone()[0]
+
+    def age(self) -> Optional[float]:
+        """Seconds since the copy was last loaded whole, or None if that is not known."""
+        with self._lock:
+            row = self._db.execute("SELECT built_at FROM sources WHERE source = ?", (self.source,)).fetchone()
+        return None if row is None or row[0] is None else max(0.0, time.time() - row[0])
+
+    def expired(self, max_age: float) -> bool:
+        """True when the copy should be reloaded whole: older than max_age seconds (0 = never)."""
+        if max_age <= 0:
+            return False
+        age = self.age()
+        return age is None or age > max_age
+
+    def refresh(self, cnx, rebuild: bool = False) -> int:
+        """Copy systems not yet held (all of them with rebuild=True) from cnx. Returns rows fetched."""
+        since = None if rebuild else self.max_id()
+        sql = f"SELECT {self.id_col}, {self.name_col} FROM {self.table}"
+        params: Tuple[Any, ...] = ()
+        if since is not None:
+            sql += f" WHERE {self.id_col} > ?"
+            params = (since,)
+        cur = cnx.cursor()
+        fetched = 0
+        try:
+            cur.execute(sql + ";", *params)
+            with self._lock:
+                self._db.execute("BEGIN")
+                try:
+                    if since is None:
+                        self._db.execute("DELETE FROM systems WHERE source = ?", (self.source,))
+                    top = since if since is not None else 0
+                    batch: List[Tuple[str, str, int]] = []
+                    for sid, sname in iter_rows(cur):
+                        fetched += 1
+                        top = max(top, int(sid))
+                        if sname is None:
+                            continue
+                        batch.append((self.source, _index_key(str(sname)), int(sid)))
+                        if len(batch) >= SYSTEM_FETCH_ROWS:
+                            self._store(batch)
+                    self._store(batch)
+                    now = time.time()
+                    if since is None:
+                        self._db.execute(
+                            "INSERT OR REPLACE INTO sources (source, max_id, refreshed_at, built_at)"
+                            " VALUES (?, ?, ?, ?)", (self.source, top, now, now),
+                        )
+                    else:
+                        self._db.execute("UPDATE sources SET max_id = ?, refreshed_at = ? WHERE source = ?",
+                                         (top, now, self.source))
+                    self._db.execute("COMMIT")
+                except Exception:
+                    self._db.execute("ROLLBACK")
+                    raise
+        finally:
+            cur.close()
+        return fetched
+
+    def _store(self, batch: List[Tuple[str, str, int]]) -> None:
+        self._db.executemany(
+            "INSERT OR REPLACE INTO systems (source, name_key, system_id) VALUES (?, ?, ?)", batch
+        )
+        batch.clear()
+
+    def get(self, key: str, default: Optional[int] = None) -> Optional[int]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT system_id FROM systems WHERE source = ? AND name_key = ?",
+                (self.source, _index_key(key)),
+            ).fetchone()
+        return row[0] if row else default
+
+    def items(self) -> Iterable[Tuple[str, int]]:
+        with self._lock:
+            return self._db.execute(
+                "SELECT name_key, system_id FROM systems WHERE source = ?", (self.source,)
+            ).fetchall()
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+SYSTEM_MATCH_MODES = ("exact", "normalized", "fuzzy")
+FUZZY_MIN_SCORE = 0.85
+# Fuzzy candidates scoring within this much of the best one make the match ambiguous.
+FUZZY_AMBIGUITY_MARGIN = 0.05
+# Bits in the per-name trigram signature that bounds a candidate's score before it is computed.
+_SIGNATURE_BITS = 256
+# Trigram rarity is estimated from every this-many'th name; any fixed order keeps lookups exact.
+_RARITY_SAMPLE = 4
+# Trigrams in more names than this ("col", " sy", "sec"...) are left out of a name's index
+# entries and of the probes where that still leaves enough to go on.
+_COMMON_GRAM_NAMES = 500
+
+def add_system_match_arguments(parser) -> None:
+    parser.add_argument("--system-match", choices=SYSTEM_MATCH_MODES, default="normalized",
+                        help="How to resolve a system name that has no exact match in the DB: exact = give up; "
+                             "normalized = also ignore case, unicode dashes, punctuation and spacing (default); "
+                             "fuzzy = also accept the closest trigram match scoring --fuzzy-min-score or more.")
+    parser.add_argument("--fuzzy-min-score", type=float, default=FUZZY_MIN_SCORE,
+                        help=f"Lowest trigram similarity (0..1) a fuzzy system match may have (default: {FUZZY_MIN_SCORE}).")
+
+_DASHES = dict.fromkeys(map(ord, "\u2010\u2011\u2012\u2013\u2014\u2015\u2212\ufe58\ufe63\uff0d"), "-")
+_NOT_NAME_CHAR = re.compile(r"[^\w\s-]")
+_SPACED_DASH = re.compile(r"\s*-\s*")
+
+def system_name_key(name: str) -> str:
+    """
+    Loose key for system names: NFKC, case-folded, every unicode dash as '-', other
+    punctuation dropped, whitespace collapsed ("Barnard\u2019s  Star" == "barnards star").
+    """
+    text = unicodedata.normalize("NFKC", name or "").translate(_DASHES).casefold()
+    text = _NOT_NAME_CHAR.sub("", text)
+    return _SPACED_DASH.sub("-", " ".join(text.split()))
+
+def _trigrams(key: str) -> Set[str]:
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def _min_overlap(size: int, floor: float) -> int:
+    """Trigrams a name of `size` trigrams must share with any other to reach Dice >= floor."""
+    return max(1, math.ceil(floor * size / (2 - floor) - 1e-9))  # 0.6 * 7 / 1.4 is not quite 3
+
+_popcount = getattr(int, "bit_count", None) or (lambda value: bin(value).count("1"))
+
+class _Ranks(dict):
+    """
+    Trigram -> rarity rank, plus `bits`: trigram -> its bit in name signatures. Grams the
+    sample missed are numbered below all others as they turn up.
+    """
+
+    def __init__(self, grams: Iterable[str]):
+        super().__init__((gram, r) for r, gram in enumerate(grams))
+        self.bits = {gram: 1 << (r % _SIGNATURE_BITS) for gram, r in self.items()}
+
+    def __missing__(self, gram: str) -> int:
+        rank = self[gram] = -len(self)
+        self.bits[gram] = 1 << (rank % _SIGNATURE_BITS)
+        return rank
+
+class SystemMatch(NamedTuple):
+    system_id: Optional[int]  # None when ambiguous
+    name: str                 # DB spelling that matched (best candidate when ambiguous)
+    score: float              # 1.0 for a normalised-key match, trigram Dice similarity otherwise
+    rivals: List[str]         # other DB names that match as well (normalised) or nearly (fuzzy)
+
+class SystemNameIndex:
+    """
+    Nearest-name lookup over (name, system_id) pairs, for names with no exact match.
+
+    Every name is reduced by system_name_key(); one dict lookup then settles most
+    spelling differences. With fuzzy=True a query that misses scores its candidates by
+    Dice similarity of padded trigrams, from a trigram index built on the first such miss.
+    Names are indexed per trigram count, only under their rarest trigrams (prefix filtering
+    in one global rarity order) and never under the very common ones if they have enough
+    others. A query probes just the sizes that can reach the score, and a candidate must
+    share two of the probed trigrams with it; a trigram signature then bounds its score,
+    so only a handful of names are ever scored. The index serves min_score down to
+    min_score - FUZZY_AMBIGUITY_MARGIN. Several system IDs under one key, or fuzzy
+    runners-up within FUZZY_AMBIGUITY_MARGIN of the best score, are reported as ambiguous
+    rather than guessed.
+    """
+
+    def __init__(self, pairs: Iterable[Tuple[str, int]], fuzzy: bool = False, min_score: float = FUZZY_MIN_SCORE):
+        self.names: List[str] = []
+        self.keys: List[str] = []
+        self.ids = array("q")
+        self.by_key: Dict[str, List[int]] = {}
+        for name, system_id in pairs:
+            key = system_name_key(name)
+            if not key:
+                continue
+            entries = self.by_key.setdefault(key, [])
+            if any(self.ids[i] == system_id for i in entries):
+                continue
+            entries.append(len(self.names))
+            self.names.append(name)
+            self.keys.append(key)
+            self.ids.append(int(system_id))
+        self.fuzzy = fuzzy
+        self.floor = max(0.05, min_score - FUZZY_AMBIGUITY_MARGIN)
+        # trigram count -> trigram -> entries; built by the first fuzzy lookup.
+        self.grams: Optional[Dict[int, Dict[str, array]]] = None
+        self._lock = threading.Lock()
+
+    def _index_trigrams(self) -> None:
+        firsts = [entries[0] for entries in self.by_key.values()]
+        counts = Counter(chain.from_iterable(_trigrams(self.keys[i]) for i in firsts[::_RARITY_SAMPLE]))
+        # Rarest first, ties broken by the gram, so the order is total.
+        rank = self.rank = _Ranks(sorted(counts, key=lambda g: (counts[g], g)))
+        common = self.common = frozenset(g for g, c in counts.items() if c * _RARITY_SAMPLE > _COMMON_GRAM_NAMES)
+        self.sizes = array("l", [0]) * len(self.keys)
+        self.signatures: List[int] = [0] * len(self.keys)
+        buckets: Dict[int, DefaultDict[str, List[int]]] = {}
+        keeps: Dict[int, int] = {}
+        for i in firsts:
+            grams = sorted(_trigrams(self.keys[i]), key=rank.__getitem__)
+            size = len(grams)
+            self.sizes[i] = size
+            self.signatures[i] = reduce(or_, map(rank.bits.__getitem__, grams))
+            keep = keeps.get(size)
+            if keep is None:
+                keep = keeps[size] = size - _min_overlap(size, self.floor) + 2
+                buckets[size] = defaultdict(list)
+            # The first `keep` grams serve queries full of common grams, the first `keep`
+            # uncommon ones all others (see _scored).
+            head = grams[:keep]
+            if not common.isdisjoint(head):
+                head = set(head).union([g for g in grams if g not in common][:keep])
+            bucket = buckets[size]
+            for gram in head:
+                bucket[gram].append(i)
+        self.unseen = -len(rank)
+        self.grams = {size: {g: array("l", ids) for g, ids in bucket.items()} for size, bucket in buckets.items()}
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def lookup(self, name: str, min_score: float = FUZZY_MIN_SCORE) -> Optional[SystemMatch]:
+        key = system_name_key(name)
+        entries = self.by_key.get(key)
+        if entries:
+            first = entries[0]
+            system_id = self.ids[first] if len(entries) == 1 else None
+            return SystemMatch(system_id, self.names[first], 1.0, [self.names[i] for i in entries[1:]])
+        if not self.fuzzy or not key:
+            return None
+        if self.grams is None:
+            with self._lock:
+                if self.grams is None:
+                    self._index_trigrams()
+        return self._fuzzy(key, min_score)
+
+    def _fuzzy(self, key: str, min_score: float) -> Optional[SystemMatch]:
+        # One pass down to the ambiguity floor: names scoring just under min_score still
+        # count as rivals of one just over it.
+        scored = self._scored(_trigrams(key), max(self.floor, min_score - FUZZY_AMBIGUITY_MARGIN))
+        if not scored or scored[0][0] < min_score:
+            return None
+        best_score, best = scored[0]
+        rivals = [self.names[i] for score, i in scored[1:]
+                  if best_score - score <= FUZZY_AMBIGUITY_MARGIN and self.ids[i] != self.ids[best]]
+        rivals += [self.names[i] for i in self.by_key[self.keys[best]][1:]]
+        return SystemMatch(None if rivals else self.ids[best], self.names[best], best_score, rivals)
+
+    def _scored(self, query: Set[str], floor: float) -> List[Tuple[float, int]]:
+        """(score, entry) for every name scoring at least floor, best first."""
+        n = len(query)
+        rank = self.rank
+        # Grams no name has sort first: they are never shared.
+        ordered = sorted(query, key=lambda g: rank.get(g, self.unseen))
+        rare = [g for g in ordered if g not in self.common]
+        common = n - len(rare)
+        outside = ~reduce(or_, map(rank.bits.get, query, repeat(0)))
+        signatures, keys = self.signatures, self.keys
+        scored: List[Tuple[float, int]] = []
+        low, high = math.ceil(n * floor / (2 - floor) - 1e-9), math.floor(n * (2 - floor) / floor + 1e-9)
+        for size in range(low, high + 1):
+            bucket = self.grams.get(size)
+            if bucket is None:
+                continue
+            need = max(math.ceil(floor * (n + size) / 2 - 1e-9), _min_overlap(size, floor), _min_overlap(n, floor))
+            if need > min(n, size):
+                continue
+            # A name reaching floor shares `need` trigrams with the query, so at least
+            # need - common uncommon ones. Two (or that many) of those are then among the
+            # query's first n - need + 2 uncommon grams and the name's first `keep` uncommon
+            # ones it is indexed under. With too many common grams in the query, the same
+            # holds for all grams and the name's first `keep` overall.
+            grams, shared_rare = rare, need - common
+            if shared_rare < 1:
+                grams, shared_rare = ordered, need
+            probe = [ids for ids in map(bucket.get, grams[:n - need + min(2, shared_rare)]) if ids]
+            if not probe:
+                continue
+            seen: Set[int] = set()
+            shared: Set[int] = set()
+            if shared_rare > 1:
+                for ids in probe[:-1]:
+                    shared.update(seen.intersection(ids))
+                    seen.update(ids)
+                shared.update(seen.intersection(probe[-1]))
+            else:
+                for ids in probe:
+                    seen.update(ids)
+            # Every signature bit outside the query's stands for at least one unshared trigram,
+            # and more than `spare` of them leave too few shared to reach floor.
+            spare = size - floor * (n + size) / 2
+            for i in shared if shared_rare > 1 else seen:
+                if _popcount(signatures[i] & outside) > spare:
+                    continue
+                score = 2 * len(query & _trigrams(keys[i])) / (n + size)
+                if score >= floor:
+                    scored.append((score, i))
+        scored.sort(key=lambda item: (-item[0], self.keys[item[1]]))
+        return scored
+
+class SystemResolver:
+    """
+    A script's exact system lookup, with SystemNameIndex as the fallback for misses.
+
+    exact(name) is the script's own resolve_system_id; only when it fails is the index
+    built (once, from the map's items()) and asked. With candidates (LazySystemMap.candidates)
+    the first LAZY_INDEX_MISSES misses are matched against just the rows it returns, so a
+    lazy run with few misses never reads the whole table. Answers for misses are kept per
+    name. resolve() returns (system_id, note): note is None for an exact hit and otherwise
+    says how the name was matched, or why not.
+    """
+
+    def __init__(self, exact: Callable[[str], Optional[int]], items: Callable[[], Iterable[Tuple[str, int]]],
+                 match: str = "normalized", min_score: float = FUZZY_MIN_SCORE,
+                 candidates: Optional[Callable[[str], Iterable[Tuple[str, int]]]] = None):
+        self.exact = exact
+        self.items = items
+        self.candidates = candidates
+        self.match = match
+        self.min_score = min_score
+        self.index: Optional[SystemNameIndex] = None
+        self.matched: Dict[str, Tuple[Optional[int], Optional[str]]] = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, name: str) -> Tuple[Optional[int], Optional[str]]:
+        system_id = self.exact(name)
+        if system_id is not None or self.match == "exact":
+            return system_id, None
+        fuzzy = self.match == "fuzzy"
+        with self._lock:
+            if name in self.matched:
+                return self.matched[name]
+            index = self.index
+            if index is None and (self.candidates is None or len(self.matched) >= LAZY_INDEX_MISSES):
+                index = self.index = SystemNameIndex(self.items(), fuzzy=fuzzy, min_score=self.min_score)
+        if index is None:
+            index = SystemNameIndex(self.candidates(name), fuzzy=fuzzy, min_score=self.min_score)
+        result = self._describe(name, index.lookup(name, self.min_score))
+        with self._lock:
+            self.matched[name] = result
+        return result
+
+    @staticmethod
+    def _describe(name: str, found: Optional[SystemMatch]) -> Tuple[Optional[int], Optional[str]]:
+        if found is None:
+            return None, None
+        how = "normalized" if found.score >= 1.0 else f"fuzzy {found.score:.2f}"
+        if found.system_id is None:
+            choices = ", ".join(repr(n) for n in [found.name] + found.rivals[:4])
+            return None, f"system '{name}' ambiguous in DB ({how}): {choices}"
+        return found.system_id, f"{how} match '{found.name}'"
+
+# --- HTML parsing -----------------------------------------------------------------
+
+# What may come between a label and its value: the end of the label's own element, then
+# whitespace, &nbsp; and the opening tags of the next sibling. Never a whole other element,
+# so "<li><a>Home system</a></li><li><a>Map</a>" has no value.
+_GAP = r"(?:\s|&nbsp;)*(?:</[^>]*>)?(?:\s|&nbsp;|<[^/!>][^>]*>)*?"
+_soup_features = "html.parser"
+
+def fast_label_value(html_text: str, label: str, anchor: bool = False) -> Optional[str]:
+    """
+    Regex fast path over the raw HTML: finds the first element whose text starts with
+    `label` (a regex, optional trailing ':') and returns the text that follows it in that
+    element or its next sibling (see _GAP). With anchor=True the value must be a link's text,
+    as the soup parsers prefer. Returns None when the page has some other layout;
+    callers then fall back to make_soup().
+    """
+    if anchor:
+        value = r"<a\b[^>]*>\s*([^<]*?)\s*</a>"
+    else:
+        value = r"([^<\s][^<]*?)\s*<"
+    m = re.search(r">\s*(?:" + label + r")\s*:?" + _GAP + value, html_text, re.IGNORECASE)
+    if not m or not m.group(1):
+        return None
+    return html.unescape(m.group(1)).strip() or None
+
+def fast_flag(html_text: str, label: str) -> Optional[bool]:
+    """fast_label_value() for Yes/No fields: True, False, or None if not found."""
+    value = fast_label_value(html_text, label)
+    if value:
+        low = value.lower()
+        if low.startswith("yes"):
+            return True
+        if low.startswith("no"):
+            return False
+    return None
+
+def add_parser_arguments(parser) -> None:
+    parser.add_argument("--parser", choices=["auto", "html.parser", "lxml"], default="auto",
+                        help="BeautifulSoup backend for pages the fast path can't read "
+                             "(default: auto = lxml if installed, else html.parser).")
+
+def use_parser(name: str) -> None:
+    """Select the make_soup() backend. Raises ValueError if lxml is asked for but missing."""
+    global _soup_features
+    if name == "auto":
+        name = "lxml" if lxml is not None else "html.parser"
+    elif name == "lxml" and lxml is None:
+        raise ValueError("--parser lxml needs lxml. Please `pip install lxml`.")
+    _soup_features = name
+
+def make_soup(html_text: str) -> BeautifulSoup:
+    return BeautifulSoup(html_text, _soup_features)
+
+# --- Concurrency ------------------------------------------------------------------
+
+def widen_connection_pool(session, pool_size: int) -> None:
+    """
+    Re-mount the session's adapters with room for `pool_size` connections per host,
+    keeping each adapter's existing retry policy.
+    """
+    for prefix, adapter in list(session.adapters.items()):
+        session.mount(prefix, HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=adapter.max_retries,
+        ))
+
+def run_ordered(
+    func: Callable[[T], R],
+    items: Iterable[T],
+    workers: int,
+    on_result: Callable[[T, R, float], Any],
+    window: int = 0,
+) -> None:
+    """
+    Run func(item) on a pool of `workers` threads and call on_result(item, result, elapsed)
+    on the calling thread, strictly in input order (elapsed = seconds func took).
+
+    At most `window` items (default: 4 per worker) are in flight or buffered at once,
+    so a slow lookup holds back output without letting memory grow unbounded.
+    If func raises, outstanding work is cancelled and the exception propagates;
+    nothing after the failing item is reported, so resume picks up from there.
+    """
+    window = window or max(1, workers) * 4
+    source = iter(items)
+    pending: Deque[Tuple[T, Any]] = deque()
+    pool = ThreadPoolExecutor(max_workers=max(1, workers))
+
+    def timed(item: T) -> Tuple[R, float]:
+        start = time.monotonic()
+        result = func(item)
+        return result, time.monotonic() - start
+
+    try:
+        for item in source:
+            pending.append((item, pool.submit(timed, item)))
+            if len(pending) >= window:
+                break
+        while pending:
+            item, fut = pending.popleft()
+            result, elapsed = fut.result()
+            on_result(item, result, elapsed)
+            nxt = next(source, _EXHAUSTED)
+            if nxt is not _EXHAUSTED:
+                pending.append((nxt, pool.submit(timed, nxt)))
+    except BaseException:
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown(wait=True)
+
+_EXHAUSTED = object()
+
+# --- Async engine -----------------------------------------------------------------
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def run_async_lookups(
+    names: Iterable[str],
+    on_result: Callable[[str, Any, float], Any],
+    *,
+    headers: Dict[str, str],
+    search_url: Callable[[str], str],
+    pick_match: Callable[[str, str], Optional[FactionMatch]],
+    interpret_details: Callable[[str], Any],
+    miss: Callable[[str], Any],
+    search_timeout: float,
+    details_timeout: float,
+    max_retries: int,
+    hard_deadline_secs: float,
+    retry_pause: float,
+    concurrency: int = 4,
+    fetcher: Optional[Fetcher] = None,
+    details_complete: Optional[Callable[[str], bool]] = None,
+) -> None:
+    """
+    Async counterpart of the scripts' sequential search -> details -> parse loop.
+
+    Each script plugs in its own pieces:
+      - search_url(name)                    -> URL of the search page
+      - pick_match(search_html, name)       -> (details_url, candidate, exact) or None
+      - interpret_details(details_html)     -> the same result tuple the sync fetch_* returns
+      - miss(reason)                        -> that tuple for a miss with the given reason
+      - details_complete(partial_html)      -> optional; lets --stream-details-kb stop early
+
+    At most `concurrency` HTTP requests are in flight at once (semaphore); the script's
+    Fetcher supplies the cache and rate limiter. Every faction runs under
+    asyncio.timeout(hard_deadline_secs), so one slow page only costs its own faction.
+    on_result(name, result, elapsed) is called on the event loop thread in input order;
+    result is None for factions left unsettled: --offline found nothing cached, or the search
+    got no answer (TransientFailure) through every redo.
+    """
+    if aiohttp is None:
+        raise RuntimeError("aiohttp is not installed. Please `pip install aiohttp` to use --engine async.")
+    if not hasattr(asyncio, "timeout"):
+        raise RuntimeError("--engine async needs Python 3.11 or newer.")
+    asyncio.run(_drive_async_lookups(
+        list(names), on_result,
+        headers=headers, search_url=search_url, pick_match=pick_match,
+        interpret_details=interpret_details, miss=miss,
+        search_timeout=search_timeout, details_timeout=details_timeout,
+        max_retries=max_retries, hard_deadline_secs=hard_deadline_secs,
+        retry_pause=retry_pause, concurrency=max(1, concurrency), fetcher=fetcher or Fetcher(),
+        details_complete=details_complete,
+    ))
+
+async def _drive_async_lookups(names, on_result, *, headers, search_url, pick_match,
+                               interpret_details, miss, search_timeout, details_timeout,
+                               max_retries, hard_deadline_secs, retry_pause, concurrency, fetcher,
+                               details_complete):
+    sem = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async with aiohttp.ClientSession(headers=headers, connector=connector) as session:
+
+        async def get(url: str, timeout: float, complete: Optional[Callable[[str], bool]] = None) -> Tuple[int, str]:
+            hit = fetcher.cached(url, complete)
+            if hit is not None:
+                return hit
+            stale = fetcher.revalidation(url, complete)
+            if fetcher.breaker is not None:
+                fetcher.breaker.allow(urlsplit(url).netloc)
+            async with sem:
+                if fetcher.limiter is not None:
+                    delay = fetcher.limiter.reserve()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                started = time.monotonic()
+                try:
+                    r = await session.get(url, timeout=aiohttp.ClientTimeout(total=timeout),
+                                          headers=stale[2] if stale else None)
+                except Exception:
+                    fetcher.observe(url, None, started)
+                    raise
+                async with r:
+                    fetcher.observe(url, r.status, started, r.headers)
+                    if r.status == 304 and stale is not None:
+                        return fetcher.not_modified(url, stale)
+                    status = r.status
+                    headers = r.headers
+                    reader = fetcher.stream_reader(status, r.charset, complete)
+                    if reader is None:
+                        text = await r.text(errors="replace")
+                    else:
+                        async for chunk in r.content.iter_chunked(STREAM_CHUNK_BYTES):
+                            if reader.feed(chunk):
+                                break
+                        text = reader.text()
+                        if reader.partial:
+                            r.close()
+            partial = reader is not None and reader.partial
+            if not partial or complete(text):
+                fetcher.store(url, status, text, partial, headers)
+            return status, text
+
+        async def search(name: str) -> Optional[str]:
+            url = fetcher.indexed_url(name)
+            if url:
+                return url
+            # Mirrors the urllib3 Retry on the sync search session: retry 429/5xx and I/O errors.
+            failure = None
+            for attempt in range(1, max_retries + 2):
+                try:
+                    url = search_url(name)
+                    status, text = await get(url, search_timeout)
+                    if status == 200:
+                        match = fetcher.parse(url, text, pick_match, name)
+                        if match is None:
+                            return None
+                        fetcher.remember(name, match)
+                        return match[0]
+                    if status not in RETRY_STATUSES and status < 500:
+                        return None
+                    failure = f"HTTP {status}"
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    failure = type(e).__name__
+                await asyncio.sleep(fetcher.pause(retry_pause * attempt))
+            raise TransientFailure(f"search: {failure}")
+
+        async def lookup(name: str) -> Tuple[Any, float]:
+            start = time.monotonic()
+            breaker = fetcher.breaker
+            redos = 0
+            while True:
+                # Same as Fetcher.pausing(): wait out open circuits, and redo a lookup that ran
+                # into one (or failed as one opened) once a probe is due, up to BREAKER_MAX_REDOS.
+                while breaker is not None and breaker.retry_in() > 0:
+                    await asyncio.sleep(min(breaker.retry_in(), 5.0))
+                trips = breaker.trips if breaker is not None else 0
+                failed = [False]
+                token = _last_request_failed.set(failed)
+                try:
+                    result = await lookup_one(name)
+                except CircuitOpen:
+                    if redos >= BREAKER_MAX_REDOS:
+                        return miss("circuit open"), time.monotonic() - start
+                    redos += 1
+                    continue
+                except TransientFailure:
+                    if breaker is None or redos >= BREAKER_MAX_REDOS:
+                        return None, time.monotonic() - start
+                    redos += 1
+                    await asyncio.sleep(fetcher.pause(2.0 ** redos))
+                    continue
+                finally:
+                    _last_request_failed.reset(token)
+                if breaker is None or not failed[0] or breaker.trips == trips or redos >= BREAKER_MAX_REDOS:
+                    return result, time.monotonic() - start
+                redos += 1
+
+        async def lookup_one(name: str) -> Any:
+            try:
+                async with asyncio.timeout(hard_deadline_secs):
+                    details_url = await search(name)
+                    if not details_url:
+                        return miss("not found (search)")
+
+                    last_exc = None
+                    for attempt in range(1, max_retries + 1):
+                        try:
+                            status, text = await get(details_url, details_timeout, details_complete)
+                            if status == 404:
+                                fetcher.forget(name)
+                                return miss("details 404")
+                            if status >= 400:
+                                raise RuntimeError(f"{status} error for url: {details_url}")
+                            return fetcher.parse(details_url, text, interpret_details)
+                        except asyncio.TimeoutError:
+                            last_exc = "read-timeout"
+                        except (CacheMiss, CircuitOpen):
+                            raise
+                        except Exception as e:
+                            last_exc = str(e)
+                        await asyncio.sleep(fetcher.pause(retry_pause * attempt))
+
+                    return miss("timeout" if last_exc == "read-timeout" else f"error: {last_exc}")
+            except TimeoutError:
+                return miss("timeout")
+            except CacheMiss:
+                return None
+
+        # Keep a bounded window of faction tasks alive and report them in input order.
+        window = concurrency * 4
+        source = iter(names)
+        pending: Deque[Tuple[str, "asyncio.Task"]] = deque()
+        try:
+            for name in source:
+                pending.append((name, asyncio.create_task(lookup(name))))
+                if len(pending) >= window:
+                    break
+            while pending:
+                name, task = pending.popleft()
+                result, elapsed = await task
+                on_result(name, result, elapsed)
+                nxt = next(source, _EXHAUSTED)
+                if nxt is not _EXHAUSTED:
+                    pending.append((nxt, asyncio.create_task(lookup(nxt))))
+        finally:
+            for _, task in pending:
+                task.cancel()
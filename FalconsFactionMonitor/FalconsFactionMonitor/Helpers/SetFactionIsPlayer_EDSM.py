@@ -13,12 +13,38 @@ What it does
     - If not found/timeout: writes MISS with reason
 - Supports --retry-misses to reprocess only previously missed entries
 - Adds BEGIN TRAN on first write, and COMMIT at the end (unless --no-commit)
+- '--engine async' pipelines search + details fetches over one asyncio loop (needs aiohttp)
+- '--cache-dir' keeps fetched pages and resolved faction URLs on disk (shared between scripts);
+  '--offline' runs from that cache only
+- Every outcome is also appended to '<output>.progress.jsonl' (name, status, reason, system,
+  player flag, timestamp, latency); resume and --retry-misses read that journal
+- SQL and journal share one open handle each and are fsynced together; '--fsync-every N'
+  batches N factions per fsync (a crash redoes at most N)
+- '--stream-details-kb N' streams details pages and hangs up once the needed fields have arrived
+  (or after N KB); such cut-short pages are cached as partial
+- '--apply' writes the results straight into ref.Faction at the end of the run (staging table,
+  one set-based UPDATE + COMMIT per '--apply-batch' rows); the .sql file is still written
+- '--output-format merge' writes INSERT INTO #FactionStaging VALUES blocks (1000 rows each) and
+  one set-based UPDATE ... JOIN at the end instead of one UPDATE per faction
+- Details pages are read by a regex fast path on the raw HTML; the BeautifulSoup tree is only
+  built when that fails ('--parser lxml' makes that fallback faster; default: lxml if installed)
+- '--watch' keeps running after the pass: results older than '--stale-hours' (default 168 with
+  --watch) are re-checked oldest first, spread evenly over that window, and names added to the
+  input file are picked up within '--watch-poll' seconds; a pass appends only what changed, as
+  its own BEGIN TRAN ... COMMIT block
+- '--adaptive' paces the search and details requests together from EDSM's answers instead of
+  '--sleep' and fixed retry pauses: it starts at '--rate', speeds up while pages come back fast,
+  halves on 429/5xx, errors or slow pages, waits out Retry-After, and logs the rate it settles on
+- When EDSM is down ('--breaker-failures' failed requests in a row, default 5) the run pauses instead
+  of writing a MISS per faction: a probe is sent after '--breaker-cooldown' seconds (doubling while
+  it keeps failing) and the pending factions carry on once one succeeds
 
 Usage
 -----
 python SetFactionIsPlayer_EDSM.py factions.txt -o update_isplayer.sql
 python SetFactionIsPlayer_EDSM.py factions.txt -o update_isplayer.sql --set-nonplayer
 python SetFactionIsPlayer_EDSM.py factions.txt -o update_isplayer.sql --retry-misses
+python SetFactionIsPlayer_EDSM.py factions.txt -o update_isplayer.sql --engine async --concurrency 8 --rate 2
 """
 
 import sys
@@ -29,14 +55,29 @@ import html
 import logging
 from datetime import datetime
 from pathlib import Path
-from typing import Iterable, Optional, Tuple, List, Set
+from typing import Iterable, Optional, Tuple, List, Dict
 from urllib.parse import quote_plus, urljoin
 
 import requests
-from bs4 import BeautifulSoup
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
+from ScraperCommon import (
+    CacheMiss, CircuitOpen, FactionMatch, Fetcher, GroupCommit, ProgressJournal,
+    FactionUpdate, add_apply_arguments, apply_faction_updates,
+    add_breaker_arguments, add_pacing_arguments, add_watch_arguments, run_watch, split_rechecks, stale_seconds,
+    watch_due_in, watch_journals, ends_with_commit, transaction_start,
+    add_cache_arguments, add_commit_arguments, add_parser_arguments, add_stream_arguments,
+    ValuesBlock, add_output_format_arguments, merge_preamble, merge_trailer, output_format_of,
+    fast_flag, make_soup, use_parser,
+    run_async_lookups, STATUS_MISS, STATUS_NONPLAYER, STATUS_UPDATE,
+)
+
+try:
+    import pyodbc  # SQL Server driver, only needed for --apply
+except Exception:
+    pyodbc = None
+
 BASE = "https://www.edsm.net"
 SEARCH_URL = f"{BASE}/en/search/factions/index/name/{{q}}"
 
@@ -66,6 +107,9 @@ details_session.headers.update(HEADERS)
 details_session.mount("https://", HTTPAdapter(max_retries=Retry(total=0)))
 details_session.mount("http://", HTTPAdapter(max_retries=Retry(total=0)))
 
+# Cache + rate limit for every GET; configured in main()
+fetcher = Fetcher("edsm")
+
 # --- Helpers --------------------------------------------------------------------
 def _norm(s: str) -> str:
     return re.sub(r"\s+", " ", s or "").strip().lower()
@@ -86,74 +130,38 @@ def append_lines(out_path: Path, lines: Iterable[str]) -> None:
 
 HEADER_LINE = "-- Generated by SetFactionIsPlayer_EDSM.py (EDSM-based player flag)"
 
-def ensure_header(out_path: Path) -> None:
+def ensure_header(out_path: Path, preamble: Iterable[str] = ()) -> None:
     if not out_path.exists() or out_path.stat().st_size == 0:
         append_lines(out_path, [
             HEADER_LINE,
             f"-- Started: {datetime.now().isoformat(timespec='seconds')}",
             "BEGIN TRAN;",
             "",
+            *preamble,
             "-- Incremental output; safe to resume. Checks 'Player faction' on EDSM.",
             "",
         ])
 
-def has_commit(out_path: Path) -> bool:
-    if not out_path.exists():
-        return False
-    try:
-        return "COMMIT;" in out_path.read_text(encoding="utf-8", errors="ignore")
-    except Exception:
-        return False
-
-def load_processed_names(out_path: Path, names: List[str]) -> Set[str]:
-    """
-    Consider processed if we already wrote:
-      - UPDATE ... WHERE f.FactionName = '<name>';
-      - or a NONPLAYER line;
-      - or a MISS/RETRY MISS line.
-    """
-    done: Set[str] = set()
-    if not out_path.exists():
-        return done
-    txt = out_path.read_text(encoding="utf-8", errors="ignore")
-    for n in names:
-        esc = escape_sql_literal(n)
-        where_sig = f"WHERE f.FactionName = '{esc}';"
-        if where_sig in txt:
-            done.add(n); continue
-        if f"-- NONPLAYER: {n}" in txt:
-            done.add(n); continue
-        if f"-- MISS: {n}" in txt or f"-- RETRY MISS: {n}" in txt:
-            done.add(n)
-    return done
-
-def load_miss_names(out_path: Path, names: List[str]) -> Set[str]:
-    misses: Set[str] = set()
-    if not out_path.exists():
-        return misses
-    name_set = set(names)
-    for line in out_path.read_text(encoding="utf-8", errors="ignore").splitlines():
-        s = line.strip()
-        if s.startswith("-- MISS: ") or s.startswith("-- RETRY MISS: "):
-            raw = s.split(": ", 1)[1]
-            name_only = raw
-            idx = raw.rfind(" (")
-            if idx != -1 and raw.endswith(")"):
-                name_only = raw[:idx]
-            cand = name_only.strip()
-            if cand in name_set:
-                misses.add(cand)
-    return misses
-
 # --- EDSM scraping --------------------------------------------------------------
+def search_url(name: str) -> str:
+    return SEARCH_URL.format(q=quote_plus(name))
+
 def search_edsm_faction_url(name: str, timeout: float = 25.0) -> Optional[str]:
-    q = quote_plus(name)
-    url = SEARCH_URL.format(q=q)
-    r = search_session.get(url, timeout=timeout)
-    if r.status_code != 200:
+    url = fetcher.indexed_url(name)
+    if url:
+        return url
+    url = search_url(name)
+    status, text = fetcher.search(search_session, url, timeout=timeout)
+    if status != 200:
+        return None
+    match = fetcher.parse(url, text, pick_edsm_faction_match, name)
+    if match is None:
         return None
+    fetcher.remember(name, match)
+    return match[0]
 
-    soup = BeautifulSoup(r.text, "html.parser")
+def pick_edsm_faction_match(search_html: str, name: str) -> Optional[FactionMatch]:
+    soup = make_soup(search_html)
     candidates: List[Tuple[str, str]] = []
     for a in soup.select("a[href]"):
         href = a.get("href", "")
@@ -168,22 +176,34 @@ def search_edsm_faction_url(name: str, timeout: float = 25.0) -> Optional[str]:
     target = _norm(name)
     for txt, full in candidates:
         if _norm(txt) == target:
-            return full
-    return candidates[0][1]
+            return full, txt, True
+    return candidates[0][1], candidates[0][0], False
 
 def fetch_details_html(details_url: str, timeout: float = 75.0) -> Optional[str]:
-    r = details_session.get(details_url, timeout=timeout)
-    if r.status_code == 404:
+    status, text = fetcher.get(details_session, details_url, timeout=timeout, complete=details_complete)
+    if status == 404:
         return None
-    r.raise_for_status()
-    return r.text
+    if status >= 400:
+        raise requests.HTTPError(f"{status} error for url: {details_url}")
+    return text
+
+PLAYER_LABEL = r"Player\s*faction"
+
+def details_complete(html_text: str) -> bool:
+    """True once a (possibly partial) details page already shows the player flag."""
+    return fast_flag(html_text, PLAYER_LABEL) is not None
 
 def parse_player_flag(html_text: str) -> Optional[bool]:
     """
     Returns True if 'Player faction: Yes', False if '... No', or None if not present.
     Much more robust: first scan the full page text, then try structural fallbacks.
     """
-    soup = BeautifulSoup(html_text, "html.parser")
+    # 0) Raw-HTML fast path: label followed by Yes/No, no tree needed
+    flag = fast_flag(html_text, PLAYER_LABEL)
+    if flag is not None:
+        return flag
+
+    soup = make_soup(html_text)
 
     # 1) Fast path: regex over full text (handles inline "Player faction: Yes")
     full = soup.get_text(" ", strip=True)
@@ -227,6 +247,12 @@ def parse_player_flag(html_text: str) -> Optional[bool]:
 
     return None
 
+def interpret_player_details(html_text: str) -> Tuple[Optional[bool], Optional[str]]:
+    flag = parse_player_flag(html_text)
+    if flag is True or flag is False:
+        return flag, None
+    return None, "no 'Player faction' field"
+
 def fetch_player_flag(
     faction_name: str,
     search_timeout: float = 25.0,
@@ -250,16 +276,16 @@ def fetch_player_flag(
         try:
             html_text = fetch_details_html(details_url, timeout=details_timeout)
             if not html_text:
+                fetcher.forget(faction_name)
                 return None, "details 404"
-            flag = parse_player_flag(html_text)
-            if flag is True or flag is False:
-                return flag, None
-            return None, "no 'Player faction' field"
+            return fetcher.parse(details_url, html_text, interpret_player_details)
         except requests.exceptions.ReadTimeout:
             last_exc = "read-timeout"
+        except (CacheMiss, CircuitOpen):
+            raise
         except Exception as e:
             last_exc = str(e)
-        time.sleep(1.2 * attempt)
+        time.sleep(fetcher.pause(1.2 * attempt))
 
     reason = "timeout" if last_exc == "read-timeout" else f"error: {last_exc}"
     return None, reason
@@ -274,6 +300,35 @@ def make_update_isplayer(faction_name: str, value: int) -> str:
         f"WHERE f.FactionName = '{f}';"
     )
 
+# --- Database (--apply) --------------------------------------------------------
+def connect_db(connection_string: str):
+    if pyodbc is None:
+        raise RuntimeError("pyodbc is not installed. Please `pip install pyodbc`.")
+    return pyodbc.connect(connection_string)
+
+def apply_to_db(connection_string: str, updates: List[FactionUpdate], batch_size: int) -> int:
+    """--apply: bulk-write the run's results into ref.Faction. Returns a main() exit code."""
+    try:
+        cnx = connect_db(connection_string)
+    except Exception as e:
+        logging.error("Could not connect to SQL Server with provided --conn: %s", e)
+        return 3
+    try:
+        updated = apply_faction_updates(
+            cnx, updates, batch_size,
+            on_batch=lambda staged, hit: logging.info("… applied batch: %d staged, %d ref.Faction rows updated", staged, hit),
+        )
+    except Exception as e:
+        logging.error("Bulk apply to ref.Faction failed: %s", e)
+        return 6
+    finally:
+        try:
+            cnx.close()
+        except Exception:
+            pass
+    logging.info("✔ Applied %d results to ref.Faction (%d rows updated).", len(updates), updated)
+    return 0
+
 # --- Main -----------------------------------------------------------------------
 def main(argv: List[str]) -> int:
     import argparse
@@ -285,7 +340,15 @@ def main(argv: List[str]) -> int:
     parser.add_argument("-o", "--output", default="update_isplayer.sql",
                         help="Output .sql file (appended incrementally).")
     parser.add_argument("--sleep", type=float, default=1.0,
-                        help="Delay between factions in seconds (default: 1.0).")
+                        help="Delay between factions in seconds (default: 1.0; sync engine only).")
+    parser.add_argument("--engine", choices=["sync", "async"], default="sync",
+                        help="sync = one faction at a time via requests; async = aiohttp event loop.")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="With --engine async: max HTTP requests in flight at once.")
+    parser.add_argument("--rate", type=float, default=2.0,
+                        help="With --engine async: max requests per second to edsm.net; with --adaptive: the starting pace.")
+    parser.add_argument("--burst", type=float, default=1.0,
+                        help="With --engine async: requests allowed back-to-back before --rate applies.")
     parser.add_argument("--search-timeout", type=float, default=25.0)
     parser.add_argument("--details-timeout", type=float, default=75.0)
     parser.add_argument("--retries", type=int, default=3,
@@ -298,31 +361,81 @@ def main(argv: List[str]) -> int:
                         help="Only retry factions previously marked as MISS in the output SQL.")
     parser.add_argument("--set-nonplayer", action="store_true",
                         help="Also write UPDATE IsPlayer = 0 when 'Player faction: No' is detected.")
+    add_cache_arguments(parser)
+    add_commit_arguments(parser)
+    add_parser_arguments(parser)
+    add_stream_arguments(parser)
+    add_pacing_arguments(parser)
+    add_breaker_arguments(parser)
+    parser.add_argument("--conn", default=None,
+                        help="ODBC connection string for SQL Server (pyodbc); needed for --apply.")
+    add_apply_arguments(parser)
+    add_output_format_arguments(parser)
+    add_watch_arguments(parser)
     args = parser.parse_args(argv[1:])
 
     logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
+    try:
+        fetcher.configure_cache(args)
+        fetcher.configure_pacing(args, search_session, details_session, note=logging.info)
+        fetcher.configure_breaker(args, note=logging.info)
+        use_parser(args.parser)
+    except ValueError as e:
+        logging.error("%s", e)
+        return 2
+
+    if args.apply and not args.conn:
+        logging.error("--apply needs --conn.")
+        return 2
+
+    if args.watch:
+        if args.retry_misses:
+            logging.error("--watch cannot be combined with --retry-misses.")
+            return 2
+        journals = watch_journals([Path(args.output)])
+        deferred: Dict[str, float] = {}
+        return run_watch(
+            lambda: run_pass(args, deferred),
+            lambda: watch_due_in(journals, read_faction_names(Path(args.input)), stale_seconds(args), deferred),
+            args.watch_poll, logging.info,
+        )
+    return run_pass(args)
+
+def run_pass(args, deferred: Optional[Dict[str, float]] = None) -> int:
+    """
+    One pass over the input file: look up every faction without a (fresh enough) result.
+    With --watch, names it cannot settle (not cached with --offline, no answer from the site)
+    go into deferred, so the watch looks at them again a --watch-poll later instead of at once.
+    """
+    if deferred is not None:
+        deferred.clear()
     names = read_faction_names(Path(args.input))
     if not names:
         logging.error("No faction names found in %s", args.input)
         return 2
 
     out_path = Path(args.output)
-    ensure_header(out_path)
+    merge = args.output_format == "merge"
+    started_as = output_format_of(out_path)
+    if started_as and started_as != args.output_format:
+        logging.error("%s was started with --output-format %s; keep that format or pick a new file.", out_path, started_as)
+        return 2
+
+    journal = ProgressJournal.for_output(out_path, names)
+    ensure_header(out_path, merge_preamble() if merge else ())
 
     if args.retry_misses:
-        prior_misses = load_miss_names(out_path, names)
+        prior_misses = journal.misses(names)
         if not prior_misses:
             logging.info("No prior MISS entries found in %s. Nothing to retry.", out_path)
             return 0
-        # Skip any that already got an UPDATE later
-        already = load_processed_names(out_path, list(prior_misses))
-        to_process = [n for n in names if n in prior_misses and n not in already]
+        to_process = [n for n in names if n in prior_misses]
         total = len(to_process)
         done = 0
         logging.info("Retrying %d previously missed factions (EDSM player flag)…", total)
     else:
-        already = load_processed_names(out_path, names)
+        already = journal.processed(names, max_age=stale_seconds(args))
         to_process = [n for n in names if n not in already]
         total = len(names)
         done = len(already)
@@ -330,58 +443,155 @@ def main(argv: List[str]) -> int:
         if already:
             logging.info("Resuming: %d/%d already present in output.", done, total)
 
+    # --watch: first-time names go through the engine; stale results are re-checked after them.
+    to_process, rechecks, recheck_pause = split_rechecks(args, to_process, [journal], len(names))
+
     updates_this_run = 0
     misses_this_run = 0
 
-    for name in to_process:
-        logging.info("… %s → (searching %d/%d)", name, (done + 1 if not args.retry_misses else done + 1), (total if not args.retry_misses else total))
-
-        is_player, miss_reason = fetch_player_flag(
-            name,
-            search_timeout=args.search_timeout,
-            details_timeout=args.details_timeout,
-            max_retries=args.retries,
-            hard_deadline_secs=args.hard_timeout,
-        )
+    writer = GroupCommit(every=args.fsync_every, interval=args.fsync_interval)
+    # --output-format merge: UPDATE rows go to a VALUES block that the writer flushes 1000 at a time.
+    out_values = ValuesBlock(out_path) if merge else None
+    if out_values is not None:
+        writer.attach(out_values)
+    journal.committer = writer
+    # An output whose last transaction is committed (an earlier pass) gets a new one, opened
+    # only once this pass has something to write.
+    committed = ends_with_commit(out_path)
+    if committed:
+        writer.begin(out_path, transaction_start(merge_preamble() if merge else ()))
+
+    def changed(name: str, status: str, is_player: Optional[bool]) -> bool:
+        # A re-check that finds what the journal already has writes no SQL: the output has it
+        # from before. Only the journal entry is renewed.
+        return args.retry_misses or not journal.unchanged(name, status, is_player=is_player)
+
+    @fetcher.pausing(miss=lambda reason: (None, reason))
+    def lookup(name: str) -> Optional[Tuple[Optional[bool], Optional[str]]]:
+        try:
+            return fetch_player_flag(
+                name,
+                search_timeout=args.search_timeout,
+                details_timeout=args.details_timeout,
+                max_retries=args.retries,
+                hard_deadline_secs=args.hard_timeout,
+            )
+        except CacheMiss:
+            return None
+
+    def record(name: str, result: Optional[Tuple[Optional[bool], Optional[str]]], elapsed: Optional[float] = None) -> None:
+        nonlocal done, updates_this_run, misses_this_run
+        if result is None:
+            logging.info("… %s → skipped (not cached with --offline, or no answer from the site)", name)
+            if deferred is not None:
+                deferred[name] = time.time() + args.watch_poll
+            return
+        is_player, miss_reason = result
 
         if is_player is True:
             logging.info("✔ %s → Player faction: Yes", name)
-            block = [
-                f"-- UPDATE IsPlayer for faction: {name} (Player=Yes)",
-                make_update_isplayer(name, 1),
-                "",
-            ]
-            append_lines(out_path, block)
-            updates_this_run += 1
-
-        elif is_player is False:
-            logging.info("✔ %s → Player faction: No", name)
-            if args.set_nonplayer:
+            if changed(name, STATUS_UPDATE, True):
                 block = [
-                    f"-- UPDATE IsPlayer for faction: {name} (Player=No)",
-                    make_update_isplayer(name, 0),
+                    f"-- UPDATE IsPlayer for faction: {name} (Player=Yes)",
+                    make_update_isplayer(name, 1),
                     "",
                 ]
-                append_lines(out_path, block)
+                if out_values is not None:
+                    out_values.add(name, None, True)
+                else:
+                    writer.add(out_path, block)
                 updates_this_run += 1
+            journal.record(name, STATUS_UPDATE, is_player=True, latency=elapsed, retry=args.retry_misses)
+
+        elif is_player is False:
+            logging.info("✔ %s → Player faction: No", name)
+            if args.set_nonplayer:
+                if changed(name, STATUS_UPDATE, False):
+                    block = [
+                        f"-- UPDATE IsPlayer for faction: {name} (Player=No)",
+                        make_update_isplayer(name, 0),
+                        "",
+                    ]
+                    if out_values is not None:
+                        out_values.add(name, None, False)
+                    else:
+                        writer.add(out_path, block)
+                    updates_this_run += 1
+                journal.record(name, STATUS_UPDATE, is_player=False, latency=elapsed, retry=args.retry_misses)
             else:
-                append_lines(out_path, [f"-- NONPLAYER: {name} (Player=No)", ""])
+                if changed(name, STATUS_NONPLAYER, False):
+                    writer.add(out_path, [f"-- NONPLAYER: {name} (Player=No)", ""])
+                journal.record(name, STATUS_NONPLAYER, is_player=False, latency=elapsed, retry=args.retry_misses)
             # Count as processed either way
 
         else:
             reason = f"{miss_reason}" if miss_reason else "unknown"
             logging.info("✖ %s → (not found) (%s)", name, reason)
-            append_lines(out_path, [f"-- {'RETRY MISS' if args.retry_misses else 'MISS'}: {name} ({reason})", ""])
-            misses_this_run += 1
+            if changed(name, STATUS_MISS, None):
+                writer.add(out_path, [f"-- {'RETRY MISS' if args.retry_misses else 'MISS'}: {name} ({reason})", ""])
+                misses_this_run += 1
+            journal.record(name, STATUS_MISS, reason=reason, latency=elapsed, retry=args.retry_misses)
 
         done += 1
-        time.sleep(args.sleep)
+        writer.end_record()
 
-    if not args.retry_misses:
-        if done == total and not has_commit(out_path) and not args.no_commit:
-            append_lines(out_path, ["-- Completed: " + datetime.now().isoformat(timespec="seconds"), "COMMIT;", ""])
+    try:
+        if args.engine == "async":
+            logging.info("Async engine: up to %d requests in flight at %.2f requests/second.", args.concurrency, args.rate)
+            fetcher.rate_limit(args.rate, args.burst)
+            try:
+                run_async_lookups(
+                    to_process, record,
+                    headers=HEADERS,
+                    search_url=search_url,
+                    pick_match=pick_edsm_faction_match,
+                    interpret_details=interpret_player_details,
+                    miss=lambda reason: (None, reason),
+                    search_timeout=args.search_timeout,
+                    details_timeout=args.details_timeout,
+                    max_retries=args.retries,
+                    hard_deadline_secs=args.hard_timeout,
+                    retry_pause=1.2,
+                    concurrency=args.concurrency,
+                    fetcher=fetcher,
+                    details_complete=details_complete,
+                )
+            except RuntimeError as e:
+                logging.error("%s", e)
+                return 5
+        else:
+            for name in to_process:
+                logging.info("… %s → (searching %d/%d)", name, (done + 1 if not args.retry_misses else done + 1), (total if not args.retry_misses else total))
+                start = time.monotonic()
+                result = lookup(name)
+                record(name, result, time.monotonic() - start)
+                time.sleep(fetcher.pause(args.sleep))
+
+        # --watch: stale results, oldest first, spread out over the staleness window.
+        for name in rechecks:
+            logging.info("… %s → (re-checking)", name)
+            start = time.monotonic()
+            result = lookup(name)
+            record(name, result, time.monotonic() - start)
+            time.sleep(recheck_pause)
+    finally:
+        writer.close()
+        journal.committer = None
+        journal.compact()
+
+    # Close the transaction this pass opened, or the file's first one once every name is done.
+    completing = out_path in writer.begun or (not args.retry_misses and done == total and not committed)
+    # Merge format: apply whatever this (or an interrupted earlier) run staged.
+    if out_values is not None and (out_values.written or completing):
+        append_lines(out_path, merge_trailer())
+    if completing and not args.no_commit:
+        append_lines(out_path, ["-- Completed: " + datetime.now().isoformat(timespec="seconds"), "COMMIT;", ""])
 
     logging.info("Run complete. Appended %d updates, %d misses.", updates_this_run, misses_this_run)
+
+    if args.apply:
+        updates = [(e["name"], None, e.get("is_player")) for e in journal.updates(names)]
+        return apply_to_db(args.conn, updates, args.apply_batch)
     return 0
 
 if __name__ == "__main__":
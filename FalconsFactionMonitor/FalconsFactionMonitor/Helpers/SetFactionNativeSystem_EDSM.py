@@ -10,6 +10,49 @@ What it does
 - UPDATE uses a literal SystemID from your DB (no JOIN)
 - '--retry-misses' mode reprocesses previous MISS entries only
 - Hard per-faction timeout; no page can hang the run
+- '--workers N' runs lookups on a thread pool, capped by a shared '--rate' limit to edsm.net;
+  output is still appended in input order, so resume works exactly as in sequential mode
+- '--engine async' pipelines search + details fetches over one asyncio loop (needs aiohttp)
+- '--cache-dir' keeps fetched pages and resolved faction URLs on disk (shared between scripts);
+  '--offline' runs from that cache only
+- Every outcome is also appended to '<output>.progress.jsonl' (name, status, reason, system,
+  player flag, timestamp, latency); resume and --retry-misses read that journal
+- SQL and journal share one open handle each and are fsynced together; '--fsync-every N'
+  batches N factions per fsync (a crash redoes at most N)
+- '--stream-details-kb N' streams details pages and hangs up once the needed fields have arrived
+  (or after N KB); such cut-short pages are cached as partial
+- '--apply' writes the results straight into ref.Faction at the end of the run (staging table,
+  one set-based UPDATE + COMMIT per '--apply-batch' rows); the .sql file is still written
+- '--output-format merge' writes INSERT INTO #FactionStaging VALUES blocks (1000 rows each) and
+  one set-based UPDATE ... JOIN at the end instead of one UPDATE per faction
+- Details pages are read by a regex fast path on the raw HTML; the BeautifulSoup tree is only
+  built when that fails ('--parser lxml' makes that fallback faster; default: lxml if installed)
+- '--isplayer-output FILE' also writes the SetFactionIsPlayer_EDSM.py SQL (and its journal) from the
+  same page fetch, so the pair no longer has to be run separately over the same list
+- '--system-map lazy' (the default for runs of up to 5000 factions) looks up only the systems
+  the pages name, one cached query each, instead of loading all of ref.System first
+- '--system-map snapshot' (the default with '--system-snapshot', without '--conn', or for larger
+  runs once '--cache-dir' is set) resolves from a local SQLite copy of ref.System, topped up by
+  SystemID when '--conn' is given and reloaded whole once older than '--system-snapshot-hours';
+  without '--conn' the run needs no database at all
+- '--apply-live' writes each result into ref.Faction as it is recorded: background writer threads
+  ('--apply-writers', one connection and one bounded queue each, a faction always going to the
+  same one) commit them in batches, so DB writes overlap the scraping instead of waiting for
+  the end of the run
+- System names with no exact DB match are retried ignoring case, unicode dashes, punctuation and
+  spacing ('--system-match normalized', default) or by trigram similarity ('--system-match fuzzy');
+  ambiguous names stay MISSes and list the candidates. '--retry-misses' re-resolves such misses
+  from the journal without fetching the pages again
+- '--watch' keeps running after the pass: results older than '--stale-hours' (default 168 with
+  --watch) are re-checked oldest first, spread evenly over that window, and names added to the
+  input file are picked up within '--watch-poll' seconds; a pass appends only what changed, as
+  its own BEGIN TRAN ... COMMIT block
+- '--adaptive' paces the search and details requests together from EDSM's answers instead of
+  '--sleep' and fixed retry pauses: it starts at '--rate', speeds up while pages come back fast,
+  halves on 429/5xx, errors or slow pages, waits out Retry-After, and logs the rate it settles on
+- When EDSM is down ('--breaker-failures' failed requests in a row, default 5) the run pauses instead
+  of writing a MISS per faction: a probe is sent after '--breaker-cooldown' seconds (doubling while
+  it keeps failing) and the pending factions carry on once one succeeds
 
 Example usage
 -------------
@@ -17,6 +60,11 @@ python SetFactionNativeSystem.py factions.txt ^
   --conn "Driver={ODBC Driver 18 for SQL Server};Server=localhost;Database=EliteDB;Trusted_Connection=yes;Encrypt=yes;TrustServerCertificate=yes" ^
   -o update_native_system_ids.sql
 
+# Concurrent lookups (8 workers, at most 3 requests/second to EDSM):
+# python SetFactionNativeSystem.py factions.txt --conn "..." --workers 8 --rate 3
+# Async engine (16 requests in flight, same rate cap):
+# python SetFactionNativeSystem.py factions.txt --conn "..." --engine async --concurrency 16 --rate 3
+
 # SQL auth example:
 # --conn "Driver={ODBC Driver 18 for SQL Server};Server=localhost;Database=EliteDB;Uid=sa;Pwd=YourStrong!Passw0rd;Encrypt=yes;TrustServerCertificate=yes"
 """
@@ -27,16 +75,32 @@ import time
 import html
 import logging
 from pathlib import Path
-from typing import Iterable, Tuple, Optional, Set, List, Dict
+from typing import Iterable, Tuple, Optional, List, Dict, Union
 from urllib.parse import quote_plus, urljoin
 import re
 from datetime import datetime
 
 import requests
-from bs4 import BeautifulSoup
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
+from ScraperCommon import (
+    CacheMiss, CircuitOpen, FactionMatch, Fetcher, GroupCommit, ProgressJournal,
+    DbWriter, FactionUpdate, add_apply_arguments, add_live_apply_arguments, apply_faction_updates,
+    LazySystemMap, SystemSnapshot, add_system_map_arguments, iter_rows, system_map_mode, system_snapshot_path,
+    SystemResolver, add_system_match_arguments,
+    add_breaker_arguments, add_pacing_arguments, add_watch_arguments, run_watch, split_rechecks, stale_seconds,
+    watch_due_in, watch_journals, ends_with_commit, transaction_start,
+    AllFound, add_cache_arguments, add_commit_arguments, add_parser_arguments, add_stream_arguments,
+    ValuesBlock, add_output_format_arguments, merge_preamble, merge_trailer, output_format_of,
+    fast_flag, fast_label_value, make_soup, use_parser,
+    run_async_lookups, run_ordered, widen_connection_pool,
+    STATUS_MISS, STATUS_NONPLAYER, STATUS_UPDATE,
+)
+from SetFactionIsPlayer_EDSM import (
+    ensure_header as ensure_isplayer_header, make_update_isplayer, parse_player_flag,
+)
+
 try:
     import pyodbc  # SQL Server driver
 except Exception as e:
@@ -66,6 +130,9 @@ no_retry = Retry(total=0, connect=0, read=0, allowed_methods=("GET",), raise_on_
 details_session.mount("https://", HTTPAdapter(max_retries=no_retry))
 details_session.mount("http://", HTTPAdapter(max_retries=no_retry))
 
+# Cache + rate limit for every GET; configured in main(). Shared by all --workers threads.
+fetcher = Fetcher("edsm")
+
 # --- Helpers --------------------------------------------------------------------
 
 def escape_sql_literal(value: str) -> str:
@@ -77,19 +144,34 @@ def read_faction_names(path: Path) -> List[str]:
 def _norm(s: str) -> str:
     return re.sub(r"\s+", " ", s).strip().lower()
 
+def search_url(faction_name: str) -> str:
+    return f"{BASE}/en/search/factions/index/name/{quote_plus(faction_name)}"
+
 def search_faction(faction_name: str, timeout: float = 25.0) -> Optional[str]:
     """
     Use EDSM's name-index search to find the canonical ID-based page:
     /en/faction/id/<id>/name/<slug>
     Returns absolute URL or None.
     """
-    q = quote_plus(faction_name)
-    url = f"{BASE}/en/search/factions/index/name/{q}"
-    r = search_session.get(url, timeout=timeout)
-    if r.status_code != 200:
+    url = fetcher.indexed_url(faction_name)
+    if url:
+        return url
+    url = search_url(faction_name)
+    status, text = fetcher.search(search_session, url, timeout=timeout)
+    if status != 200:
         return None
+    match = fetcher.parse(url, text, pick_faction_match, faction_name)
+    if match is None:
+        return None
+    fetcher.remember(faction_name, match)
+    return match[0]
 
-    soup = BeautifulSoup(r.text, "html.parser")
+def pick_faction_match(search_html: str, faction_name: str) -> Optional[FactionMatch]:
+    """
+    Pick the details URL from a search results page: exact (normalised) name match,
+    else the first candidate. Returns (details_url, candidate_text, exact) or None.
+    """
+    soup = make_soup(search_html)
     candidates: list[tuple[str, str]] = []
 
     for a in soup.select("a[href]"):
@@ -104,11 +186,20 @@ def search_faction(faction_name: str, timeout: float = 25.0) -> Optional[str]:
     target = _norm(faction_name)
     for text, full in candidates:
         if _norm(text) == target:
-            return full
-    return candidates[0][1]
+            return full, text, True
+    return candidates[0][1], candidates[0][0], False
+
+HOME_LABEL = r"Home\s+system"
+PLAYER_LABEL = r"Player\s+faction"
 
 def parse_home_system_and_player(html_text: str) -> tuple[Optional[str], Optional[bool]]:
-    soup = BeautifulSoup(html_text, "html.parser")
+    # Raw-HTML fast path first; the soup below is only built for fields it can't read.
+    home = fast_label_value(html_text, HOME_LABEL, anchor=True)
+    is_player = fast_flag(html_text, PLAYER_LABEL)
+    if home and is_player is not None:
+        return home, is_player
+
+    soup = make_soup(html_text)
 
     def value_after_label(label: str) -> Optional[str]:
         for b in soup.select("b, strong"):
@@ -127,9 +218,9 @@ def parse_home_system_and_player(html_text: str) -> tuple[Optional[str], Optiona
                 return html.unescape(a.get_text(strip=True))
         return None
 
-    home = value_after_label("Home system")
-    pf_text = value_after_label("Player faction")
-    is_player: Optional[bool] = None
+    if not home:
+        home = value_after_label("Home system")
+    pf_text = value_after_label("Player faction") if is_player is None else None
     if pf_text:
         low = pf_text.strip().lower()
         if low.startswith("yes"):
@@ -140,11 +231,32 @@ def parse_home_system_and_player(html_text: str) -> tuple[Optional[str], Optiona
     return home, is_player
 
 def fetch_details_html(details_url: str, timeout: float = 75.0) -> Optional[str]:
-    r = details_session.get(details_url, timeout=timeout)
-    if r.status_code == 404:
+    status, text = fetcher.get(details_session, details_url, timeout=timeout, complete=details_complete)
+    if status == 404:
         return None
-    r.raise_for_status()
-    return r.text
+    if status >= 400:
+        raise requests.HTTPError(f"{status} error for url: {details_url}")
+    return text
+
+NO_SYSTEM_REASON = "no 'Home system' field"
+
+def shows_home_system(html_text: str) -> bool:
+    return fast_label_value(html_text, HOME_LABEL, anchor=True) is not None
+
+def shows_player_flag(html_text: str) -> bool:
+    return fast_flag(html_text, PLAYER_LABEL) is not None
+
+# True once a (possibly partial) details page already shows the home system and player flag.
+details_complete = AllFound(shows_home_system, shows_player_flag)
+
+def interpret_details(html_text: str) -> tuple[Optional[str], Optional[bool], Optional[str]]:
+    home, is_player = parse_home_system_and_player(html_text)
+    if is_player is None:
+        # Same parser as the IsPlayer script, so --isplayer-output matches its results.
+        is_player = parse_player_flag(html_text)
+    if home:
+        return home, is_player, None
+    return None, is_player, NO_SYSTEM_REASON
 
 def fetch_home_system_and_player(
     faction_name: str,
@@ -172,17 +284,17 @@ def fetch_home_system_and_player(
         try:
             html_text = fetch_details_html(details_url, timeout=details_timeout)
             if not html_text:
+                fetcher.forget(faction_name)
                 return None, None, "details 404"
-            home, is_player = parse_home_system_and_player(html_text)
-            if home:
-                return home, is_player, None
-            return None, None, "no 'Home system' field"
+            return fetcher.parse(details_url, html_text, interpret_details)
         except requests.exceptions.ReadTimeout:
             last_exc = "read-timeout"
+        except (CacheMiss, CircuitOpen):
+            raise
         except Exception as e:
             last_exc = str(e)
 
-        time.sleep(1.2 * attempt)
+        time.sleep(fetcher.pause(1.2 * attempt))
 
     reason = "timeout" if last_exc == "read-timeout" else f"error: {last_exc}"
     return None, None, reason
@@ -202,18 +314,41 @@ def load_system_map(cnx, table: str = "ref.System", id_col: str = "SystemID", na
     cur = cnx.cursor()
     cur.execute(sql)
     mapping: Dict[str, int] = {}
-    for sid, sname in cur.fetchall():
+    for sid, sname in iter_rows(cur):
         if sname is None:
             continue
         mapping[str(sname).strip().lower()] = int(sid)
     cur.close()
     return mapping
 
-def resolve_system_id(system_map: Dict[str, int], system_name: Optional[str]) -> Optional[int]:
+def resolve_system_id(system_map: Union[Dict[str, int], LazySystemMap, SystemSnapshot], system_name: Optional[str]) -> Optional[int]:
     if not system_name:
         return None
     return system_map.get(system_name.strip().lower())
 
+def apply_to_db(connection_string: str, updates: List[FactionUpdate], batch_size: int) -> int:
+    """--apply: bulk-write the run's results into ref.Faction. Returns a main() exit code."""
+    try:
+        cnx = connect_db(connection_string)
+    except Exception as e:
+        logging.error("Could not connect to SQL Server with provided --conn: %s", e)
+        return 3
+    try:
+        updated = apply_faction_updates(
+            cnx, updates, batch_size,
+            on_batch=lambda staged, hit: logging.info("… applied batch: %d staged, %d ref.Faction rows updated", staged, hit),
+        )
+    except Exception as e:
+        logging.error("Bulk apply to ref.Faction failed: %s", e)
+        return 6
+    finally:
+        try:
+            cnx.close()
+        except Exception:
+            pass
+    logging.info("✔ Applied %d results to ref.Faction (%d rows updated).", len(updates), updated)
+    return 0
+
 # ------------- SQL block creation ------------------------------------------------
 
 def make_update_sql_literal_id(faction_name: str, system_id: int, is_player: Optional[bool]) -> str:
@@ -235,27 +370,19 @@ def make_update_sql_literal_id(faction_name: str, system_id: int, is_player: Opt
 
 HEADER_LINE = "-- Generated by SetFactionNativeSystem.py (ID-based, player-aware)"
 
-def ensure_header(out_path: Path) -> None:
+def ensure_header(out_path: Path, preamble: Iterable[str] = ()) -> None:
     if not out_path.exists() or out_path.stat().st_size == 0:
         lines = [
             HEADER_LINE,
             f"-- Started: {datetime.now().isoformat(timespec='seconds')}",
             "BEGIN TRAN;",
             "",
+            *preamble,
             "-- This file is written incrementally; safe to resume after interruption.",
             "",
         ]
         append_lines(out_path, lines)
 
-def has_commit(out_path: Path) -> bool:
-    if not out_path.exists():
-        return False
-    try:
-        txt = out_path.read_text(encoding="utf-8", errors="ignore")
-        return "COMMIT;" in txt
-    except Exception:
-        return False
-
 def append_lines(out_path: Path, lines: Iterable[str]) -> None:
     out_path.parent.mkdir(parents=True, exist_ok=True)
     with open(out_path, "a", encoding="utf-8", newline="\n") as f:
@@ -264,50 +391,6 @@ def append_lines(out_path: Path, lines: Iterable[str]) -> None:
         f.flush()
         os.fsync(f.fileno())
 
-def load_processed_names(out_path: Path, all_names: List[str], treat_miss_as_processed: bool = True) -> Set[str]:
-    """
-    Consider a faction 'processed' if its UPDATE already exists
-    (identified by the exact WHERE clause). If treat_miss_as_processed is True,
-    also treat any '-- MISS: <name>' or '-- RETRY MISS: <name>' as processed.
-    """
-    processed: Set[str] = set()
-    if not out_path.exists():
-        return processed
-    txt = out_path.read_text(encoding="utf-8", errors="ignore")
-    for name in all_names:
-        escaped = escape_sql_literal(name)
-        where_sig = f"WHERE f.FactionName = '{escaped}';"
-        if where_sig in txt:
-            processed.add(name)
-            continue
-        if treat_miss_as_processed:
-            if f"-- MISS: {name}" in txt or f"-- RETRY MISS: {name}" in txt:
-                processed.add(name)
-    return processed
-
-def load_miss_names(out_path: Path, all_names: List[str]) -> Set[str]:
-    """
-    Return set of faction names that appear as MISS (or RETRY MISS) in the output SQL.
-    Only keep names that are present in all_names (input file).
-    """
-    misses: Set[str] = set()
-    if not out_path.exists():
-        return misses
-
-    name_set = set(all_names)
-    for line in out_path.read_text(encoding="utf-8", errors="ignore").splitlines():
-        line = line.strip()
-        if line.startswith("-- MISS: ") or line.startswith("-- RETRY MISS: "):
-            raw = line.split(": ", 1)[1]  # "<name>" or "<name> (reason)"
-            name_only = raw
-            idx = raw.rfind(" (")
-            if idx != -1 and raw.endswith(")"):
-                name_only = raw[:idx]
-            candidate = name_only.strip()
-            if candidate in name_set:
-                misses.add(candidate)
-    return misses
-
 # ------------- Main --------------------------------------------------------------
 
 def main(argv: list[str]) -> int:
@@ -319,8 +402,8 @@ def main(argv: list[str]) -> int:
     parser.add_argument("input", help="UTF-8 text file of faction names (one per line).")
     parser.add_argument("-o", "--output", default="update_native_system_ids.sql",
                         help="Output .sql file (appended incrementally).")
-    parser.add_argument("--conn", required=True,
-                        help="ODBC connection string for SQL Server (pyodbc).")
+    parser.add_argument("--conn", default=None,
+                        help="ODBC connection string for SQL Server (pyodbc); optional with a system snapshot.")
     parser.add_argument("--system-table", default="ref.System",
                         help="Table holding systems (default: ref.System)")
     parser.add_argument("--system-id-col", default="SystemID",
@@ -328,7 +411,17 @@ def main(argv: list[str]) -> int:
     parser.add_argument("--system-name-col", default="SystemName",
                         help="System name column name (default: SystemName)")
     parser.add_argument("--sleep", type=float, default=0.4,
-                        help="Delay between lookups in seconds.")
+                        help="Delay between lookups in seconds (sequential mode only).")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of concurrent lookups (default: 1 = sequential).")
+    parser.add_argument("--engine", choices=["sync", "async"], default="sync",
+                        help="sync = requests (optionally with --workers); async = aiohttp event loop.")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="With --engine async: max HTTP requests in flight at once.")
+    parser.add_argument("--rate", type=float, default=2.0,
+                        help="With --workers > 1 or --engine async: max requests per second to edsm.net; with --adaptive: the starting pace.")
+    parser.add_argument("--burst", type=float, default=1.0,
+                        help="With --workers > 1 or --engine async: requests allowed back-to-back before --rate applies.")
     parser.add_argument("--search-timeout", type=float, default=25.0,
                         help="Seconds allowed for the search page.")
     parser.add_argument("--details-timeout", type=float, default=75.0,
@@ -341,100 +434,416 @@ def main(argv: list[str]) -> int:
                         help="Do not auto-append COMMIT; even if all names are processed.")
     parser.add_argument("--retry-misses", action="store_true",
                         help="Process only factions previously marked as MISS in the output SQL.")
+    parser.add_argument("--isplayer-output", default=None,
+                        help="Also write SetFactionIsPlayer_EDSM.py-style SQL (IsPlayer only) to this file from the same page fetch.")
+    parser.add_argument("--set-nonplayer", action="store_true",
+                        help="With --isplayer-output: write UPDATE IsPlayer = 0 for 'No' instead of a NONPLAYER note.")
+    add_cache_arguments(parser)
+    add_commit_arguments(parser)
+    add_parser_arguments(parser)
+    add_stream_arguments(parser)
+    add_pacing_arguments(parser)
+    add_breaker_arguments(parser)
+    add_apply_arguments(parser)
+    add_live_apply_arguments(parser)
+    add_output_format_arguments(parser)
+    add_watch_arguments(parser)
+    add_system_map_arguments(parser)
+    add_system_match_arguments(parser)
     args = parser.parse_args(argv[1:])
 
     logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
+    try:
+        fetcher.configure_cache(args)
+        fetcher.configure_pacing(args, search_session, details_session, note=logging.info)
+        fetcher.configure_breaker(args, note=logging.info)
+        use_parser(args.parser)
+    except ValueError as e:
+        logging.error("%s", e)
+        return 2
+
+    if (args.apply or args.apply_live or args.rebuild_system_snapshot) and not args.conn:
+        logging.error("--apply, --apply-live and --rebuild-system-snapshot need --conn.")
+        return 2
+
+    if args.watch:
+        if args.retry_misses:
+            logging.error("--watch cannot be combined with --retry-misses.")
+            return 2
+        journals = watch_journals([Path(p) for p in (args.output, args.isplayer_output) if p])
+        deferred: Dict[str, float] = {}
+        return run_watch(
+            lambda: run_pass(args, deferred),
+            lambda: watch_due_in(journals, read_faction_names(Path(args.input)), stale_seconds(args), deferred),
+            args.watch_poll, logging.info,
+        )
+    return run_pass(args)
+
+def run_pass(args, deferred: Optional[Dict[str, float]] = None) -> int:
+    """
+    One pass over the input file: look up every faction without a (fresh enough) result.
+    With --watch, names it cannot settle (not cached with --offline, no answer from the site)
+    go into deferred, so the watch looks at them again a --watch-poll later instead of at once.
+    """
+    if deferred is not None:
+        deferred.clear()
     names = read_faction_names(Path(args.input))
     if not names:
         logging.error("No faction names found in %s", args.input)
         return 2
 
-    # --- DB connect + load System map
-    try:
-        cnx = connect_db(args.conn)
-    except Exception as e:
-        logging.error("Could not connect to SQL Server with provided --conn: %s", e)
-        return 3
-
-    try:
-        system_map = load_system_map(cnx, table=args.system_table, id_col=args.system_id_col, name_col=args.system_name_col)
-    except Exception as e:
-        logging.error("Failed to load system map from %s: %s", args.system_table, e)
-        return 4
-    finally:
-        try:
-            cnx.close()
-        except Exception:
-            pass
-
     out_path = Path(args.output)
-    ensure_header(out_path)
+    isplayer_path = Path(args.isplayer_output) if args.isplayer_output else None
+    merge = args.output_format == "merge"
+    for path in filter(None, (out_path, isplayer_path)):
+        started_as = output_format_of(path)
+        if started_as and started_as != args.output_format:
+            logging.error("%s was started with --output-format %s; keep that format or pick a new file.", path, started_as)
+            return 2
+
+    journal = ProgressJournal.for_output(out_path, names)
+    isplayer_journal = ProgressJournal.for_output(isplayer_path, names) if isplayer_path else None
 
     if args.retry_misses:
-        prior_misses = load_miss_names(out_path, names)
-        if not prior_misses:
+        prior_misses = journal.misses(names)
+        isplayer_todo = isplayer_journal.misses(names) if isplayer_journal else set()
+        if not prior_misses and not isplayer_todo:
             logging.info("No prior MISS entries found in %s. Nothing to retry.", out_path)
             return 0
-        already_updates = load_processed_names(out_path, list(prior_misses), treat_miss_as_processed=False)
-        to_process = [n for n in names if n in prior_misses and n not in already_updates]
+        native_todo = prior_misses
+        to_process = [n for n in names if n in native_todo or n in isplayer_todo]
+        isplayer_total = len(isplayer_todo)
+        isplayer_done = 0
         total = len(to_process)
         done = 0
         logging.info("Retrying %d previously missed factions…", total)
     else:
-        already = load_processed_names(out_path, names, treat_miss_as_processed=True)
-        to_process = [n for n in names if n not in already]
+        already = journal.processed(names, max_age=stale_seconds(args))
+        native_todo = {n for n in names if n not in already}
+        isplayer_already = isplayer_journal.processed(names, max_age=stale_seconds(args)) if isplayer_journal else set(names)
+        isplayer_todo = {n for n in names if n not in isplayer_already}
+        to_process = [n for n in names if n in native_todo or n in isplayer_todo]
+        isplayer_total = len(names)
+        isplayer_done = len(isplayer_already)
         total = len(names)
         done = len(already)
         logging.info("Looking up home systems on EDSM for %d factions…", total)
         if already:
             logging.info("Resuming: %d/%d already present in output.", done, total)
 
-    updates_this_run = 0
-    misses_this_run = 0
+    # --watch: first-time names go through the engine; stale results are re-checked after them.
+    to_process, rechecks, recheck_pause = split_rechecks(args, to_process, [journal] + ([isplayer_journal] if isplayer_journal else []), len(names))
 
-    for name in to_process:
-        logging.info("… %s → (searching %d/%d)", name, (done + 1 if not args.retry_misses else done + 1), (total if not args.retry_misses else total))
+    # DB: load all of ref.System, resolve systems as pages name them, or use the local snapshot
+    snapshot_path = system_snapshot_path(args)
+    lookups = len(to_process) + len(rechecks)
+    map_mode = system_map_mode(args.system_map, lookups, snapshot_path,
+                               explicit=bool(args.system_snapshot), connected=bool(args.conn))
+    if map_mode == "snapshot" and snapshot_path is None:
+        logging.error("--system-map snapshot needs --system-snapshot or --cache-dir.")
+        return 2
+    if map_mode != "snapshot" and not args.conn:
+        logging.error("--conn is required unless a system snapshot is used (--system-snapshot or --cache-dir).")
+        return 2
 
-        home, is_player, miss_reason = fetch_home_system_and_player(
-            name,
-            search_timeout=args.search_timeout,
-            details_timeout=args.details_timeout,
-            max_retries=args.retries,
-            hard_deadline_secs=args.hard_timeout,
-        )
+    cnx = None
+    if args.conn:
+        try:
+            cnx = connect_db(args.conn)
+        except Exception as e:
+            if map_mode != "snapshot":
+                logging.error("Could not connect to SQL Server with provided --conn: %s", e)
+                return 3
+            logging.warning("Could not connect to SQL Server (%s); using the system snapshot as it is.", e)
 
-        if home:
-            sys_id = resolve_system_id(system_map, home)
-            if sys_id is not None:
-                tag = " (player)" if is_player else ""
-                logging.info("✔ %s → %s [SystemID=%d]%s", name, home, sys_id, tag)
-                header = f"-- {'RETRY UPDATE' if args.retry_misses else 'UPDATE'} for faction: {name} (System='{home}', SystemID={sys_id})"
-                block = [header, make_update_sql_literal_id(name, sys_id, is_player), ""]
-                append_lines(out_path, block)
-                updates_this_run += 1
-            else:
-                # SystemName from EDSM not present in DB
-                reason = f"system '{home}' not in DB"
-                logging.info("✖ %s → (not found) (%s)", name, reason)
-                miss_header = f"-- {'RETRY MISS' if args.retry_misses else 'MISS'}: {name} ({reason})"
-                append_lines(out_path, [miss_header, ""])
-                misses_this_run += 1
+    try:
+        if map_mode == "snapshot":
+            system_map = SystemSnapshot(snapshot_path, table=args.system_table, id_col=args.system_id_col, name_col=args.system_name_col)
+            expired = system_map.expired(args.system_snapshot_hours * 3600.0)
+            if cnx is not None:
+                rebuild = args.rebuild_system_snapshot or expired
+                fetched = system_map.refresh(cnx, rebuild=rebuild)
+                logging.info("System snapshot: %s %d systems from %s.", "reloaded" if rebuild else "fetched",
+                             fetched, args.system_table)
+            elif system_map.max_id() is None:
+                raise RuntimeError(f"{snapshot_path} has no copy of it yet; run once with --conn")
+            elif expired:
+                logging.warning("System snapshot %s is older than %g hours; run with --conn to reload it.",
+                                snapshot_path, args.system_snapshot_hours)
+            logging.info("Resolving systems from %s (%d systems).", snapshot_path, system_map.count())
+        elif map_mode == "lazy":
+            system_map = LazySystemMap(cnx, table=args.system_table, id_col=args.system_id_col, name_col=args.system_name_col)
+            system_map.check()
+            logging.info("Resolving systems from %s on demand (%d factions to look up).", args.system_table, lookups)
         else:
-            reason = f"{miss_reason}" if miss_reason else "unknown"
-            logging.info("✖ %s → (not found) (%s)", name, reason)
-            miss_header = f"-- {'RETRY MISS' if args.retry_misses else 'MISS'}: {name} ({reason})"
-            append_lines(out_path, [miss_header, ""])
-            misses_this_run += 1
+            system_map = load_system_map(cnx, table=args.system_table, id_col=args.system_id_col, name_col=args.system_name_col)
+    except Exception as e:
+        logging.error("Failed to load system map from %s: %s", args.system_table, e)
+        if cnx is not None:
+            try:
+                cnx.close()
+            except Exception:
+                pass
+        return 4
+    if map_mode != "lazy" and cnx is not None:
+        # Everything needed is local now; lazy mode keeps the connection until the run ends.
+        try:
+            cnx.close()
+        except Exception:
+            pass
+
+    resolver = SystemResolver(lambda n: resolve_system_id(system_map, n), system_map.items,
+                              match=args.system_match, min_score=args.fuzzy_min_score,
+                              candidates=system_map.candidates if isinstance(system_map, LazySystemMap) else None)
+
+    ensure_header(out_path, merge_preamble() if merge else ())
+    if isplayer_path:
+        ensure_isplayer_header(isplayer_path, merge_preamble() if merge else ())
 
-        done += 1
-        time.sleep(args.sleep)
+    updates_this_run = 0
+    misses_this_run = 0
+
+    writer = GroupCommit(every=args.fsync_every, interval=args.fsync_interval)
+    # --output-format merge: UPDATE rows go to VALUES blocks that the writer flushes 1000 at a time.
+    out_values = ValuesBlock(out_path) if merge else None
+    isplayer_values = ValuesBlock(isplayer_path) if merge and isplayer_path else None
+    for values in filter(None, (out_values, isplayer_values)):
+        writer.attach(values)
+    journal.committer = writer
+    if isplayer_journal:
+        isplayer_journal.committer = writer
+    # An output whose last transaction is committed (an earlier pass) gets a new one, opened
+    # only once this pass has something to write.
+    committed = ends_with_commit(out_path)
+    isplayer_committed = isplayer_path is not None and ends_with_commit(isplayer_path)
+    for path in [out_path] * committed + [isplayer_path] * isplayer_committed:
+        writer.begin(path, transaction_start(merge_preamble() if merge else ()))
+
+    def changed(j: ProgressJournal, name: str, status: str, system_id: Optional[int] = None,
+                is_player: Optional[bool] = None) -> bool:
+        # A re-check that finds what the journal already has writes no SQL: the output has it
+        # from before. Only the journal entry is renewed.
+        return args.retry_misses or not j.unchanged(name, status, system_id, is_player)
+
+    @fetcher.pausing(miss=lambda reason: (None, None, reason))
+    def lookup(name: str) -> Optional[tuple[Optional[str], Optional[bool], Optional[str]]]:
+        try:
+            return fetch_home_system_and_player(
+                name,
+                search_timeout=args.search_timeout,
+                details_timeout=args.details_timeout,
+                max_retries=args.retries,
+                hard_deadline_secs=args.hard_timeout,
+            )
+        except CacheMiss:
+            return None
+
+    def record_isplayer(name: str, is_player: Optional[bool], miss_reason: Optional[str], elapsed: Optional[float]) -> None:
+        # Mirrors the IsPlayer script's record(); miss_reason is only set when the page itself failed.
+        nonlocal isplayer_done
+        if is_player is True:
+            if changed(isplayer_journal, name, STATUS_UPDATE, is_player=True):
+                if isplayer_values is not None:
+                    isplayer_values.add(name, None, True)
+                else:
+                    writer.add(isplayer_path, [f"-- UPDATE IsPlayer for faction: {name} (Player=Yes)", make_update_isplayer(name, 1), ""])
+                if db_writer is not None:
+                    db_writer.put((name, None, True))
+            isplayer_journal.record(name, STATUS_UPDATE, is_player=True, latency=elapsed, retry=args.retry_misses)
+        elif is_player is False and args.set_nonplayer:
+            if changed(isplayer_journal, name, STATUS_UPDATE, is_player=False):
+                if isplayer_values is not None:
+                    isplayer_values.add(name, None, False)
+                else:
+                    writer.add(isplayer_path, [f"-- UPDATE IsPlayer for faction: {name} (Player=No)", make_update_isplayer(name, 0), ""])
+                if db_writer is not None:
+                    db_writer.put((name, None, False))
+            isplayer_journal.record(name, STATUS_UPDATE, is_player=False, latency=elapsed, retry=args.retry_misses)
+        elif is_player is False:
+            if changed(isplayer_journal, name, STATUS_NONPLAYER, is_player=False):
+                writer.add(isplayer_path, [f"-- NONPLAYER: {name} (Player=No)", ""])
+            isplayer_journal.record(name, STATUS_NONPLAYER, is_player=False, latency=elapsed, retry=args.retry_misses)
+        else:
+            reason = miss_reason or "no 'Player faction' field"
+            if changed(isplayer_journal, name, STATUS_MISS):
+                writer.add(isplayer_path, [f"-- {'RETRY MISS' if args.retry_misses else 'MISS'}: {name} ({reason})", ""])
+            isplayer_journal.record(name, STATUS_MISS, reason=reason, latency=elapsed, retry=args.retry_misses)
+        isplayer_done += 1
+
+    def record(name: str, result: Optional[tuple[Optional[str], Optional[bool], Optional[str]]], elapsed: Optional[float] = None) -> None:
+        nonlocal done, updates_this_run, misses_this_run
+        if result is None:
+            logging.info("… %s → skipped (not cached with --offline, or no answer from the site)", name)
+            if deferred is not None:
+                deferred[name] = time.time() + args.watch_poll
+            return
+        home, is_player, miss_reason = result
+
+        if name in native_todo:
+            if home:
+                sys_id, matched = resolver.resolve(home)
+                if sys_id is not None:
+                    tag = " (player)" if is_player else ""
+                    via = f", {matched}" if matched else ""
+                    logging.info("✔ %s → %s [SystemID=%d%s]%s", name, home, sys_id, via, tag)
+                    if changed(journal, name, STATUS_UPDATE, sys_id, is_player):
+                        header = f"-- {'RETRY UPDATE' if args.retry_misses else 'UPDATE'} for faction: {name} (System='{home}', SystemID={sys_id}{via})"
+                        block = [header, make_update_sql_literal_id(name, sys_id, is_player), ""]
+                        if out_values is not None:
+                            out_values.add(name, sys_id, True if is_player is True else None)
+                        else:
+                            writer.add(out_path, block)
+                        if db_writer is not None:
+                            db_writer.put((name, sys_id, True if is_player is True else None))
+                        updates_this_run += 1
+                    journal.record(name, STATUS_UPDATE, system=home, system_id=sys_id, is_player=is_player,
+                                   latency=elapsed, retry=args.retry_misses)
+                else:
+                    # SystemName from EDSM not present in DB
+                    reason = matched or f"system '{home}' not in DB"
+                    logging.info("✖ %s → (not found) (%s)", name, reason)
+                    if changed(journal, name, STATUS_MISS, is_player=is_player):
+                        miss_header = f"-- {'RETRY MISS' if args.retry_misses else 'MISS'}: {name} ({reason})"
+                        writer.add(out_path, [miss_header, ""])
+                        misses_this_run += 1
+                    journal.record(name, STATUS_MISS, reason=reason, system=home, is_player=is_player,
+                                   latency=elapsed, retry=args.retry_misses)
+            else:
+                reason = f"{miss_reason}" if miss_reason else "unknown"
+                logging.info("✖ %s → (not found) (%s)", name, reason)
+                if changed(journal, name, STATUS_MISS):
+                    miss_header = f"-- {'RETRY MISS' if args.retry_misses else 'MISS'}: {name} ({reason})"
+                    writer.add(out_path, [miss_header, ""])
+                    misses_this_run += 1
+                journal.record(name, STATUS_MISS, reason=reason, latency=elapsed, retry=args.retry_misses)
+
+            done += 1
+        if name in isplayer_todo:
+            record_isplayer(name, is_player, miss_reason if miss_reason != NO_SYSTEM_REASON else None, elapsed)
+        writer.end_record()
+
+    # --apply-live: results go to ref.Faction in the background while scraping continues.
+    db_writer = None
+    live_failed = False
+    if args.apply_live:
+        db_writer = DbWriter(
+            lambda: connect_db(args.conn), batch_size=args.apply_batch, interval=args.apply_interval,
+            writers=args.apply_writers,
+            on_batch=lambda staged, hit: logging.info("… live apply: %d staged, %d ref.Faction rows updated", staged, hit),
+        )
 
-    if not args.retry_misses:
-        if done == total and not has_commit(out_path) and not args.no_commit:
-            append_lines(out_path, ["-- Completed: " + datetime.now().isoformat(timespec="seconds"), "COMMIT;", ""])
+    try:
+        if args.retry_misses:
+            # The page already named a system the DB lacked; re-resolving it needs no refetch.
+            local = [n for n in to_process if n not in isplayer_todo and journal.latest.get(n, {}).get("system")]
+            for name in local:
+                entry = journal.latest[name]
+                record(name, (entry["system"], entry.get("is_player"), None))
+            if local:
+                logging.info("Re-resolved %d journalled systems without fetching their pages again.", len(local))
+                resolved = set(local)
+                to_process = [n for n in to_process if n not in resolved]
+
+        if args.engine == "async":
+            logging.info("Async engine: up to %d requests in flight at %.2f requests/second.", args.concurrency, args.rate)
+            fetcher.rate_limit(args.rate, args.burst)
+            try:
+                run_async_lookups(
+                    to_process, record,
+                    headers=HEADERS,
+                    search_url=search_url,
+                    pick_match=pick_faction_match,
+                    interpret_details=interpret_details,
+                    miss=lambda reason: (None, None, reason),
+                    search_timeout=args.search_timeout,
+                    details_timeout=args.details_timeout,
+                    max_retries=args.retries,
+                    hard_deadline_secs=args.hard_timeout,
+                    retry_pause=1.2,
+                    concurrency=args.concurrency,
+                    fetcher=fetcher,
+                    details_complete=details_complete,
+                )
+            except RuntimeError as e:
+                logging.error("%s", e)
+                return 5
+        elif args.workers > 1:
+            fetcher.rate_limit(args.rate, args.burst)
+            widen_connection_pool(search_session, args.workers)
+            widen_connection_pool(details_session, args.workers)
+            logging.info("Using %d workers at up to %.2f requests/second.", args.workers, args.rate)
+
+            def lookup_logged(name: str):
+                logging.info("… %s → (searching)", name)
+                return lookup(name)
+
+            run_ordered(lookup_logged, to_process, args.workers, record)
+        else:
+            for name in to_process:
+                logging.info("… %s → (searching %d/%d)", name, (done + 1 if not args.retry_misses else done + 1), (total if not args.retry_misses else total))
+                start = time.monotonic()
+                result = lookup(name)
+                record(name, result, time.monotonic() - start)
+                time.sleep(fetcher.pause(args.sleep))
+
+        # --watch: stale results, oldest first, spread out over the staleness window.
+        for name in rechecks:
+            logging.info("… %s → (re-checking)", name)
+            start = time.monotonic()
+            result = lookup(name)
+            record(name, result, time.monotonic() - start)
+            time.sleep(recheck_pause)
+    finally:
+        writer.close()
+        if db_writer is not None:
+            try:
+                db_writer.close()
+            except Exception as e:
+                logging.error("Live apply to ref.Faction failed: %s", e)
+                live_failed = True
+        if map_mode == "lazy":
+            logging.info("Looked up %d distinct systems in %s.", system_map.queries, args.system_table)
+            try:
+                cnx.close()
+            except Exception:
+                pass
+        elif map_mode == "snapshot":
+            system_map.close()
+        journal.committer = None
+        journal.compact()
+        if isplayer_journal:
+            isplayer_journal.committer = None
+            isplayer_journal.compact()
+
+    # Close the transaction this pass opened, or the file's first one once every name is done.
+    completing = out_path in writer.begun or (not args.retry_misses and done == total and not committed)
+    isplayer_completing = isplayer_path is not None and (
+        isplayer_path in writer.begun
+        or (not args.retry_misses and isplayer_done == isplayer_total and not isplayer_committed))
+    # Merge format: apply whatever this (or an interrupted earlier) run staged.
+    if out_values is not None and (out_values.written or completing):
+        append_lines(out_path, merge_trailer())
+    if isplayer_values is not None and (isplayer_values.written or isplayer_completing):
+        append_lines(isplayer_path, merge_trailer())
+    if completing and not args.no_commit:
+        append_lines(out_path, ["-- Completed: " + datetime.now().isoformat(timespec="seconds"), "COMMIT;", ""])
+    if isplayer_completing and not args.no_commit:
+        append_lines(isplayer_path, ["-- Completed: " + datetime.now().isoformat(timespec="seconds"), "COMMIT;", ""])
 
     logging.info("Run complete. Appended %d updates, %d misses.", updates_this_run, misses_this_run)
+    if db_writer is not None and not live_failed:
+        logging.info("✔ Live-applied %d results to ref.Faction (%d rows updated).", db_writer.staged, db_writer.updated)
+    if live_failed:
+        return 6
+
+    if args.apply:
+        # NativeSystem UPDATEs only ever set IsPlayer = 1; the IsPlayer journal also has the 0s.
+        updates = [(e["name"], e.get("system_id"), True if e.get("is_player") is True else None)
+                   for e in journal.updates(names)]
+        if isplayer_journal:
+            updates += [(e["name"], None, e.get("is_player")) for e in isplayer_journal.updates(names)]
+        return apply_to_db(args.conn, updates, args.apply_batch)
     return 0
 
 if __name__ == "__main__":
@@ -0,0 +1,872 @@
+# Tests for ScraperCommon.py helpers that need no network or database.
+# Run from this folder: python -m unittest test_ScraperCommon  (or: python -m pytest)
+
+import os
+import random
+import shutil
+import tempfile
+import time
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import requests
+
+import ScraperCommon as sc
+
+
+def brute_force(index, name, min_score):
+    """What SystemNameIndex.lookup must return, by scoring every name."""
+    key = sc.system_name_key(name)
+    if key in index.by_key or not key:
+        return index.lookup(name, min_score)
+    query = sc._trigrams(key)
+    floor = max(0.05, min_score - sc.FUZZY_AMBIGUITY_MARGIN)
+    scored = []
+    for other, entries in index.by_key.items():
+        grams = sc._trigrams(other)
+        score = 2 * len(query & grams) / (len(query) + len(grams))
+        if score >= floor:
+            scored.append((score, entries[0]))
+    scored.sort(key=lambda item: (-item[0], index.keys[item[1]]))
+    if not scored or scored[0][0] < min_score:
+        return None
+    best_score, best = scored[0]
+    rivals = [index.names[i] for score, i in scored[1:]
+              if best_score - score <= sc.FUZZY_AMBIGUITY_MARGIN and index.ids[i] != index.ids[best]]
+    rivals += [index.names[i] for i in index.by_key[index.keys[best]][1:]]
+    return sc.SystemMatch(None if rivals else index.ids[best], index.names[best], best_score, rivals)
+
+
+class FakeClock:
+    """Stands in for time.monotonic; tests move it forward by hand."""
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TokenBucketTests(unittest.TestCase):
+    def test_burst_then_one_token_per_interval(self):
+        clock = FakeClock()
+        with mock.patch.object(sc.time, "monotonic", clock):
+            bucket = sc.TokenBucket(rate=4, burst=2)
+            self.assertEqual([bucket.reserve() for _ in range(4)], [0.0, 0.0, 0.25, 0.5])
+            clock.now += 10
+            # Refill is capped at the burst, however long the bucket sat idle.
+            self.assertEqual([bucket.reserve() for _ in range(3)], [0.0, 0.0, 0.25])
+
+    def test_rate_holds_across_threads(self):
+        bucket = sc.TokenBucket(rate=50)
+        stamps = []
+        lock = threading.Lock()
+
+        def take():
+            for _ in range(5):
+                bucket.acquire()
+                with lock:
+                    stamps.append(time.monotonic())
+
+        threads = [threading.Thread(target=take) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stamps.sort()
+        # 20 tokens at 50/s with a burst of 1: at least 19 intervals of 20 ms.
+        self.assertGreaterEqual(stamps[-1] - stamps[0], 19 / 50 - 0.02)
+
+
+class AdaptivePacerTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(sc.time, "monotonic", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pacer = sc.AdaptivePacer(rate=2.0, min_rate=0.5, max_rate=3.0, step=0.5, cooldown=2.0)
+
+    def test_speeds_up_on_answers_and_halves_on_failures(self):
+        pacer = self.pacer
+        for _ in range(4):
+            pacer.observe(200, 0.1)
+        self.assertEqual(pacer.rate, 3.0)  # max_rate
+        pacer.observe(503, 0.1)
+        self.assertEqual(pacer.rate, 1.5)
+        pacer.observe(None, 0.1)  # the same burst of failures: within the cooldown
+        self.assertEqual(pacer.rate, 1.5)
+        self.clock.now += 2
+        pacer.observe(429, 0.1)
+        self.assertEqual(pacer.rate, 0.75)
+        self.clock.now += 2
+        pacer.observe(500, 0.1)
+        self.assertEqual(pacer.rate, 0.5)  # min_rate
+
+    def test_slow_answer_counts_as_a_failure(self):
+        pacer = self.pacer
+        for _ in range(3):
+            pacer.observe(200, 0.5)
+        self.assertEqual(pacer.rate, 3.0)
+        pacer.observe(200, 1.2)  # slower, but not slow_factor times the average
+        self.assertEqual(pacer.rate, 3.0)
+        pacer.observe(200, 3.0)
+        self.assertEqual(pacer.rate, 1.5)
+
+    def test_requests_are_spaced_and_held_for_retry_after(self):
+        pacer = sc.AdaptivePacer(rate=4.0, min_rate=0.5, max_rate=8.0)
+        self.assertEqual([pacer.reserve() for _ in range(3)], [0.0, 0.25, 0.5])
+        self.clock.now += 1
+        pacer.observe(503, 0.1, retry_after="10")
+        self.assertEqual(pacer.rate, 2.0)
+        self.assertEqual([pacer.reserve() for _ in range(2)], [10.0, 10.5])
+        self.assertEqual(sc.parse_retry_after("120"), 120.0)
+        self.assertIsNone(sc.parse_retry_after("soon"))
+
+
+class RunOrderedTests(unittest.TestCase):
+    def test_results_arrive_in_input_order(self):
+        seen = []
+        sc.run_ordered(lambda n: time.sleep((n % 3) * 0.01) or n * n, range(12), 4,
+                       lambda item, result, elapsed: seen.append((item, result)))
+        self.assertEqual(seen, [(n, n * n) for n in range(12)])
+
+    def test_failure_stops_reporting_at_the_failing_item(self):
+        seen = []
+
+        def square(n):
+            if n == 5:
+                raise RuntimeError("boom")
+            return n * n
+
+        with self.assertRaises(RuntimeError):
+            sc.run_ordered(square, range(12), 3, lambda item, result, elapsed: seen.append(item))
+        self.assertEqual(seen, [0, 1, 2, 3, 4])
+
+
+def temp_dir(test: unittest.TestCase) -> Path:
+    folder = Path(tempfile.mkdtemp())
+    test.addCleanup(shutil.rmtree, folder)
+    return folder
+
+
+def noise(rng: random.Random, size: int) -> str:
+    """Text that zlib cannot shrink much, so stored sizes are predictable."""
+    return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz0123456789") for _ in range(size))
+
+
+class FakeResponse:
+    """Just enough of a requests.Response for Fetcher.get() (not streamed)."""
+
+    def __init__(self, status_code: int, text: str = "", headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+        self.encoding = "utf-8"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class FakeSession:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.sent = []  # the conditional headers of each GET
+
+    def get(self, url, timeout=None, stream=False, headers=None):
+        self.sent.append(headers)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class ResponseCacheTests(unittest.TestCase):
+    def open_cache(self, max_bytes: int = 1 << 20) -> sc.ResponseCache:
+        cache = sc.ResponseCache(temp_dir(self) / sc.CACHE_FILE_NAME, max_bytes)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_entries_expire_after_max_age(self):
+        cache = self.open_cache()
+        clock = FakeClock(1_700_000_000.0)
+        with mock.patch.object(sc.time, "time", clock):
+            cache.put("https://x/a", 200, "page")
+            clock.now += 3599
+            self.assertEqual(cache.get("https://x/a", 3600), (200, "page"))
+            clock.now += 2
+            self.assertIsNone(cache.get("https://x/a", 3600))
+            self.assertEqual(cache.get("https://x/a", None), (200, "page"))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        rng = random.Random(3)
+        cache = self.open_cache()
+        clock = FakeClock(1_700_000_000.0)
+        with mock.patch.object(sc.time, "time", clock):
+            for url in ("a", "b", "c"):
+                clock.now += 1
+                cache.put(url, 200, noise(rng, 3000))
+            # Room for three entries and a half: the fourth must push exactly one out.
+            cache.max_bytes = cache._total * 7 // 6
+            clock.now += 1
+            cache.get("a", None)  # "b" is now the least recently used
+            clock.now += 1
+            cache.put("d", 200, noise(rng, 3000))
+            self.assertIsNone(cache.get("b", None))
+            for url in ("a", "c", "d"):
+                self.assertIsNotNone(cache.get(url, None), url)
+            self.assertLessEqual(cache._total, cache.max_bytes)
+
+    def test_partial_body_needs_a_complete_check(self):
+        cache = self.open_cache()
+        cache.put("u", 200, "<head>only", partial=True)
+        self.assertIsNone(cache.get("u", None))
+        self.assertIsNone(cache.get("u", None, lambda text: "</body>" in text))
+        self.assertEqual(cache.get("u", None, lambda text: "<head>" in text), (200, "<head>only"))
+
+    def test_expired_entry_is_revalidated_with_its_validators(self):
+        cache = self.open_cache()
+        clock = FakeClock(1_700_000_000.0)
+        with mock.patch.object(sc.time, "time", clock):
+            cache.put("u", 200, "page", etag='"v1"', last_modified="Wed, 01 Oct 2025 00:00:00 GMT")
+            cache.put("v", 200, "page")
+            clock.now += 7200
+            self.assertIsNone(cache.get("u", 3600))
+            self.assertEqual(cache.revalidation("u"), (200, "page", {
+                "If-None-Match": '"v1"', "If-Modified-Since": "Wed, 01 Oct 2025 00:00:00 GMT"}))
+            self.assertIsNone(cache.revalidation("v"))
+            cache.touch("u")  # a 304 came back
+            self.assertEqual(cache.get("u", 3600), (200, "page"))
+
+    def test_not_modified_page_is_not_parsed_again(self):
+        fetcher = sc.Fetcher("test")
+        fetcher.cache = self.open_cache()
+        fetcher.cache_ttl = 3600
+        session = FakeSession(FakeResponse(200, "Player faction: Yes", {"ETag": '"v1"'}), FakeResponse(304),
+                              FakeResponse(200, "Player faction: No", {"ETag": '"v2"'}))
+        parsed = []
+
+        def interpret_flag(text):
+            parsed.append(text)
+            return text.endswith("Yes"), None
+
+        def lookup():
+            status, text = fetcher.get(session, "u", 10.0)
+            return fetcher.parse("u", text, interpret_flag)
+
+        clock = FakeClock(1_700_000_000.0)
+        with mock.patch.object(sc.time, "time", clock):
+            self.assertEqual(lookup(), (True, None))
+            self.assertEqual(lookup(), (True, None))  # fresh in the cache: no request
+            clock.now += 7200
+            self.assertEqual(lookup(), (True, None))  # 304
+            clock.now += 7200
+            self.assertEqual(lookup(), (False, None))  # changed: a new body, parsed again
+        self.assertEqual(session.sent, [None, {"If-None-Match": '"v1"'}, {"If-None-Match": '"v1"'}])
+        self.assertEqual(parsed, ["Player faction: Yes", "Player faction: No"])
+
+    def test_offline_miss_raises(self):
+        fetcher = sc.Fetcher("test")
+        fetcher.cache = self.open_cache()
+        fetcher.offline = True
+        fetcher.cache.put("u", 404, "gone")
+        self.assertEqual(fetcher.cached("u"), (404, "gone"))
+        with self.assertRaises(sc.CacheMiss):
+            fetcher.cached("v")
+
+
+class CircuitBreakerTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(sc.time, "monotonic", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.notes = []
+        self.breaker = sc.CircuitBreaker(threshold=3, cooldown=10.0, max_cooldown=30.0, note=self.notes.append)
+
+    def test_opens_probes_and_closes(self):
+        breaker = self.breaker
+        breaker.failure("h")
+        breaker.failure("h")
+        breaker.success("h")  # not consecutive: the count starts over
+        for _ in range(3):
+            breaker.allow("h")
+            breaker.failure("h")
+        self.assertEqual((breaker.trips, breaker.retry_in()), (1, 10.0))
+        with self.assertRaises(sc.CircuitOpen):
+            breaker.allow("h")
+        breaker.allow("other")  # circuits are per host
+        self.clock.now += 10
+        breaker.allow("h")  # the half-open probe
+        with self.assertRaises(sc.CircuitOpen):
+            breaker.allow("h")  # one probe at a time
+        breaker.failure("h")
+        self.assertEqual((breaker.trips, breaker.retry_in()), (2, 20.0))
+        self.clock.now += 20
+        breaker.allow("h")
+        breaker.failure("h")
+        self.assertEqual(breaker.retry_in(), 30.0)  # max_cooldown
+        self.clock.now += 30
+        breaker.allow("h")
+        breaker.success("h")
+        breaker.allow("h")
+        self.assertEqual((breaker.retry_in(), breaker.failing()), (0.0, False))
+        self.assertEqual([note.split(":")[0].split(" after")[0] for note in self.notes],
+                         ["Circuit for h open", "Circuit for h half-open", "Circuit for h open",
+                          "Circuit for h half-open", "Circuit for h open", "Circuit for h half-open",
+                          "Circuit for h closed"])
+
+    def test_answers_to_requests_sent_before_the_trip_are_ignored(self):
+        breaker = self.breaker
+        started = self.clock()
+        self.clock.now += 1
+        for _ in range(3):
+            breaker.failure("h")
+        breaker.success("h", started)  # a slow straggler neither closes the circuit...
+        with self.assertRaises(sc.CircuitOpen):
+            breaker.allow("h")
+        self.clock.now += 10
+        breaker.allow("h")
+        breaker.failure("h", started)  # ...nor counts as the probe
+        self.assertEqual(breaker.trips, 1)
+        breaker.success("h", self.clock())
+        self.assertEqual(breaker.retry_in(), 0.0)
+
+    def test_transient_failures_are_redone_not_missed(self):
+        fetcher = sc.Fetcher("test")
+        fetcher.breaker = self.breaker
+        answers = [sc.TransientFailure("search: HTTP 503")] * 2 + [(True, None)]
+
+        def lookup(name):
+            answer = answers.pop(0)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+
+        run = fetcher.pausing(lookup, miss=lambda reason: (None, reason))
+        with mock.patch.object(sc.time, "sleep") as sleep:
+            self.assertEqual(run("Alpha"), (True, None))
+            self.assertEqual(sleep.call_count, 2)
+            answers[:] = [sc.TransientFailure("search: ConnectionError")] * (sc.BREAKER_MAX_REDOS + 1)
+            self.assertIsNone(run("Alpha"))  # unsettled, not miss(...)
+            self.assertEqual(answers, [])
+        answers[:] = [sc.TransientFailure("search: HTTP 502")]
+        self.assertIsNone(sc.Fetcher("test").pausing(lookup, miss=lambda reason: (None, reason))("Alpha"))
+
+    def test_search_without_an_answer_is_transient(self):
+        fetcher = sc.Fetcher("test")
+        session = FakeSession(FakeResponse(503), FakeResponse(429),
+                              requests.exceptions.ConnectionError("refused"),
+                              requests.exceptions.RetryError("too many 500 error responses"),
+                              FakeResponse(404, "none"), FakeResponse(200, "<a>Alpha</a>"))
+        for _ in range(4):
+            with self.assertRaises(sc.TransientFailure):
+                fetcher.search(session, "u", 10.0)
+        self.assertEqual(fetcher.search(session, "u", 10.0), (404, "none"))
+        self.assertEqual(fetcher.search(session, "u", 10.0), (200, "<a>Alpha</a>"))
+
+
+class ScanOutputTests(unittest.TestCase):
+    def test_resume_points(self):
+        out = temp_dir(self) / "out.sql"
+        out.write_text("\n".join([
+            "BEGIN TRAN;",
+            "UPDATE f",
+            "SET f.NativeSystemID = 42, f.IsPlayer = 1",
+            "FROM ref.Faction AS f",
+            "WHERE f.FactionName = 'O''Neil Group';",
+            "-- MISS: Sons (of) Sol (not found (search))",
+            "-- RETRY MISS: Plain (no home system)",
+            "-- NONPLAYER: Blue (Cartel) (player faction: No)",
+            "INSERT INTO #FactionStaging (FactionName, NativeSystemID, IsPlayer) VALUES",
+            "(N'Row One', 7, NULL),",
+            "(N'Row Two', NULL, 0);",
+            "UPDATE f",
+            "SET f.NativeSystemID = 9",
+            "FROM ref.Faction AS f",
+            "WHERE f.FactionName = 'Torn",
+        ]), encoding="utf-8")
+        scan = sc.scan_output(out)
+        self.assertEqual(scan.updated, {"O'Neil Group", "Row One", "Row Two"})
+        self.assertEqual(scan.values, {"O'Neil Group": (42, True), "Row One": (7, None), "Row Two": (None, False)})
+        names = ["Sons (of) Sol", "Sons", "Plain", "Blue (Cartel)", "Blue", "Torn"]
+        self.assertEqual(scan.missed(names), {"Sons (of) Sol", "Plain"})
+        self.assertEqual(scan.nonplayer(names), {"Blue (Cartel)"})
+        self.assertFalse(scan.has_commit)
+        with open(out, "a", encoding="utf-8") as f:
+            f.write("';\nCOMMIT;\n")
+        scan = sc.scan_output(out)
+        self.assertIn("Torn", scan.updated)
+        self.assertTrue(scan.has_commit)
+
+    def test_missing_file_is_empty(self):
+        scan = sc.scan_output(temp_dir(self) / "none.sql")
+        self.assertEqual((scan.updated, scan.miss_payloads, scan.has_commit), (set(), [], False))
+
+    def test_ends_with_commit_looks_at_the_last_line(self):
+        out = temp_dir(self) / "out.sql"
+        self.assertFalse(sc.ends_with_commit(out))
+        out.write_text("BEGIN TRAN;\n" + "-- MISS: Alpha (unknown)\n" * 1000 + "COMMIT;\n\n", encoding="utf-8")
+        self.assertTrue(sc.ends_with_commit(out))
+        with open(out, "a", encoding="utf-8") as f:
+            f.write("\n".join(sc.transaction_start()) + "-- MISS: Beta (unknown)\n")
+        self.assertFalse(sc.ends_with_commit(out))
+
+
+class GroupCommitTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = temp_dir(self)
+        self.sql = self.folder / "out.sql"
+        self.journal = self.folder / "out.sql.progress.jsonl"
+        self.synced = []
+        self.writer = None
+        real_fsync = os.fsync
+
+        def fsync(fd):
+            # Name the file by the writer's open handle, so the order of the fsyncs shows.
+            self.synced.extend(path.name for path, f in self.writer._handles.items() if f.fileno() == fd)
+            real_fsync(fd)
+
+        patcher = mock.patch.object(sc.os, "fsync", fsync)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def record(self, writer, n):
+        writer.add(self.sql, [f"-- row {n}"])
+        writer.add(self.journal, [f'{{"name": "{n}"}}'])
+        writer.end_record()
+
+    def lines(self, path):
+        return path.read_text(encoding="utf-8").splitlines() if path.exists() else []
+
+    def test_every_n_records_share_one_fsync_per_file(self):
+        writer = self.writer = sc.GroupCommit(every=3)
+        for n in range(2):
+            self.record(writer, n)
+        self.assertEqual((self.synced, self.lines(self.sql)), ([], []))
+        self.record(writer, 2)
+        self.assertEqual(self.synced, ["out.sql", "out.sql.progress.jsonl"])
+        self.assertEqual(len(self.lines(self.sql)), 3)
+        self.assertEqual(len(self.lines(self.journal)), 3)
+        for n in range(3, 5):
+            self.record(writer, n)
+        writer.close()
+        self.assertEqual(len(self.synced), 4)
+        self.assertEqual(self.lines(self.sql), [f"-- row {n}" for n in range(5)])
+
+    def test_interval_commits_a_partial_batch(self):
+        clock = FakeClock()
+        with mock.patch.object(sc.time, "monotonic", clock):
+            writer = self.writer = sc.GroupCommit(every=100, interval=2.0)
+            self.record(writer, 0)
+            self.assertEqual(self.synced, [])
+            clock.now += 2.5
+            self.record(writer, 1)
+            self.assertEqual(len(self.synced), 2)
+            writer.close()
+        self.assertEqual(len(self.lines(self.journal)), 2)
+
+    def test_values_block_commits_when_full(self):
+        writer = self.writer = sc.GroupCommit(every=1)
+        block = sc.ValuesBlock(self.sql, rows_per_block=2)
+        writer.attach(block)
+        block.add("A", 1, None)
+        writer.add(self.journal, ['{"name": "A"}'])
+        writer.end_record()
+        self.assertEqual(self.synced, [])
+        block.add("B", None, True)
+        writer.add(self.journal, ['{"name": "B"}'])
+        writer.end_record()
+        writer.close()
+        self.assertEqual(self.synced, ["out.sql", "out.sql.progress.jsonl"])
+        self.assertEqual(self.lines(self.sql)[1:3], ["(N'A', 1, NULL),", "(N'B', NULL, 1);"])
+
+    def test_begin_goes_ahead_of_the_first_lines_only(self):
+        writer = self.writer = sc.GroupCommit(every=1)
+        writer.begin(self.sql, ["BEGIN TRAN;"])
+        writer.add(self.journal, ['{"name": "A"}'])
+        writer.end_record()
+        self.assertEqual((self.lines(self.sql), writer.begun), ([], set()))
+        self.record(writer, 1)
+        self.record(writer, 2)
+        writer.close()
+        self.assertEqual(self.lines(self.sql), ["BEGIN TRAN;", "-- row 1", "-- row 2"])
+        self.assertEqual(writer.begun, {self.sql})
+
+
+class ProgressJournalTests(unittest.TestCase):
+    def test_resume_skips_a_torn_final_line(self):
+        out = temp_dir(self) / "out.sql"
+        journal = sc.ProgressJournal.for_output(out, [])
+        out.write_text("BEGIN TRAN;\n", encoding="utf-8")
+        journal.record("Alpha", sc.STATUS_MISS, reason="not found (search)")
+        journal.record("Alpha", sc.STATUS_UPDATE, system_id=5, retry=True)
+        journal.record("Beta", sc.STATUS_MISS, reason="no home system")
+        with open(journal.path, "a", encoding="utf-8") as f:
+            f.write('{"name": "Gamma", "status": "upd')
+        resumed = sc.ProgressJournal.for_output(out, ["Alpha", "Beta", "Gamma"])
+        names = ["Alpha", "Beta", "Gamma"]
+        self.assertEqual(resumed.processed(names), {"Alpha", "Beta"})
+        self.assertEqual(resumed.processed(names, include_misses=False), {"Alpha"})
+        self.assertEqual(resumed.misses(names), {"Beta"})
+        self.assertEqual([entry["system_id"] for entry in resumed.updates(names)], [5])
+
+    def test_emptied_output_discards_the_journal(self):
+        out = temp_dir(self) / "out.sql"
+        out.write_text("BEGIN TRAN;\n", encoding="utf-8")
+        sc.ProgressJournal.for_output(out, []).record("Alpha", sc.STATUS_UPDATE, system_id=1)
+        out.write_text("", encoding="utf-8")
+        journal = sc.ProgressJournal.for_output(out, ["Alpha"])
+        self.assertFalse(journal.path.exists())
+        self.assertEqual(journal.processed(["Alpha"]), set())
+
+    def test_seeded_once_from_an_older_output(self):
+        out = temp_dir(self) / "out.sql"
+        out.write_text("SET f.NativeSystemID = 3\nWHERE f.FactionName = 'Alpha';\n"
+                       "-- MISS: Beta (not found (search))\n", encoding="utf-8")
+        journal = sc.ProgressJournal.for_output(out, ["Alpha", "Beta", "Gamma"])
+        self.assertEqual(journal.status("Alpha"), sc.STATUS_UPDATE)
+        self.assertEqual(journal.latest["Alpha"]["system_id"], 3)
+        self.assertEqual(journal.status("Beta"), sc.STATUS_MISS)
+        self.assertIsNone(journal.status("Gamma"))
+        self.assertEqual(len(journal.path.read_text(encoding="utf-8").splitlines()), 2)
+
+    def test_max_age_selects_stale_outcomes(self):
+        journal = sc.ProgressJournal(temp_dir(self) / ("out.sql" + sc.JOURNAL_SUFFIX))
+        journal.record("Alpha", sc.STATUS_UPDATE, system_id=1)
+        journal.record("Beta", sc.STATUS_UPDATE, system_id=2)
+        journal.latest["Beta"]["ts"] = "2000-01-01T00:00:00"
+        self.assertEqual(journal.processed(["Alpha", "Beta"], max_age=3600), {"Alpha"})
+
+    def test_refresh_reads_only_what_was_appended(self):
+        path = temp_dir(self) / ("out.sql" + sc.JOURNAL_SUFFIX)
+        journal = sc.ProgressJournal(path)
+        journal.record("Alpha", sc.STATUS_UPDATE, system_id=1)
+        reader = sc.ProgressJournal(path)
+        reader.refresh()
+        self.assertEqual(reader.latest["Alpha"]["system_id"], 1)
+        # Rewrite the first line in place: a reader going back over it would see "Alphb".
+        path.write_bytes(path.read_bytes().replace(b"Alpha", b"Alphb"))
+        journal.record("Beta", sc.STATUS_MISS, reason="unknown")
+        with open(path, "a", encoding="utf-8") as f:
+            f.write('{"name": "Gamma", "status": "upd')
+        reader.refresh()
+        self.assertEqual(sorted(reader.latest), ["Alpha", "Beta"])
+        with open(path, "a", encoding="utf-8") as f:
+            f.write('ate", "system_id": 3}\n')
+        reader.refresh()
+        self.assertEqual((sorted(reader.latest), reader.lines), (["Alpha", "Beta", "Gamma"], 3))
+
+    def test_compact_keeps_each_names_latest_entry(self):
+        path = temp_dir(self) / ("out.sql" + sc.JOURNAL_SUFFIX)
+        journal = sc.ProgressJournal(path)
+        journal.record("Beta", sc.STATUS_UPDATE, system_id=2)
+        for n in range(3):
+            journal.record("Alpha", sc.STATUS_MISS, reason=f"try {n}")
+        self.assertFalse(journal.compact())  # half the lines are still current
+        journal.record("Beta", sc.STATUS_UPDATE, system_id=2)
+        reader = sc.ProgressJournal(path)
+        reader.refresh()
+        self.assertTrue(journal.compact())
+        self.assertEqual(len(path.read_text(encoding="utf-8").splitlines()), 2)
+        journal.record("Beta", sc.STATUS_UPDATE, system_id=3)
+        reader.refresh()  # the file was replaced: read again from the start
+        self.assertEqual(reader.latest["Alpha"]["reason"], "try 2")
+        self.assertEqual((reader.latest["Beta"]["system_id"], reader.lines), (3, 3))
+
+    def test_unchanged_compares_the_outcome(self):
+        journal = sc.ProgressJournal(temp_dir(self) / ("out.sql" + sc.JOURNAL_SUFFIX))
+        journal.record("Alpha", sc.STATUS_UPDATE, system_id=4, is_player=True)
+        journal.record("Beta", sc.STATUS_MISS, reason="unknown")
+        self.assertTrue(journal.unchanged("Alpha", sc.STATUS_UPDATE, 4, True))
+        self.assertFalse(journal.unchanged("Alpha", sc.STATUS_UPDATE, 5, True))
+        self.assertFalse(journal.unchanged("Alpha", sc.STATUS_UPDATE, 4, None))
+        self.assertTrue(journal.unchanged("Beta", sc.STATUS_MISS))
+        self.assertFalse(journal.unchanged("Gamma", sc.STATUS_MISS))
+
+
+class FakeFactionTable:
+    """ref.Faction behind fake pyodbc connections: the cursor calls apply_faction_updates makes."""
+
+    def __init__(self):
+        self.values = {}
+        self.writers = {}  # faction name -> connections that wrote it
+        self.lock = threading.Lock()
+        self.rng = random.Random(5)
+
+    def connect(self):
+        table = self
+
+        class Cursor:
+            fast_executemany = False
+            rowcount = 0
+
+            def __init__(self, cnx):
+                self.cnx = cnx
+                self.staged = []
+
+            def execute(self, sql, *params):
+                if sql.startswith("UPDATE f"):
+                    with table.lock:
+                        for name, system_id, _ in self.staged:
+                            table.values[name] = system_id
+                            table.writers.setdefault(name, set()).add(id(self.cnx))
+                    self.rowcount = len(self.staged)
+                elif sql.startswith("TRUNCATE"):
+                    self.staged = []
+
+            def executemany(self, sql, rows):
+                time.sleep(table.rng.random() / 500)  # let writers overtake each other
+                self.staged.extend(rows)
+
+            def close(self):
+                pass
+
+        class Connection:
+            def cursor(self):
+                return Cursor(self)
+
+            def commit(self):
+                pass
+
+            def rollback(self):
+                pass
+
+            def close(self):
+                pass
+
+        return Connection()
+
+
+class DbWriterTests(unittest.TestCase):
+    def test_a_faction_always_goes_through_one_writer(self):
+        table = FakeFactionTable()
+        writer = sc.DbWriter(table.connect, batch_size=3, interval=0.001, writers=4)
+        names = [f"Faction {i}" for i in range(12)]
+        for version in range(1, 6):
+            for name in names:
+                writer.put((name, version, None))
+        writer.close()
+        self.assertEqual(table.values, {name: 5 for name in names})
+        self.assertTrue(all(len(cnxs) == 1 for cnxs in table.writers.values()))
+        self.assertEqual(writer.staged, 60)
+
+
+class FakeSystemTable:
+    """The little of a pyodbc connection SystemSnapshot.refresh uses, over a list of (id, name) rows."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def cursor(self):
+        table = self
+
+        class Cursor:
+            def execute(self, sql, *params):
+                table.queries.append(sql)
+                self.pending = [row for row in table.rows if not params or row[0] > params[0]]
+
+            def fetchmany(self, size):
+                batch, self.pending = self.pending[:size], self.pending[size:]
+                return batch
+
+            def close(self):
+                pass
+
+        return Cursor()
+
+
+class SystemSnapshotTests(unittest.TestCase):
+    def test_auto_mode(self):
+        snapshot = Path("snap.sqlite3")
+        small, large = sc.LAZY_SYSTEM_MAP_MAX_FACTIONS, sc.LAZY_SYSTEM_MAP_MAX_FACTIONS + 1
+        self.assertEqual(sc.system_map_mode("auto", small, snapshot), "lazy")
+        self.assertEqual(sc.system_map_mode("auto", large, snapshot), "snapshot")
+        self.assertEqual(sc.system_map_mode("auto", large, None), "full")
+        self.assertEqual(sc.system_map_mode("auto", small, snapshot, explicit=True), "snapshot")
+        self.assertEqual(sc.system_map_mode("auto", small, snapshot, connected=False), "snapshot")
+        self.assertEqual(sc.system_map_mode("full", small, snapshot, explicit=True), "full")
+
+    def test_top_up_then_reload_once_expired(self):
+        table = FakeSystemTable([(1, "Sol"), (2, "Achenar")])
+        snapshot = sc.SystemSnapshot(temp_dir(self) / "snap.sqlite3", "ref.System", "SystemID", "SystemName")
+        self.addCleanup(snapshot.close)
+        self.assertIsNone(snapshot.age())
+        self.assertTrue(snapshot.expired(3600))
+        self.assertEqual(snapshot.refresh(table), 2)
+        self.assertFalse(snapshot.expired(3600))
+        table.rows = [(1, "Sol"), (3, "Lave")]  # Achenar deleted, Lave added
+        self.assertEqual(snapshot.refresh(table), 1)
+        self.assertIn("WHERE SystemID > ?", table.queries[-1])
+        self.assertEqual(snapshot.get("achenar"), 2)
+        clock = FakeClock(time.time() + 7200)
+        with mock.patch.object(sc.time, "time", clock):
+            self.assertTrue(snapshot.expired(3600))
+            self.assertFalse(snapshot.expired(0))
+            snapshot.refresh(table, rebuild=True)
+            self.assertFalse(snapshot.expired(3600))
+        self.assertIsNone(snapshot.get("achenar"))
+        self.assertEqual((snapshot.get("lave"), snapshot.count()), (3, 2))
+
+
+class SystemNameIndexTests(unittest.TestCase):
+    def test_fuzzy_matches_brute_force(self):
+        rng = random.Random(7)
+        names = [f"Synuefe {a}{b}-{c} c{n}-{m}" for a, b, c, n, m in
+                 ((rng.choice("ABCX"), rng.choice("EFGH"), rng.choice("JKL"), rng.randrange(30), rng.randrange(30))
+                  for _ in range(1500))]
+        names += ["".join(rng.choice("ab c-1") for _ in range(rng.randint(1, 7))) for _ in range(1500)]
+        names += ["Alpha Centauri", "Barnard's Star", "Sol", "Sola"]
+        pairs = [(name, i) for i, name in enumerate(names)]
+        queries = names[::10] + ["Alpha Centaur", "Barnards Stra", "So", "Synuefe AE-J c1-", "ba  cb-"]
+        for min_score in (0.85, 0.6, 0.3):
+            index = sc.SystemNameIndex(pairs, fuzzy=True, min_score=min_score)
+            for query in queries:
+                with self.subTest(query=query, min_score=min_score):
+                    self.assertEqual(index.lookup(query, min_score), brute_force(index, query, min_score))
+
+    def test_dense_name_families_stay_fast(self):
+        # Procedural names share most of their trigrams; 50k of them is a small system table.
+        rng = random.Random(7)
+        letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+        names = [f"Col 285 Sector {rng.choice(letters)}{rng.choice(letters)}-{rng.choice(letters)} "
+                 f"d{rng.randrange(200)}-{rng.randrange(100)}" for _ in range(25000)]
+        names += [f"Synuefe {rng.choice(letters)}{rng.choice(letters)}-{rng.choice(letters)} "
+                  f"c{rng.randrange(30)}-{rng.randrange(30)}" for _ in range(25000)]
+        index = sc.SystemNameIndex([(name, i) for i, name in enumerate(names)], fuzzy=True)
+        self.assertIsNone(index.grams)  # built by the first fuzzy lookup, not up front
+        queries = [name[:-1] + "x" for name in names[::250]]
+        for query in queries[::60]:
+            self.assertEqual(index.lookup(query), brute_force(index, query, sc.FUZZY_MIN_SCORE))
+        best = min(self.mean_lookup_secs(index, queries) for _ in range(3))
+        self.assertLess(best, 0.00075, f"{best * 1000:.2f} ms per fuzzy lookup")
+
+    @staticmethod
+    def mean_lookup_secs(index, queries):
+        start = time.perf_counter()
+        for query in queries:
+            index.lookup(query)
+        return (time.perf_counter() - start) / len(queries)
+
+    def test_near_tie_is_ambiguous(self):
+        index = sc.SystemNameIndex([("Col 285 Sector AB-C d12-3", 1), ("Col 285 Sector AB-C d12-4", 2)], fuzzy=True)
+        found = index.lookup("Col 285 Sector AB-C d12-5")
+        self.assertIsNone(found.system_id)
+        self.assertEqual(len(found.rivals), 1)
+
+
+class SystemResolverTests(unittest.TestCase):
+    def test_lazy_misses_use_candidates_until_many(self):
+        rows = [("Alpha Centauri", 1), ("Barnard's Star", 2)]
+        loads = []
+
+        def items():
+            loads.append(1)
+            return rows
+
+        resolver = sc.SystemResolver(lambda name: None, items, match="fuzzy", candidates=lambda name: rows)
+        self.assertEqual(resolver.resolve("Alpha Centaurj")[0], 1)
+        self.assertEqual(resolver.resolve("barnards star")[0], 2)
+        self.assertEqual(loads, [])
+        for i in range(sc.LAZY_INDEX_MISSES):
+            resolver.resolve(f"Nowhere {i}")
+        self.assertEqual(loads, [1])
+        self.assertEqual(resolver.resolve("Alpha Centaurj")[0], 1)
+
+
+class StreamReaderTests(unittest.TestCase):
+    def test_each_chunk_is_scanned_once(self):
+        page = ("<p>filler</p>" * 20000 + "<div><strong>Home system:</strong> <a href='/s'>Sol</a></div>"
+                + "<p>filler</p>" * 20000 + "<div><strong>Player faction:</strong> No</div>" + "<p>tail</p>" * 5000)
+        body = page.encode("utf-8")
+        scanned = []
+
+        def counted(check):
+            def run(text):
+                scanned.append(len(text))
+                return check(text)
+            return run
+
+        reader = sc.StreamReader("utf-8", sc.AllFound(
+            counted(lambda text: sc.fast_label_value(text, r"Home\s+system", anchor=True) is not None),
+            counted(lambda text: sc.fast_flag(text, r"Player\s+faction") is not None)), limit=len(body))
+        chunk = 1000  # small enough that both fields straddle a chunk boundary somewhere
+        for start in range(0, len(body), chunk):
+            if reader.feed(body[start:start + chunk]):
+                break
+        self.assertTrue(reader.partial)
+        text = reader.text()
+        self.assertLess(len(text), len(page))
+        self.assertIn("Player faction:</strong> No</div>", text)
+        # Two checks over each chunk plus the overlap, not over everything read so far.
+        self.assertLess(sum(scanned), 2 * len(text) * (1 + sc.STREAM_OVERLAP_CHARS / chunk))
+        self.assertLess(max(scanned), chunk + sc.STREAM_OVERLAP_CHARS + 1)
+
+    def test_limit_cuts_the_body_short(self):
+        reader = sc.StreamReader(None, lambda text: False, limit=10)
+        self.assertFalse(reader.feed(b"0123"))
+        self.assertTrue(reader.feed(b"456789ab"))
+        self.assertEqual((reader.text(), reader.partial), ("0123456789ab", True))
+
+
+class FastLabelValueTests(unittest.TestCase):
+    def test_value_in_own_element_or_next_sibling(self):
+        edsm = "<div><strong>Home system:</strong> <a href='/sys'>Sol</a></div><div><strong>Player faction:</strong> No</div>"
+        self.assertEqual(sc.fast_label_value(edsm, r"Home\s+system", anchor=True), "Sol")
+        self.assertIs(sc.fast_flag(edsm, r"Player\s+faction"), False)
+        inara = "<table><tr><td>Origin</td><td><a href='/s'>Achenar</a></td></tr><tr><td>Player minor faction</td><td>Yes</td></tr></table>"
+        self.assertEqual(sc.fast_label_value(inara, "Origin", anchor=True), "Achenar")
+        self.assertIs(sc.fast_flag(inara, r"Player\s+minor\s+faction"), True)
+        self.assertEqual(sc.fast_label_value("<p>Player faction: Yes</p>", r"Player\s+faction"), "Yes")
+
+    def test_no_value_from_a_later_element(self):
+        self.assertIsNone(sc.fast_label_value("<ul><li><a>Home system</a></li><li><a>Map</a></li></ul>",
+                                              r"Home\s+system", anchor=True))
+        self.assertIsNone(sc.fast_label_value("<div><span>Origin</span><span></span><span>Sol</span></div>", "Origin"))
+
+
+class WatchTests(unittest.TestCase):
+    def test_deferred_names_are_not_due_at_once(self):
+        journals = sc.watch_journals([temp_dir(self) / "out.sql"])
+        self.assertEqual(sc.watch_due_in(journals, ["Alpha"], 3600), 0.0)
+        deferred = {"Alpha": time.time() + 30}
+        self.assertGreater(sc.watch_due_in(journals, ["Alpha"], 3600, deferred), 25)
+        self.assertEqual(sc.watch_due_in(journals, ["Alpha", "Beta"], 3600, deferred), 0.0)
+
+    def test_journals_see_entries_added_between_polls(self):
+        out = temp_dir(self) / "out.sql"
+        journals = sc.watch_journals([out])
+        self.assertEqual(sc.watch_due_in(journals, ["Alpha"], 3600), 0.0)
+        sc.ProgressJournal(sc.ProgressJournal.path_for(out)).record("Alpha", sc.STATUS_UPDATE, is_player=True)
+        self.assertGreater(sc.watch_due_in(journals, ["Alpha"], 3600), 3500)
+
+    def test_each_pass_appends_its_own_transaction(self):
+        import SetFactionIsPlayer_EDSM as script
+        folder = temp_dir(self)
+        (folder / "names.txt").write_text("Alpha\nBeta\n", encoding="utf-8")
+        out = folder / "out.sql"
+        flags = {"Alpha": (True, None), "Beta": (False, None)}
+        argv = ["SetFactionIsPlayer_EDSM.py", str(folder / "names.txt"), "-o", str(out),
+                "--sleep", "0", "--stale-hours", "0"]
+        with mock.patch.object(script, "fetch_player_flag", lambda name, **kwargs: flags[name]):
+            self.assertEqual(script.main(argv), 0)
+            first = out.read_text(encoding="utf-8")
+            self.assertEqual(script.main(argv), 0)  # every re-check finds what the journal has
+            self.assertEqual(out.read_text(encoding="utf-8"), first)
+            flags["Beta"] = (True, None)
+            self.assertEqual(script.main(argv), 0)
+        added = out.read_text(encoding="utf-8")[len(first):]
+        self.assertEqual((first.count("BEGIN TRAN;"), first.count("COMMIT;")), (1, 1))
+        self.assertEqual((added.count("BEGIN TRAN;"), added.count("COMMIT;")), (1, 1))
+        self.assertIn("Beta", added)
+        self.assertNotIn("Alpha", added)
+        self.assertTrue(sc.ends_with_commit(out))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,13 +4,29 @@
 #   python resourceTranslator.py --default StringResources.default.xaml --langs af de es fr it ja ru zh --provider auto
 #   python resourceTranslator.py --default StringResources.default.xaml --langs af de es fr it ja ru zh --provider google --overwrite
 #   python resourceTranslator.py --default StringResources.default.xaml --langs zh --provider auto --overwrite
+#   # Translations are remembered in translation_memory.json next to the default file, so a rerun only
+#   # translates strings that are new or changed (--memory PATH to move it, --no-memory to bypass it)
+#   python resourceTranslator.py --default StringResources.default.xaml --langs af de es fr it ja ru zh --incremental
+#   # --incremental only translates keys that are new or whose default text changed since the target was
+#   # written (per-key source hashes in translation_sources.json); every other value is kept byte-for-byte
+#   python resourceTranslator.py --default StringResources.default.xaml --langs af de es fr it ja ru zh --overwrite --jobs 4
+#   # --jobs N translates N languages (and N batches/strings within each) at once, within PROVIDER_LIMITS
+#   # (each provider's concurrent calls and calls per second, shared by all languages); the files written
+#   # are identical to a sequential run
+#   # A provider that is not configured (e.g. no Azure env vars) is skipped for the whole run, and one that
+#   # keeps failing (e.g. Google rate-limiting) is skipped until a probe after its cooldown succeeds
 #   # Azure (recommended for reliability): set env vars AZURE_TRANSLATOR_KEY, AZURE_TRANSLATOR_REGION, AZURE_TRANSLATOR_ENDPOINT
 
 import os
 import re
+import hashlib
 import json
 import time
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from contextvars import ContextVar, copy_context
 from pathlib import Path
 
 # Keys to skip translating (endonyms for language selection)
@@ -53,11 +69,36 @@ MANUAL_OVERRIDES = {
 }
 
 
+MEMORY_FILE_NAME = "translation_memory.json"
+SOURCE_HASHES_FILE_NAME = "translation_sources.json"
+MANUAL_PROVIDER = "manual"
+
+# Per-provider (concurrent calls, calls per second) when running with --jobs > 1; a sequential run makes
+# one call at a time and stays well under these rates
+PROVIDER_LIMITS = {
+    "azure": (4, 10.0),
+    "google": (2, 8.0),
+    "mymemory": (1, 1.0),
+}
+
+# Azure Translator v3 per-request limits (array elements / characters across all elements)
+AZURE_MAX_ITEMS = 100
+AZURE_MAX_CHARS = 10000
+
+# Provider circuit breaker: a provider is skipped after this many strings (or batches) in a row
+# failed on it, until a probe after the cooldown succeeds; each failed probe doubles the cooldown
+PROVIDER_FAILURES = 3
+PROVIDER_COOLDOWN_SECS = 30.0
+PROVIDER_MAX_COOLDOWN_SECS = 300.0
+# How often one string waits for a cooling-down provider before giving up
+PROVIDER_MAX_WAITS = 4
+
 # EXACT value-only replace between <prefix:String ...> ... </prefix:String>
 STRING_TAG_RE = re.compile(
     r'(<(?P<prefix>[A-Za-z_][\w\-.]*):String\b[^>]*>)(?P<inner>.*?)(</(?P=prefix):String>)',
     re.DOTALL
 )
+KEY_RE = re.compile(r'\bx:Key\s*=\s*"([^"]+)"')
 
 # Protect placeholders/entities
 PLACEHOLDER_PATTERNS = [
@@ -100,7 +141,178 @@ def restore_tokens(text: str, token_map):
         text = text.replace(f'__TKN{idx}__', tok)
     return text
 
+# ---------------- Translation memory ----------------
+class TranslationMemory:
+    """
+    Persistent (source text after protect_tokens, target lang, provider) -> translation store,
+    kept as JSON next to the resources. MANUAL_OVERRIDES are merged in as pinned "manual"
+    entries that win over every provider and are never overwritten. They are rebuilt from
+    MANUAL_OVERRIDES on every load and never saved, so a removed override stops applying.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.hits = 0
+        self.added = 0
+        self._lock = threading.Lock()
+        # lang -> provider -> protected source text -> translation
+        self.entries = {}
+        if path.exists():
+            self.entries = json.loads(path.read_text(encoding="utf-8")).get("entries", {})
+        for by_provider in self.entries.values():
+            by_provider.pop(MANUAL_PROVIDER, None)  # written by older versions
+        for en, per_lang in MANUAL_OVERRIDES.items():
+            protected, _tokens = protect_tokens(en)
+            for lang, value in per_lang.items():
+                self.entries.setdefault(lang, {}).setdefault(MANUAL_PROVIDER, {})[protected] = value
+
+    def get(self, text, target_lang, order):
+        by_provider = self.entries.get(target_lang, {})
+        for provider in (MANUAL_PROVIDER,) + tuple(order):
+            res = by_provider.get(provider, {}).get(text)
+            if res is not None:
+                with self._lock:
+                    self.hits += 1
+                return res
+        return None
+
+    def put(self, text, target_lang, provider, translation):
+        if provider == MANUAL_PROVIDER:
+            return
+        with self._lock:
+            self.entries.setdefault(target_lang, {}).setdefault(provider, {})[text] = translation
+            self.added += 1
+
+    def save(self):
+        """Write the memory atomically (temp file + rename)."""
+        with self._lock:
+            entries = {}
+            for lang, by_provider in self.entries.items():
+                saved = {provider: texts for provider, texts in by_provider.items() if provider != MANUAL_PROVIDER}
+                if saved:
+                    entries[lang] = saved
+            data = json.dumps({"version": 1, "entries": entries}, ensure_ascii=False, indent=1, sort_keys=True)
+        write_text_atomic(self.path, data + "\n")
+
+def write_text_atomic(path: Path, text: str):
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(text, encoding="utf-8")
+    os.replace(tmp, path)
+
 # ---------------- Translation providers ----------------
+class ProviderGate:
+    """Caps one provider's concurrent calls and calls per second across all --jobs threads"""
+
+    def __init__(self, concurrency, rate):
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._slots.acquire()
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self._interval
+        if start > now:
+            time.sleep(start - now)
+        return self
+
+    def __exit__(self, *exc):
+        self._slots.release()
+
+# Where provider status messages go; with --jobs, the output buffer of the language being translated
+PROVIDER_REPORT = ContextVar("PROVIDER_REPORT", default=None)
+
+def report(message):
+    (PROVIDER_REPORT.get() or print)(message)
+
+class ProviderUnavailable(RuntimeError):
+    """The provider cannot work in this run at all (e.g. not configured), so it is never retried"""
+
+def _unavailable(err):
+    return isinstance(err, (ProviderUnavailable, ImportError))
+
+class ProviderHealth:
+    """
+    Per-run provider circuit breaker, shared by all strings, languages and --jobs threads.
+
+    An unavailable provider is switched off for the rest of the run. One that fails `threshold`
+    calls in a row is skipped until `cooldown` seconds have passed, when exactly one caller gets
+    through as the probe: success puts it back in rotation, failure reopens it for twice as long
+    (up to max_cooldown).
+    """
+
+    def __init__(self, threshold=PROVIDER_FAILURES, cooldown=PROVIDER_COOLDOWN_SECS, max_cooldown=PROVIDER_MAX_COOLDOWN_SECS):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max(cooldown, max_cooldown)
+        # provider -> [consecutive failures, reopen time (monotonic, inf = off) or None, current cooldown, probe in flight]
+        self._providers = {}
+        self._lock = threading.Lock()
+
+    def _state(self, provider):
+        state = self._providers.get(provider)
+        if state is None:
+            state = self._providers[provider] = [0, None, self.cooldown, False]
+        return state
+
+    def allow(self, provider):
+        """True if a call to provider may go out now (possibly as the probe)"""
+        with self._lock:
+            state = self._state(provider)
+            if state[1] is None:
+                return True
+            if state[3] or time.monotonic() < state[1]:
+                return False
+            state[3] = True
+        report(f"Provider {provider}: cooldown over, sending a probe")
+        return True
+
+    def success(self, provider):
+        with self._lock:
+            state = self._state(provider)
+            reopened = state[1] is not None
+            self._providers[provider] = [0, None, self.cooldown, False]
+        if reopened:
+            report(f"Provider {provider}: probe succeeded, back in rotation")
+
+    def failure(self, provider, err):
+        with self._lock:
+            state = self._state(provider)
+            state[0] += 1
+            if _unavailable(err):
+                if state[1] == float("inf"):
+                    return
+                state[1], state[3] = float("inf"), False
+                message = f"Provider {provider}: unavailable, skipped for the rest of this run ({err})"
+            else:
+                if state[3]:
+                    state[2] = min(self.max_cooldown, state[2] * 2)
+                elif state[1] is not None or state[0] < self.threshold:
+                    return
+                state[1], state[3] = time.monotonic() + state[2], False
+                message = f"Provider {provider}: {state[0]} failures in a row, skipped for {state[2]:.0f}s ({err})"
+        report(message)
+
+    def retry_in(self, providers):
+        """Seconds until one of providers is due a probe; None if none of them is cooling down"""
+        with self._lock:
+            now = time.monotonic()
+            waits = [max(0.0, state[1] - now) if not state[3] else 1.0
+                     for state in (self._providers.get(p) for p in providers)
+                     if state is not None and state[1] is not None and state[1] != float("inf")]
+        return min(waits) if waits else None
+
+PROVIDER_HEALTH = ProviderHealth()
+
+# provider -> ProviderGate; only filled in for --jobs > 1
+PROVIDER_GATES = {}
+
+def provider_gate(provider):
+    return PROVIDER_GATES.get(provider) or nullcontext()
+
 def try_google(text, target_lang):
     from deep_translator import GoogleTranslator
     gt = GoogleTranslator(source='en', target=target_lang)
@@ -118,7 +330,7 @@ def try_azure_batch(lines, target_lang):
     key = os.environ.get('AZURE_TRANSLATOR_KEY')
     region = os.environ.get('AZURE_TRANSLATOR_REGION')
     if not endpoint or not key or not region:
-        raise RuntimeError("Azure env vars missing.")
+        raise ProviderUnavailable("Azure env vars missing.")
     url = f"{endpoint.rstrip('/')}/translate?api-version=3.0&to={target_lang}"
     headers = {
         "Ocp-Apim-Subscription-Key": key,
@@ -176,50 +388,173 @@ def _allow_unchanged(text: str) -> bool:
     return False
 
 
-def robust_translate_one(text, target_lang, order=("azure","google","mymemory"), max_retries=4):
+def robust_translate_one(text, target_lang, order=("azure","google","mymemory"), max_retries=4, with_provider=False):
+    """Translate one text; with_provider=True returns (translation, provider that produced it)."""
     if not text.strip():
-        return text
+        return (text, None) if with_provider else text
+
+    last_err = None
+    for waits in range(PROVIDER_MAX_WAITS + 1):
+        for provider in order:
+            if not PROVIDER_HEALTH.allow(provider):
+                continue
+            norm_lang = normalize_lang_for_provider(provider, target_lang)
+            answered = False
+            for attempt in range(max_retries):
+                try:
+                    with provider_gate(provider):
+                        if provider == "azure":
+                            res = try_azure_batch([text], norm_lang)[0]
+                        elif provider == "google":
+                            res = try_google(text, norm_lang)
+                        elif provider == "mymemory":
+                            res = try_mymemory(text, norm_lang)
+                        else:
+                            continue
+                    answered = True
+
+                    if res.strip() == text.strip() and not _allow_unchanged(text):
+                        raise RuntimeError(f"{provider} returned unchanged text")
+
+                    PROVIDER_HEALTH.success(provider)
+                    return (res, provider) if with_provider else res
+                except Exception as e:
+                    last_err = e
+                    if _unavailable(e):
+                        break
+                    time.sleep(0.25 * (attempt + 1))
+            # An unchanged result still shows the provider is up; only failed calls count against it
+            if answered:
+                PROVIDER_HEALTH.success(provider)
+            else:
+                PROVIDER_HEALTH.failure(provider, last_err)
+        # Every provider failed or was skipped: wait for one that is cooling down, if any
+        wait = PROVIDER_HEALTH.retry_in(order)
+        if wait is None or waits == PROVIDER_MAX_WAITS:
+            break
+        time.sleep(wait)
+    raise RuntimeError(f"All providers failed for text: {text!r}; last error: {last_err}")
 
+def _batches(texts, max_items, max_chars):
+    """
+    Split texts into consecutive lists of at most max_items items / max_chars characters
+    (an oversize single text still gets a batch of its own)
+    """
+    batch, size = [], 0
+    for t in texts:
+        if batch and (len(batch) >= max_items or size + len(t) > max_chars):
+            yield batch
+            batch, size = [], 0
+        batch.append(t)
+        size += len(t)
+    if batch:
+        yield batch
+
+def translate_many(texts, target_lang, order=("azure","google","mymemory"), max_retries=4, memory=None, pool=None):
+    """
+    Translate a list of texts, returning the results in the same order.
+    Each distinct text is translated once, and not at all if the translation memory has it.
+    Azure gets the rest in provider-sized batches; items a batch fails on (or returns unchanged)
+    fall back to robust_translate_one with the remaining providers. Providers without a batch
+    API translate item by item. New translations are added to the memory.
+    With a thread pool (--jobs), batches and per-item fallbacks run concurrently; results
+    are still collected in input order, so the outcome matches a sequential run.
+    """
+    def run_all(fn, items):
+        if pool is None:
+            return map(fn, items)
+        # Each call sees this thread's PROVIDER_REPORT, so its messages land in the right language's output
+        context = copy_context()
+        return pool.map(lambda item: context.copy().run(fn, item), items)
+
+    results = {}
+    pending = []
+    for t in dict.fromkeys(texts):
+        if not t.strip():
+            continue
+        hit = memory.get(t, target_lang, order) if memory is not None else None
+        if hit is None:
+            pending.append(t)
+        else:
+            results[t] = hit
+    rest = order
     last_err = None
-    for provider in order:
-        norm_lang = normalize_lang_for_provider(provider, target_lang)
-        for attempt in range(max_retries):
-            try:
-                if provider == "azure":
-                    res = try_azure_batch([text], norm_lang)[0]
-                elif provider == "google":
-                    res = try_google(text, norm_lang)
-                elif provider == "mymemory":
-                    res = try_mymemory(text, norm_lang)
+    if order and order[0] == "azure":
+        rest = order[1:]
+        todo, pending = pending, []
+        norm_lang = normalize_lang_for_provider("azure", target_lang)
+
+        def azure_batch(batch):
+            if not PROVIDER_HEALTH.allow("azure"):
+                return None, RuntimeError("azure skipped: provider failing")
+            err = None
+            for attempt in range(max_retries):
+                try:
+                    with provider_gate("azure"):
+                        translated = try_azure_batch(batch, norm_lang)
+                    if len(translated) != len(batch):
+                        raise RuntimeError(f"azure returned {len(translated)} items for {len(batch)}")
+                    PROVIDER_HEALTH.success("azure")
+                    return translated, None
+                except Exception as e:
+                    err = e
+                    if _unavailable(e):
+                        break
+                    time.sleep(0.25 * (attempt + 1))
+            PROVIDER_HEALTH.failure("azure", err)
+            return None, err
+
+        batches = list(_batches(todo, AZURE_MAX_ITEMS, AZURE_MAX_CHARS))
+        for batch, (translated, err) in zip(batches, run_all(azure_batch, batches)):
+            if translated is None:
+                last_err = err
+                pending.extend(batch)
+                continue
+            for text, res in zip(batch, translated):
+                if res.strip() != text.strip() or _allow_unchanged(text):
+                    results[text] = res
+                    if memory is not None:
+                        memory.put(text, target_lang, "azure", res)
                 else:
-                    continue
+                    last_err = RuntimeError("azure returned unchanged text")
+                    pending.append(text)
 
-                if res.strip() == text.strip():
-                    if _allow_unchanged(text):
-                        return res
-                    raise RuntimeError(f"{provider} returned unchanged text")
+    # Per-item fallback
+    if pending and not rest:
+        raise RuntimeError(f"All providers failed for text: {pending[0]!r}; last error: {last_err}")
 
-                return res
-            except Exception as e:
-                last_err = e
-                time.sleep(0.25 * (attempt + 1))
-    raise RuntimeError(f"All providers failed for text: {text!r}; last error: {last_err}")
+    def fallback(text):
+        return robust_translate_one(text, target_lang, order=rest, max_retries=max_retries, with_provider=True)
+
+    for text, (res, provider) in zip(pending, run_all(fallback, pending)):
+        results[text] = res
+        if memory is not None:
+            memory.put(text, target_lang, provider, res)
+    return [results.get(t, t) for t in texts]
 
 
 # -------------------------------------------------------
-def translate_values_preserve_format(src_text: str, target_lang: str, mode: str):
+def translate_values_preserve_format(src_text: str, target_lang: str, mode: str, memory=None, keep=None, pool=None):
+    """
+    Translate every <x:String> value of src_text into target_lang, leaving all other bytes alone.
+    keep: optional x:Key -> value taken verbatim instead of translating (--incremental).
+    pool: optional thread pool for concurrent provider calls (--jobs).
+    """
     order = ("azure","google","mymemory") if mode == "auto" else ((mode,) if mode in ("azure","google") else ("google","mymemory"))
 
     matches = list(STRING_TAG_RE.finditer(src_text))
     out = []
     last = 0
+    # Translatable values: out[] index to fill, text before/after the core, token map, trailing punct
+    slots = []
+    texts = []
     for m in matches:
         prefix = m.group(1)
         inner  = m.group('inner')
         suffix = m.group(4)
 
         # detect x:Key
-        key_match = re.search(r'\bx:Key\s*=\s*"([^"]+)"', prefix)
+        key_match = KEY_RE.search(prefix)
         key = key_match.group(1) if key_match else None
 
         # Skip language-option endonyms entirely
@@ -229,6 +564,13 @@ def translate_values_preserve_format(src_text: str, target_lang: str, mode: str)
             last = m.end()
             continue
 
+        # --incremental: value still current in the existing target file, keep it as is
+        if keep and key in keep:
+            out.append(src_text[last:m.start()])
+            out.append(prefix + keep[key] + suffix)
+            last = m.end()
+            continue
+
         # Preserve whitespace around core
         leading_ws = re.match(r'^\s*', inner, re.DOTALL).group(0)
         trailing_ws_match = re.search(r'\s*$', inner, re.DOTALL)
@@ -246,64 +588,173 @@ def translate_values_preserve_format(src_text: str, target_lang: str, mode: str)
             continue
         # --- END NEW
         
-        # Protect tokens on the punctuation-free core
+        # Protect tokens on the punctuation-free core; translated below with all the others
         protected, token_map = protect_tokens(core_np)
 
-        # Robust translation
-        translated_core_np = robust_translate_one(protected, target_lang, order=order, max_retries=4)
-        restored_np = restore_tokens(translated_core_np, token_map)
-
-        # Reattach any trailing punctuation exactly as in source
-        restored = restored_np + core_punct
-
         out.append(src_text[last:m.start()])
-        out.append(prefix + leading_ws + restored + trailing_ws + suffix)
+        slots.append((len(out), prefix + leading_ws, token_map, core_punct, trailing_ws + suffix))
+        texts.append(protected)
+        out.append(None)
         last = m.end()
 
     out.append(src_text[last:])
+
+    # Robust translation, batched where the provider allows it
+    translated = translate_many(texts, target_lang, order=order, max_retries=4, memory=memory, pool=pool)
+    for (pos, head, token_map, core_punct, tail), translated_core_np in zip(slots, translated):
+        restored_np = restore_tokens(translated_core_np, token_map)
+        # Reattach any trailing punctuation exactly as in source
+        out[pos] = head + restored_np + core_punct + tail
     return ''.join(out)
 
-def write_bytes_like_source(out_path: Path, new_text: str, source_bytes: bytes):
+def string_values(text: str):
+    """x:Key -> raw value of every <x:String> in a resource file"""
+    values = {}
+    for m in STRING_TAG_RE.finditer(text):
+        key_match = KEY_RE.search(m.group(1))
+        if key_match:
+            values[key_match.group(1)] = m.group('inner')
+    return values
+
+def source_hash(value: str) -> str:
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()[:16]
+
+def incremental_keep(src_values, target_values, hashes, previous_src=None):
+    """
+    Keys whose existing target value can stay: present in the target and their default text
+    unchanged since it was written. For keys without a stored hash (target written before
+    --incremental existed), previous_src -- the EN copy of the default as of the last run --
+    supplies the text it was translated from; a key found in neither counts as changed.
+    """
+    keep = {}
+    for key, value in src_values.items():
+        if key not in target_values:
+            continue
+        stored = hashes.get(key)
+        if stored is None and previous_src and key in previous_src:
+            stored = source_hash(previous_src[key])
+        if stored == source_hash(value):
+            keep[key] = target_values[key]
+    return keep
+
+def read_resource_text(data: bytes) -> str:
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return data.decode("utf-8-sig")
+
+def encode_like_source(new_text: str, source_bytes: bytes) -> bytes:
     has_bom = source_bytes.startswith(b'\xef\xbb\xbf')
-    out_bytes = new_text.encode("utf-8-sig" if has_bom else "utf-8")
-    out_path.write_bytes(out_bytes)
+    return new_text.encode("utf-8-sig" if has_bom else "utf-8")
+
+def write_bytes_like_source(out_path: Path, new_text: str, source_bytes: bytes):
+    """Write atomically (temp file + rename), so an interrupted run never leaves a half-written file"""
+    tmp = out_path.with_name(out_path.name + ".tmp")
+    tmp.write_bytes(encode_like_source(new_text, source_bytes))
+    os.replace(tmp, out_path)
 
 def main():
     ap = argparse.ArgumentParser(description="Translate from StringResources.default.xaml -> en + other languages, preserving exact XML formatting.")
     ap.add_argument("--default", required=True, help="Path to StringResources.default.xaml")
     ap.add_argument("--langs", nargs="+", required=True, help="Target langs, e.g. af de es fr it ja ru zh")
     ap.add_argument("--provider", choices=["auto","azure","google"], default="auto", help="auto=azure(if configured)->google->mymemory")
-    ap.add_argument("--overwrite", action="store_true", help="Overwrite existing outputs")
+    mode = ap.add_mutually_exclusive_group()
+    mode.add_argument("--overwrite", action="store_true", help="Overwrite existing outputs")
+    mode.add_argument("--incremental", action="store_true",
+                      help="Update existing outputs in place: translate only new or changed keys, keep the rest byte-for-byte")
+    ap.add_argument("--memory", default=None, help=f"Translation memory file (default: {MEMORY_FILE_NAME} next to --default)")
+    ap.add_argument("--no-memory", action="store_true", help="Translate everything again, without reading or updating the memory")
+    ap.add_argument("--jobs", type=int, default=1, help="Languages (and provider calls within each) to translate at once")
     args = ap.parse_args()
+    jobs = max(1, args.jobs)
 
     default_path = Path(args.default)
     if not default_path.exists():
         raise FileNotFoundError(f"Default file not found: {default_path}")
 
     src_bytes = default_path.read_bytes()
-    try:
-        src_text = src_bytes.decode("utf-8")
-    except UnicodeDecodeError:
-        src_text = src_bytes.decode("utf-8-sig")
+    src_text = read_resource_text(src_bytes)
+    src_values = string_values(src_text)
 
     # 1) Create EN as direct copy (verbatim)
     en_path = default_path.with_name("StringResources.en.xaml")
-    if en_path.exists() and not args.overwrite:
+    # Read before it is refreshed: --incremental falls back to it for keys without a stored hash
+    previous_src = string_values(read_resource_text(en_path.read_bytes())) if en_path.exists() else {}
+    if en_path.exists() and args.incremental and en_path.read_bytes() == src_bytes:
+        print(f"EN up to date: {en_path}")
+    elif en_path.exists() and not (args.overwrite or args.incremental):
         print(f"EN exists, skipping copy (use --overwrite to replace): {en_path}")
     else:
         en_path.write_bytes(src_bytes)
         print(f"Created EN copy: {en_path}")
 
-    # 2) Translate for each requested language
-    for lang in args.langs:
+    # lang -> x:Key -> hash of the default value each target value was translated from
+    hashes_path = default_path.with_name(SOURCE_HASHES_FILE_NAME)
+    hashes = json.loads(hashes_path.read_text(encoding="utf-8")) if hashes_path.exists() else {}
+
+    memory = None
+    if not args.no_memory:
+        memory = TranslationMemory(Path(args.memory) if args.memory else default_path.with_name(MEMORY_FILE_NAME))
+
+    if jobs > 1:
+        for provider, (concurrency, rate) in PROVIDER_LIMITS.items():
+            PROVIDER_GATES[provider] = ProviderGate(min(concurrency, jobs), rate)
+
+    def run_lang(lang, emit, pool=None):
+        """Translate and write one language; returns False when it was skipped"""
         out_path = default_path.with_name(f"StringResources.{lang}.xaml")
-        if out_path.exists() and not args.overwrite:
-            print(f"Exists, skipping: {out_path}")
-            continue
-        print(f"Translating -> {lang} : {out_path}")
-        new_text = translate_values_preserve_format(src_text, lang, args.provider)
-        write_bytes_like_source(out_path, new_text, src_bytes)
-        print(f"Saved: {out_path}")
+        keep = None
+        if out_path.exists() and args.incremental:
+            old_bytes = out_path.read_bytes()
+            keep = incremental_keep(src_values, string_values(read_resource_text(old_bytes)), hashes.get(lang, {}), previous_src)
+            changed = len(src_values) - len(keep)
+            emit(f"Incremental -> {lang} : {changed} new or changed keys, {len(keep)} kept")
+        elif out_path.exists() and not args.overwrite:
+            emit(f"Exists, skipping: {out_path}")
+            return False
+        else:
+            emit(f"Translating -> {lang} : {out_path}")
+        new_text = translate_values_preserve_format(src_text, lang, args.provider, memory=memory, keep=keep, pool=pool)
+        if keep is not None and encode_like_source(new_text, src_bytes) == old_bytes:
+            emit(f"Up to date: {out_path}")
+        else:
+            write_bytes_like_source(out_path, new_text, src_bytes)
+            emit(f"Saved: {out_path}")
+        return True
+
+    def finish_lang(lang):
+        # Shared state is only written from the main thread, in --langs order
+        hashes[lang] = {key: source_hash(value) for key, value in src_values.items()}
+        write_text_atomic(hashes_path, json.dumps(hashes, indent=1, sort_keys=True) + "\n")
+        if memory is not None:
+            memory.save()
+            print(f"Translation memory: {memory.hits} hits, {memory.added} new entries so far ({memory.path.name})")
+
+    # 2) Translate for each requested language
+    if jobs == 1:
+        for lang in args.langs:
+            if run_lang(lang, print):
+                finish_lang(lang)
+        return
+
+    def run_buffered(lang, pool):
+        lines = []
+        token = PROVIDER_REPORT.set(lines.append)
+        try:
+            done = run_lang(lang, lines.append, pool=pool)
+        finally:
+            PROVIDER_REPORT.reset(token)
+        return done, lines
+
+    # Separate pools: language tasks block on their own provider calls, so sharing one pool could deadlock
+    with ThreadPoolExecutor(jobs) as lang_pool, ThreadPoolExecutor(jobs) as call_pool:
+        futures = [lang_pool.submit(run_buffered, lang, call_pool) for lang in args.langs]
+        for lang, future in zip(args.langs, futures):
+            done, lines = future.result()
+            for line in lines:
+                print(line)
+            if done:
+                finish_lang(lang)
 
 if __name__ == "__main__":
     main()
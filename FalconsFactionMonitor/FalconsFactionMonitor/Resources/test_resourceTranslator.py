@@ -0,0 +1,152 @@
+# Tests for resourceTranslator.py; providers are replaced by a deterministic fake, so no network is used.
+# Run from this folder: python -m unittest test_resourceTranslator  (or: python -m pytest)
+
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import resourceTranslator as rt
+
+HERE = Path(__file__).resolve().parent
+
+
+def fake_google(text, target_lang):
+    return f"[{target_lang}] {text.upper()}"
+
+
+def no_azure(lines, target_lang):
+    raise rt.ProviderUnavailable("Azure env vars missing.")
+
+
+class FakeProviderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.dir)
+        for name in ("StringResources.default.xaml", "StringResources.en.xaml", "StringResources.ja.xaml"):
+            shutil.copy(HERE / name, self.dir / name)
+        self.default = self.dir / "StringResources.default.xaml"
+        patches = [
+            mock.patch.object(rt, "try_azure_batch", no_azure),
+            mock.patch.object(rt, "try_google", fake_google),
+            mock.patch.object(rt, "PROVIDER_HEALTH", rt.ProviderHealth()),
+            mock.patch.dict(rt.PROVIDER_GATES),
+            # Fast enough that --jobs runs of the fake provider are not held up by pacing
+            mock.patch.dict(rt.PROVIDER_LIMITS, google=(2, 10000.0)),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def run_main(self, *args):
+        """Run the script; returns the lines it printed."""
+        argv = ["resourceTranslator.py", "--default", str(self.default), "--langs", "ja", "--no-memory", *args]
+        with mock.patch.object(sys, "argv", argv), mock.patch("builtins.print") as printed:
+            rt.main()
+        return [str(call.args[0]) for call in printed.call_args_list]
+
+    def values(self, name):
+        return rt.string_values(rt.read_resource_text((self.dir / name).read_bytes()))
+
+
+class IncrementalTests(FakeProviderTestCase):
+    def test_missing_hash_counts_as_changed(self):
+        src = {"A": "Search", "B": "Close"}
+        self.assertEqual(rt.incremental_keep(src, {"A": "x", "B": "y"}, {}), {})
+        previous = {"A": "Find", "B": "Close"}
+        self.assertEqual(rt.incremental_keep(src, {"A": "x", "B": "y"}, {}, previous), {"B": "y"})
+
+    def test_edited_source_without_hash_file_is_retranslated(self):
+        key = "InfluenceHistory_Button_Search"
+        before = self.values("StringResources.ja.xaml")
+        text = rt.read_resource_text(self.default.read_bytes())
+        edited = text.replace(f'x:Key="{key}">Search<', f'x:Key="{key}">Search systems<')
+        self.assertNotEqual(edited, text)
+        self.default.write_bytes(rt.encode_like_source(edited, self.default.read_bytes()))
+        self.assertFalse((self.dir / rt.SOURCE_HASHES_FILE_NAME).exists())
+
+        self.run_main("--incremental")
+
+        after = self.values("StringResources.ja.xaml")
+        self.assertEqual(after[key], "[ja] SEARCH SYSTEMS")
+        self.assertEqual({k: v for k, v in after.items() if k != key},
+                         {k: v for k, v in before.items() if k != key})
+        hashes = rt.json.loads((self.dir / rt.SOURCE_HASHES_FILE_NAME).read_text(encoding="utf-8"))
+        self.assertEqual(hashes["ja"][key], rt.source_hash("Search systems"))
+
+        # A second run finds nothing left to do
+        data = (self.dir / "StringResources.ja.xaml").read_bytes()
+        with mock.patch.object(rt, "try_google", side_effect=AssertionError("nothing should be translated")):
+            self.run_main("--incremental")
+        self.assertEqual((self.dir / "StringResources.ja.xaml").read_bytes(), data)
+
+
+class JobsTests(FakeProviderTestCase):
+    def test_jobs_match_sequential_run(self):
+        langs = ["de", "fr", "ja"]
+        self.run_main("--overwrite", "--langs", *langs)
+        sequential = {lang: (self.dir / f"StringResources.{lang}.xaml").read_bytes() for lang in langs}
+        rt.PROVIDER_HEALTH = rt.ProviderHealth()
+
+        lines = self.run_main("--overwrite", "--langs", *langs, "--jobs", "3")
+
+        for lang in langs:
+            self.assertEqual((self.dir / f"StringResources.{lang}.xaml").read_bytes(), sequential[lang])
+        # Provider messages from worker threads are printed with the language that caused them
+        reports = [i for i, line in enumerate(lines) if line.startswith("Provider azure:")]
+        self.assertEqual(len(reports), 1)
+        before = [line for line in lines[:reports[0]] if line.startswith("Translating -> ")][-1]
+        after = next(line for line in lines[reports[0]:] if line.startswith("Saved: "))
+        lang = before.split()[2]
+        self.assertTrue(after.endswith(f"StringResources.{lang}.xaml"))
+        self.assertNotIn(f"Saved: {self.dir / f'StringResources.{lang}.xaml'}", lines[:reports[0]])
+
+    def test_provider_rate_is_shared_by_all_languages(self):
+        rate = 100.0
+        calls = []
+
+        def timed_google(text, target_lang):
+            calls.append(time.monotonic())
+            return fake_google(text, target_lang)
+
+        with mock.patch.dict(rt.PROVIDER_LIMITS, google=(4, rate)), mock.patch.object(rt, "try_google", timed_google):
+            self.run_main("--overwrite", "--langs", "de", "fr", "--jobs", "2")
+
+        calls.sort()
+        self.assertGreater(len(calls), 100)
+        # Any 11 calls in a row span at least 10 intervals, less one for thread wake-up jitter
+        window = 10
+        fastest = min(calls[i + window] - calls[i] for i in range(len(calls) - window))
+        self.assertGreaterEqual(fastest, (window - 1) / rate)
+
+
+class MemoryTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = self.dir / rt.MEMORY_FILE_NAME
+
+    def test_removed_override_no_longer_wins(self):
+        with mock.patch.dict(rt.MANUAL_OVERRIDES, {"Close": {"ja": "閉じる (manual)"}}):
+            memory = rt.TranslationMemory(self.path)
+            memory.put("Close", "ja", "google", "閉じる")
+            self.assertEqual(memory.get("Close", "ja", ["google"]), "閉じる (manual)")
+            memory.save()
+        saved = rt.json.loads(self.path.read_text(encoding="utf-8"))["entries"]
+        self.assertNotIn(rt.MANUAL_PROVIDER, saved["ja"])
+
+        memory = rt.TranslationMemory(self.path)
+        self.assertEqual(memory.get("Close", "ja", ["google"]), "閉じる")
+
+    def test_manual_bucket_from_old_file_is_dropped(self):
+        entries = {"ja": {rt.MANUAL_PROVIDER: {"Close": "stale"}, "google": {"Close": "閉じる"}}}
+        self.path.write_text(rt.json.dumps({"version": 1, "entries": entries}), encoding="utf-8")
+        memory = rt.TranslationMemory(self.path)
+        self.assertEqual(memory.get("Close", "ja", ["google"]), "閉じる")
+
+
+if __name__ == "__main__":
+    unittest.main()